@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Compare the peak memory used by Database.fetchall and Database.stream when
+reading a large table.
+
+Run from the folder containing the bot's config.json, which is used to
+connect:
+
+    python benchmarks/stream.py [rows] [batch_size]
+
+A table named stream_benchmark is filled with `rows' rows (one million by
+default), each mode is run in its own process, and the table is dropped.
+"""
+
+import asyncio
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+ROWS = 1000000
+BATCH_SIZE = 1000
+INSERT_BATCH = 10000
+TABLE = "stream_benchmark"
+
+
+def peak_rss() -> int:
+    """
+    Return the peak resident set size of this process in KiB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes rather than KiB
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def current_rss() -> int:
+    """
+    Return the current resident set size of this process in KiB.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") // 1024
+    except OSError:
+        return peak_rss()
+
+
+async def fill(db, rows: int):
+    await db.execute(f"DROP TABLE IF EXISTS {TABLE};")
+    await db.execute(f"""
+        CREATE TABLE {TABLE} (
+            id BIGINT NOT NULL PRIMARY KEY,
+            guild_id BIGINT NOT NULL,
+            command VARCHAR(255) NOT NULL
+        );
+    """)
+    insert = f"INSERT INTO {TABLE} VALUES (%s, %s, %s);"
+    for start in range(0, rows, INSERT_BATCH):
+        await db.executemany(insert, *(
+            (i, 100000000000000000 + i, f".command.number_{i % 1000}")
+            for i in range(start, min(start + INSERT_BATCH, rows))
+        ))
+
+
+async def measure(db, mode: str, batch_size: int):
+    select = f"SELECT id, guild_id, command FROM {TABLE};"
+    # Connect first, so the pool is not counted
+    await db.fetchone("SELECT 1;")
+    before = current_rss()
+    start = time.perf_counter()
+    count = 0
+    if mode == "fetchall":
+        rows = await db.fetchall(select)
+        count = len(rows)
+        del rows
+    else:
+        async for batch in db.stream(select, batch_size=batch_size,
+                                     batches=True):
+            count += len(batch)
+    elapsed = time.perf_counter() - start
+    print(f"{mode:>8}: {count} rows in {elapsed:.2f}s, "
+          f"peak RSS +{(peak_rss() - before) / 1024:.1f} MiB")
+
+
+async def main(args):
+    from commands.base import db
+    if args[0] == "fill":
+        await fill(db, int(args[1]))
+    elif args[0] == "drop":
+        await db.execute(f"DROP TABLE IF EXISTS {TABLE};")
+    else:
+        await measure(db, args[0], int(args[1]))
+    await db.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] in ("fill", "drop", "fetchall",
+                                              "stream"):
+        asyncio.get_event_loop().run_until_complete(main(sys.argv[1:]))
+        sys.exit()
+
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else ROWS
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else BATCH_SIZE
+    this = os.path.abspath(__file__)
+
+    print(f"Filling {TABLE} with {rows} rows")
+    subprocess.run([sys.executable, this, "fill", str(rows)], check=True)
+    try:
+        for mode in ("fetchall", "stream"):
+            subprocess.run([sys.executable, this, mode, str(batch_size)],
+                           check=True)
+    finally:
+        subprocess.run([sys.executable, this, "drop"], check=True)
@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+"""
+Run the bot as a cluster of processes, each connecting a range of shards, so
+that more than one CPU core can serve the bot's guilds.
+
+    TOKEN='your token here' python cluster.py
+
+The shard count recommended by Discord is split into one contiguous range per
+process, and each process runs main.py with its range. Processes that exit
+are restarted, waiting longer each time one fails again soon after starting.
+Every process reads the same config.json, and talks to the launcher over a
+local connection, used for cluster-wide commands such as quit and stats.
+The write-behind journal, snapshot and L2 cache files of each process are
+given a suffix with its cluster ID, so that processes never share them.
+"""
+
+import asyncio
+import json
+import os
+import secrets
+import signal
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing.connection import Connection, Listener
+from typing import Any, Dict, List, Optional, Tuple
+
+# Environment variables read by commands.base.ipc.ClusterLink, which is not
+# imported here as importing the commands package starts the bot
+CLUSTER_ID = "CLUSTER_ID"
+CLUSTER_ADDRESS = "CLUSTER_ADDRESS"
+CLUSTER_AUTHKEY = "CLUSTER_AUTHKEY"
+SHARD_IDS = "SHARD_IDS"
+SHARD_COUNT = "SHARD_COUNT"
+
+# Defaults for the "cluster" config
+CLUSTER_ADDRESS_DEFAULT = ["localhost", 6042]
+RESTART_DELAY = 5.0
+MAX_RESTART_DELAY = 300.0
+# Time a process must run for its next failure to restart it without delay
+STABLE_TIME = 60.0
+STOP_TIMEOUT = 30.0
+READY_TIMEOUT = 600.0
+STATS_TIMEOUT = 5.0
+
+
+def split_shards(shard_count: int, processes: int) -> List[List[int]]:
+    """
+    Split shard IDs into contiguous ranges of nearly equal size.
+
+    :param shard_count: Total number of shards
+    :param processes: Number of ranges, capped to the number of shards
+    :return: List of shard IDs of each range
+    """
+    processes = max(1, min(processes, shard_count))
+    return [list(range(i * shard_count // processes,
+                       (i + 1) * shard_count // processes))
+            for i in range(processes)]
+
+
+async def recommended_shards(token: str) -> int:
+    """
+    Ask Discord for the number of shards recommended for the bot.
+    """
+    from discord.http import HTTPClient
+    http = HTTPClient()
+    try:
+        await http.static_login(token, bot=True)
+        shards, _ = await http.get_bot_gateway()
+    finally:
+        await http.close()
+    return shards
+
+
+class Worker:
+    """
+    One process of the cluster, along with its connection to the launcher.
+    """
+    __slots__ = ["cluster_id", "shard_ids", "process", "conn", "ready",
+                 "started", "delay", "restart_at", "restarting", "_send_lock"]
+
+    def __init__(self, cluster_id: int, shard_ids: List[int],
+                 delay: float) -> None:
+        self.cluster_id = cluster_id
+        self.shard_ids = shard_ids
+        self.process: Optional[subprocess.Popen] = None
+        self.conn: Optional[Connection] = None
+        self.ready = threading.Event()
+        self.started = 0.0
+        # Time to wait before the next restart
+        self.delay = delay
+        # Time at which to restart the process after it exited
+        self.restart_at: Optional[float] = None
+        # Whether the process is being restarted on purpose
+        self.restarting = False
+        self._send_lock = threading.Lock()
+
+    def send(self, operation: str, request_id: Optional[int], *args: Any):
+        """
+        Send a message to the process, if connected.
+        """
+        conn = self.conn
+        if conn is None:
+            return
+        try:
+            with self._send_lock:
+                conn.send((operation, request_id, *args))
+        except (OSError, ValueError):
+            pass
+
+
+class Launcher:
+    """
+    Class used to start and supervise every process of the cluster, and to
+    answer the operations they send to it.
+    """
+
+    def __init__(self, config: Dict[str, Any], token: str) -> None:
+        options = config.get("cluster", {})
+        self.token = token
+        self.processes = options.get("processes") or os.cpu_count() or 1
+        self.shard_count: Optional[int] = options.get("shard_count")
+        address = options.get("address", CLUSTER_ADDRESS_DEFAULT)
+        # A host and port, or the path of a Unix socket
+        self.address = tuple(address) if isinstance(address, list) \
+            else address
+        self.restart_delay = options.get("restart_delay", RESTART_DELAY)
+        self.max_restart_delay = options.get("max_restart_delay",
+                                             MAX_RESTART_DELAY)
+        self.stats_timeout = options.get("stats_timeout", STATS_TIMEOUT)
+        self.authkey = secrets.token_bytes(32)
+        self.workers: List[Worker] = []
+        self.stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._restart_lock = threading.Lock()
+        self._next_request = 0
+        # Replies to requests sent by the launcher, by request ID
+        self._replies: Dict[int, Tuple[threading.Event, Dict[int, Any]]] = {}
+
+    def run(self):
+        """
+        Start every process and supervise them until the cluster is stopped.
+        """
+        if not self.shard_count:
+            self.shard_count = asyncio.get_event_loop().run_until_complete(
+                recommended_shards(self.token))
+        ranges = split_shards(self.shard_count, self.processes)
+        self.workers = [Worker(i, shard_ids, self.restart_delay)
+                        for i, shard_ids in enumerate(ranges)]
+        print(f"Starting {len(self.workers)} processes for "
+              f"{self.shard_count} shards")
+
+        listener = Listener(self.address, authkey=self.authkey)
+        threading.Thread(target=self._accept, args=(listener,),
+                         name="cluster-accept", daemon=True).start()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: self.stopping.set())
+
+        try:
+            for worker in self.workers:
+                self.spawn(worker)
+            while not self.stopping.wait(1):
+                self.supervise()
+        finally:
+            self.stop()
+            listener.close()
+
+    def spawn(self, worker: Worker):
+        """
+        Start the process of a worker.
+        """
+        env = dict(os.environ)
+        env[CLUSTER_ID] = str(worker.cluster_id)
+        env[CLUSTER_ADDRESS] = json.dumps(self.address)
+        env[CLUSTER_AUTHKEY] = self.authkey.hex()
+        env[SHARD_IDS] = ",".join(map(str, worker.shard_ids))
+        env[SHARD_COUNT] = str(self.shard_count)
+        worker.ready.clear()
+        worker.restart_at = None
+        worker.started = time.monotonic()
+        worker.process = subprocess.Popen(
+            [sys.executable, "main.py"], env=env,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        print(f"Started cluster {worker.cluster_id} (shards "
+              f"{worker.shard_ids[0]}-{worker.shard_ids[-1]}), "
+              f"pid {worker.process.pid}")
+
+    def supervise(self):
+        """
+        Restart every process that has exited, once its delay has passed.
+        """
+        now = time.monotonic()
+        for worker in self.workers:
+            if worker.restarting or worker.process is None:
+                continue
+            if worker.restart_at is None:
+                code = worker.process.poll()
+                if code is None:
+                    continue
+                if now - worker.started >= STABLE_TIME:
+                    worker.delay = self.restart_delay
+                worker.restart_at = now + worker.delay
+                worker.conn = None
+                print(f"Cluster {worker.cluster_id} exited with code {code}, "
+                      f"restarting in {worker.delay:.0f}s")
+                # Back off while the process keeps failing
+                worker.delay = min(worker.delay * 2, self.max_restart_delay)
+            elif now >= worker.restart_at:
+                self.spawn(worker)
+
+    def stop(self):
+        """
+        Ask every process to quit, killing those which do not in time.
+        """
+        self.stopping.set()
+        for worker in self.workers:
+            if worker.conn is not None:
+                worker.send("quit", None)
+            elif worker.process is not None and worker.process.poll() is None:
+                # Still starting, so it cannot be asked yet
+                worker.process.terminate()
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for worker in self.workers:
+            self._wait(worker, deadline - time.monotonic())
+
+    def rolling_restart(self):
+        """
+        Restart every process in turn, waiting for each to be ready before
+        restarting the next, so that at most one range of shards is offline.
+        Only one rolling restart runs at a time.
+        """
+        if not self._restart_lock.acquire(blocking=False):
+            return
+        try:
+            self._rolling_restart()
+        finally:
+            self._restart_lock.release()
+
+    def _rolling_restart(self):
+        for worker in self.workers:
+            if self.stopping.is_set():
+                return
+            worker.restarting = True
+            try:
+                worker.send("quit", None)
+                self._wait(worker, STOP_TIMEOUT)
+                worker.conn = None
+                self.spawn(worker)
+                if not worker.ready.wait(READY_TIMEOUT):
+                    print(f"Cluster {worker.cluster_id} did not become "
+                          f"ready, continuing")
+            finally:
+                worker.restarting = False
+
+    def broadcast(self, operation: str, *args: Any) -> Dict[int, Any]:
+        """
+        Send an operation to every connected process and collect their
+        replies, waiting at most `stats_timeout' seconds.
+
+        :return: Dict of the reply of each cluster which replied in time
+        """
+        with self._lock:
+            self._next_request += 1
+            request_id = self._next_request
+        event = threading.Event()
+        replies: Dict[int, Any] = {}
+        connected = [worker for worker in self.workers
+                     if worker.conn is not None]
+        self._replies[request_id] = (event, replies)
+        try:
+            for worker in connected:
+                worker.send(operation, request_id, *args)
+            deadline = time.monotonic() + self.stats_timeout
+            while len(replies) < len(connected):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not event.wait(remaining):
+                    break
+                event.clear()
+            return dict(replies)
+        finally:
+            del self._replies[request_id]
+
+    def _wait(self, worker: Worker, timeout: float):
+        if worker.process is None:
+            return
+        try:
+            worker.process.wait(max(timeout, 0))
+        except subprocess.TimeoutExpired:
+            print(f"Cluster {worker.cluster_id} did not quit, killing it")
+            worker.process.kill()
+            worker.process.wait()
+
+    def _accept(self, listener: Listener):
+        while not self.stopping.is_set():
+            try:
+                conn = listener.accept()
+            except OSError:
+                # Closed, or a process failed to authenticate
+                if self.stopping.is_set():
+                    return
+                continue
+            threading.Thread(target=self._serve, args=(conn,),
+                             name="cluster-serve", daemon=True).start()
+
+    def _serve(self, conn: Connection):
+        worker = None
+        while True:
+            try:
+                operation, request_id, *args = conn.recv()
+            except (EOFError, OSError):
+                break
+            if operation == "hello":
+                worker = self.workers[args[0]]
+                worker.conn = conn
+            elif worker is None:
+                break
+            else:
+                threading.Thread(
+                    target=self._handle,
+                    args=(worker, operation, request_id, args),
+                    daemon=True).start()
+        conn.close()
+        if worker is not None and worker.conn is conn:
+            worker.conn = None
+
+    def _handle(self, worker: Worker, operation: str,
+                request_id: Optional[int], args: List[Any]):
+        result = None
+        if operation == "reply":
+            entry = self._replies.get(request_id)
+            if entry is not None:
+                entry[1][worker.cluster_id] = args[0]
+                entry[0].set()
+            return
+        elif operation == "ready":
+            worker.ready.set()
+        elif operation == "quit":
+            print(f"Cluster {worker.cluster_id} asked the cluster to quit")
+            self.stopping.set()
+        elif operation == "stats":
+            result = self.broadcast("stats")
+        elif operation == "reload":
+            if self._restart_lock.locked():
+                result = 0
+            else:
+                print(f"Cluster {worker.cluster_id} asked for a rolling "
+                      f"restart")
+                threading.Thread(target=self.rolling_restart,
+                                 name="cluster-restart", daemon=True).start()
+                result = len(self.workers)
+        else:
+            print(f"Unknown cluster operation \"{operation}\"")
+        if request_id is not None:
+            worker.send("reply", request_id, result)
+
+
+def main():
+    token = os.environ.get("TOKEN")
+    if token in [None, ""]:
+        raise RuntimeError("No discord token set in environment")
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    with open("config.json") as f:
+        config = json.load(f)
+    Launcher(config, token).run()
+
+
+if __name__ == "__main__":
+    main()
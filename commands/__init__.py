@@ -1,2 +1,5 @@
 from . import base
 from . import extra
+
+# this names every command registered above, so it needs to go last
+base.language.build_alias_index()
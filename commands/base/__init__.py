@@ -1,8 +1,27 @@
 # -*- coding: utf-8 -*-
-from .database import Database as db
+from .database import Database as db, DatabaseUnavailable
 from .command import Command, CommandError, authorise
 from .context import Context
 from .client import bot, ratelimit
+from .writebehind import WriteBehind
+from .invalidation import Invalidation
+from .snapshot import Snapshot
+from .tiered import L2Store
+from .shared import SharedSettings
+from .ipc import ClusterLink
+db.configure(bot.config)
+WriteBehind.configure(bot.config)
+Invalidation.configure(bot.config)
+Snapshot.configure(bot.config)
+L2Store.configure(bot.config)
+SharedSettings.configure(bot.config)
+if ClusterLink.cluster_id:
+    # One builder is enough for every process of a cluster
+    SharedSettings.builder = False
+# Every process of a cluster keeps its own journal and caches
+WriteBehind.journal = ClusterLink.local_path(WriteBehind.journal)
+Snapshot.path = ClusterLink.local_path(Snapshot.path)
+L2Store.path = ClusterLink.local_path(L2Store.path)
 from . import language
 from .utils import get_next_arg
 from . import converters
@@ -12,8 +31,9 @@ from .alias import get_alias, toggle_alias
 from .botban import (get_guild_botbans, get_user_botbans, is_botbanned,
                      toggle_botban)
 from . import toggle
-from .toggle import (get_guild_toggles, is_toggled, toggle_elements,
-                     enable_elements, disable_elements, CommandToggle)
+from .toggle import (get_guild_toggles, get_toggle_mask, is_toggled,
+                     get_disabled_ancestor, toggle_elements, enable_elements,
+                     disable_elements, CommandToggle)
 from . import authority
 
 # this actually uses the framework, so it needs to go last
@@ -2,15 +2,61 @@
 
 from __future__ import annotations
 
-import cachetools
-from typing import List, Optional
+import json
+from typing import Dict, List, Optional
 
 from . import db
+from .database import DatabaseUnavailable
 from .client import bot
+from .writebehind import WriteBehind
+from .invalidation import Invalidation
+from .snapshot import Snapshot
+from .shared import SharedSettings, grouped
+from .tiered import TieredCache
 
 
 # Internal cache of guild invokers, to reduce unnecessary database queries
-_invoker_cache = cachetools.LFUCache(100)
+_invoker_cache = TieredCache(100, "invokers")
+
+_select_invokers = db.query("invokers.select", """
+    SELECT callstr FROM invokers
+    WHERE guild_id = %s;
+""")
+_delete_default_invoker = db.query("invokers.delete_default", """
+    DELETE FROM invokers
+    WHERE guild_id = %s
+      AND callstr IS NULL;
+""")
+_insert_invoker = db.query("invokers.insert", """
+    INSERT INTO invokers
+    VALUES (%s, %s);
+""")
+_insert_default_invoker = db.query("invokers.insert_default", """
+    INSERT INTO invokers
+    VALUES (%s, NULL);
+""")
+_delete_invoker = db.query("invokers.delete", """
+    DELETE FROM invokers
+    WHERE guild_id = %s
+      AND callstr = %s;
+""")
+_select_all_invokers = db.query("invokers.select_all", """
+    SELECT guild_id, callstr FROM invokers
+    ORDER BY guild_id;
+""")
+
+
+def _build_invokers(callstrs: List[Optional[str]]) -> List[str]:
+    """
+    Convert the rows of a guild's invokers into the list of all accepted
+    invokers, where a NULL row removes the default invoker.
+    """
+    ret = bot.ping_invokers + callstrs
+    if None in ret:
+        ret.remove(None)
+    else:
+        ret = [bot.invoker] + ret
+    return ret
 
 
 async def get_alias(guild_id: int) -> List[str]:
@@ -19,22 +65,24 @@ async def get_alias(guild_id: int) -> List[str]:
 
     :param guild_id: ID of guild to search
     :return: List of all accepted invokers, including the default invoker and
-    ping invokers
+    ping invokers. While the database is unavailable, the last known invokers
+    are returned, or only the default ones if the guild is not known.
     """
-    if guild_id not in _invoker_cache:
-        ret = await db.fetchall("""
-            SELECT callstr FROM invokers
-            WHERE guild_id = %s;
-        """, guild_id)
-        ret = bot.ping_invokers + [row[0] for row in ret]
-
-        if None in ret:
-            ret.remove(None)
-        else:
-            ret = [bot.invoker] + ret
-        _invoker_cache[guild_id] = ret
+    try:
+        return await _invoker_cache.lookup(guild_id)
+    except KeyError:
+        pass
 
-    return _invoker_cache[guild_id]
+    await WriteBehind.barrier("invokers")
+    Invalidation.read_fresh("invokers", guild_id)
+    try:
+        ret = await db.fetchall(_select_invokers, guild_id)
+    except DatabaseUnavailable:
+        return _invoker_cache.get_stale(
+            guild_id, bot.ping_invokers + [bot.invoker])
+    ret = _build_invokers([row[0] for row in ret])
+    _invoker_cache[guild_id] = ret
+    return ret
 
 
 async def toggle_alias(guild_id: int, invoker: Optional[str]) -> bool:
@@ -45,40 +93,70 @@ async def toggle_alias(guild_id: int, invoker: Optional[str]) -> bool:
     :param invoker: Invoker to toggle
     :return: Boolean of whether this invoker was enabled in the guild
     """
-    guild_invokers = await get_alias(guild_id)
-    added = invoker not in guild_invokers
-    if added:
-        _invoker_cache[guild_id].append(invoker)
-        if invoker == bot.invoker:
-            # need to remove null from db
-            await db.execute("""
-                DELETE FROM invokers
-                WHERE guild_id = %s
-                  AND callstr IS NULL;
-            """, guild_id)
-        else:
-            await db.execute("""
-                INSERT INTO invokers
-                VALUES (%s, %s);
-            """, guild_id, invoker)
-    else:
-        if invoker == bot.invoker:
-            # we need to insert null into the db
-            # to signal the default invoker is removed
-            await db.execute("""
-                INSERT INTO invokers
-                VALUES (%s, NULL);
-            """, guild_id)
+    # The read and write share one connection and transaction, unless the
+    # write is only queued
+    async with WriteBehind.transaction():
+        # The cached list may be held by earlier callers, so change a copy
+        guild_invokers = list(await get_alias(guild_id))
+        added = invoker not in guild_invokers
+        key = ("invokers", guild_id, invoker)
+        if added:
+            guild_invokers.append(invoker)
+            if invoker == bot.invoker:
+                # need to remove null from db
+                await WriteBehind.toggle(key, _delete_default_invoker,
+                                         guild_id)
+            else:
+                await WriteBehind.toggle(key, _insert_invoker, guild_id,
+                                         invoker)
         else:
-            await db.execute("""
-                DELETE FROM invokers
-                WHERE guild_id = %s
-                  AND callstr = %s;
-            """, guild_id, invoker)
-    del _invoker_cache[guild_id]
+            guild_invokers.remove(invoker)
+            if invoker == bot.invoker:
+                # we need to insert null into the db
+                # to signal the default invoker is removed
+                await WriteBehind.toggle(key, _insert_default_invoker,
+                                         guild_id)
+            else:
+                await WriteBehind.toggle(key, _delete_invoker, guild_id,
+                                         invoker)
+        # Only cached once written or queued, as the write may not be flushed
+        # yet
+        _invoker_cache[guild_id] = guild_invokers
+    await Invalidation.publish("invokers", guild_id)
+    await Invalidation.invalidate_tags(f"invokers:{guild_id}")
     return added
 
 
+Invalidation.subscribe("invokers", _invoker_cache.discard)
+
+
+def _restore_invokers(invokers: Dict[int, List[str]]) -> List[int]:
+    _invoker_cache.update(invokers)
+    return list(invokers)
+
+
+async def _revalidate_invokers(guild_ids: List[int]):
+    for guild_id in guild_ids:
+        _invoker_cache.discard(guild_id)
+    for guild_id in guild_ids:
+        await get_alias(guild_id)
+
+
+def _load_invokers(guild_id: int, encoded: Optional[memoryview]
+                   ) -> List[str]:
+    return _build_invokers([] if encoded is None else
+                           json.loads(bytes(encoded)))
+
+
+_invoker_cache.load = _load_invokers
+SharedSettings.register("invokers", lambda: grouped(
+    _select_all_invokers, lambda callstrs: json.dumps(callstrs).encode()))
+
+
+Snapshot.register("invokers", lambda: dict(_invoker_cache), _restore_invokers,
+                  _revalidate_invokers)
+
+
 @bot.on_ready
 async def set_ping_invokers():
     bot.ping_invokers = [f"<@{bot.user.id}>", f"<@!{bot.user.id}>"]
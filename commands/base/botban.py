@@ -2,15 +2,284 @@
 
 from __future__ import annotations
 
-import cachetools
-from typing import List, Optional
+import asyncio
+from array import array
+from bisect import bisect_left, insort
+from typing import Dict, List, Optional, Set
 
 from . import db
+from .database import DatabaseUnavailable
 from .client import bot
+from .writebehind import WriteBehind
+from .invalidation import Invalidation
+from .snapshot import Snapshot
+from .shared import SharedSettings, grouped, _missing
 
 
-# Internal cache of botbanned users, to reduce unnecessary database queries
-_botban_cache = cachetools.LFUCache(100)
+_select_all_botbans = db.query("botbans.select_all", """
+    SELECT guild_id, user_id FROM botbans
+    ORDER BY guild_id, user_id
+""")
+_select_all_botbans_by_user = db.query("botbans.select_all_by_user", """
+    SELECT user_id, guild_id FROM botbans
+    ORDER BY user_id, guild_id
+""")
+_select_guild_botbans = db.query("botbans.select_guild", """
+    SELECT user_id FROM botbans
+    WHERE guild_id = %s
+    ORDER BY user_id
+""")
+_delete_botban = db.query("botbans.delete", """
+    DELETE FROM botbans
+    WHERE user_id = %s AND guild_id = %s
+""")
+_insert_botban = db.query("botbans.insert", """
+    INSERT INTO botbans
+    (user_id, guild_id)
+    VALUES (%s, %s)
+""")
+
+
+def _contains(ids: array, id_: int) -> bool:
+    i = bisect_left(ids, id_)
+    return i < len(ids) and ids[i] == id_
+
+
+def _discard(index: Dict[int, array], key: int, id_: int):
+    ids = index.get(key)
+    if ids is None:
+        return
+    i = bisect_left(ids, id_)
+    if i < len(ids) and ids[i] == id_:
+        ids.pop(i)
+        if not ids:
+            del index[key]
+
+
+class BotbanIndex:
+    """
+    Class used to hold every botban in memory, so that the bot_banned global
+    auth never needs to query the database.
+
+    Botbans are indexed both by guild and by user, each as a sorted array of
+    IDs searched by bisection. The whole table is loaded in one query, either
+    when the bot is ready or on the first lookup, and is then kept up to date
+    by toggle_botban. Guilds changed by other processes are marked stale and
+    reloaded on their next lookup.
+
+    While the database is unavailable, lookups use whatever botbans are
+    already in memory, so nobody is botbanned if the index never loaded.
+
+    When SharedSettings has mapped a file with the botbans section, the
+    index only holds the guilds changed since that file was built, listed in
+    `local', and every other guild is searched in the file instead.
+    """
+    __slots__ = []
+    guilds: Dict[int, array] = {}
+    users: Dict[int, array] = {}
+    stale: Set[int] = set()
+    # Guilds held in the index, or None if it holds every guild
+    local: Optional[Set[int]] = None
+    loaded = False
+    _lock: Optional[asyncio.Lock] = None
+
+    @classmethod
+    async def load(cls):
+        """
+        Load every botban from the database, if they have not been loaded
+        yet. This is called automatically by the first lookup.
+        """
+        if cls._lock is None:
+            cls._lock = asyncio.Lock()
+
+        async with cls._lock:
+            if cls.loaded:
+                return
+            if SharedSettings.is_active("botbans"):
+                cls.guilds = {}
+                cls.users = {}
+                cls.local = set()
+                cls.stale.clear()
+                cls.loaded = True
+                return
+            await WriteBehind.barrier("botbans")
+            rows = await db.fetchall(_select_all_botbans)
+
+            guilds = {}
+            users = {}
+            for guild_id, user_id in rows:
+                try:
+                    guilds[guild_id].append(user_id)
+                except KeyError:
+                    guilds[guild_id] = array("Q", [user_id])
+                # Rows are sorted by guild, so each user's guilds are sorted
+                try:
+                    users[user_id].append(guild_id)
+                except KeyError:
+                    users[user_id] = array("Q", [guild_id])
+
+            cls.guilds = guilds
+            cls.users = users
+            cls.local = None
+            cls.stale.clear()
+            cls.loaded = True
+
+    @classmethod
+    async def refresh(cls, guild_id: Optional[int] = None):
+        """
+        Make sure the index is loaded, and reload stale guilds from the
+        database.
+
+        :param guild_id: ID of the only guild to reload if stale, or None to
+        reload every stale guild
+        """
+        try:
+            if not cls.loaded:
+                await cls.load()
+            if SharedSettings.is_active("botbans"):
+                await cls._refresh_shared(guild_id)
+                return
+            if not cls.stale:
+                return
+            if guild_id is None:
+                for stale_id in list(cls.stale):
+                    await cls._reload_guild(stale_id)
+            elif guild_id in cls.stale:
+                await cls._reload_guild(guild_id)
+        except DatabaseUnavailable:
+            # Fail open, keeping stale guilds to be reloaded later
+            pass
+
+    @classmethod
+    async def _refresh_shared(cls, guild_id: Optional[int]):
+        if cls.local is None:
+            # The file was mapped after every guild was loaded, so only keep
+            # the guilds it may not have caught up with
+            cls.local = set(SharedSettings.dirty.get("botbans", ()))
+            for drop_id in [drop_id for drop_id in cls.guilds
+                            if drop_id not in cls.local]:
+                cls._drop_guild(drop_id)
+
+        if guild_id is None:
+            # Every guild must be current to list a user's botbans
+            for dirty_id in list(SharedSettings.dirty.get("botbans", ())):
+                if dirty_id not in cls.local or dirty_id in cls.stale:
+                    await cls._reload_guild(dirty_id)
+        elif not SharedSettings.is_dirty("botbans", guild_id):
+            if guild_id in cls.local:
+                # The file has caught up with this guild
+                cls._drop_guild(guild_id)
+            cls.stale.discard(guild_id)
+        elif guild_id not in cls.local or guild_id in cls.stale:
+            await cls._reload_guild(guild_id)
+
+    @classmethod
+    async def hold(cls, guild_id: int):
+        """
+        Make sure the index holds a guild, rather than the file mapped by
+        SharedSettings, before changing it.
+        """
+        await cls.refresh(guild_id)
+        if cls.local is not None and guild_id not in cls.local:
+            SharedSettings.mark_dirty("botbans", guild_id)
+            await cls._reload_guild(guild_id)
+
+    @classmethod
+    async def _reload_guild(cls, guild_id: int):
+        await WriteBehind.barrier("botbans")
+        Invalidation.read_fresh("botbans", guild_id)
+        rows = await db.fetchall(_select_guild_botbans, guild_id)
+        cls.stale.discard(guild_id)
+
+        cls._drop_guild(guild_id)
+        if cls.local is not None:
+            cls.local.add(guild_id)
+        for (user_id,) in rows:
+            cls.add(user_id, guild_id)
+
+    @classmethod
+    def _drop_guild(cls, guild_id: int):
+        for user_id in cls.guilds.pop(guild_id, ()):
+            _discard(cls.users, user_id, guild_id)
+        if cls.local is not None:
+            cls.local.discard(guild_id)
+
+    @classmethod
+    def guild_users(cls, guild_id: int) -> List[int]:
+        """
+        Return the IDs of every user botbanned in this guild. The index must
+        have been refreshed beforehand.
+        """
+        if cls.local is None or guild_id in cls.local:
+            return list(cls.guilds.get(guild_id, ()))
+        encoded = SharedSettings.lookup("botbans", guild_id)
+        if encoded is None or encoded is _missing:
+            return []
+        with encoded, encoded.cast("Q") as user_ids:
+            return user_ids.tolist()
+
+    @classmethod
+    def user_guilds(cls, user_id: int) -> List[int]:
+        """
+        Return the IDs of every guild this user is botbanned in. The index
+        must have been refreshed for every guild beforehand.
+        """
+        if cls.local is None:
+            return list(cls.users.get(user_id, ()))
+        encoded = SharedSettings.lookup("botban_users", user_id)
+        guild_ids = set()
+        if encoded is not None and encoded is not _missing:
+            with encoded, encoded.cast("Q") as shared_ids:
+                guild_ids.update(shared_ids.tolist())
+        # Guilds held in the index replace their copy in the file
+        guild_ids -= cls.local
+        guild_ids.update(cls.users.get(user_id, ()))
+        return sorted(guild_ids)
+
+    @classmethod
+    def contains(cls, user_id: int, guild_id: int) -> bool:
+        """
+        Return if this user is botbanned in this guild. The index must have
+        been refreshed beforehand.
+        """
+        if cls.local is None or guild_id in cls.local:
+            users = cls.guilds.get(guild_id)
+            return users is not None and _contains(users, user_id)
+        encoded = SharedSettings.lookup("botbans", guild_id)
+        if encoded is None or encoded is _missing:
+            return False
+        # Search the file in place
+        with encoded, encoded.cast("Q") as user_ids:
+            return _contains(user_ids, user_id)
+
+    @classmethod
+    def add(cls, user_id: int, guild_id: int):
+        """
+        Add a botban to the index.
+        """
+        for index, key, id_ in ((cls.guilds, guild_id, user_id),
+                                (cls.users, user_id, guild_id)):
+            ids = index.get(key)
+            if ids is None:
+                index[key] = array("Q", [id_])
+            elif not _contains(ids, id_):
+                insort(ids, id_)
+
+    @classmethod
+    def remove(cls, user_id: int, guild_id: int):
+        """
+        Remove a botban from the index.
+        """
+        _discard(cls.guilds, guild_id, user_id)
+        _discard(cls.users, user_id, guild_id)
+
+    @classmethod
+    def invalidate(cls, guild_id: int):
+        """
+        Mark a guild as changed by another process, to be reloaded on its
+        next lookup.
+        """
+        cls.stale.add(guild_id)
 
 
 async def is_botbanned(user_id: int, guild_id: Optional[int]) -> bool:
@@ -24,7 +293,8 @@ async def is_botbanned(user_id: int, guild_id: Optional[int]) -> bool:
     if guild_id is None:
         return False
 
-    return user_id in await get_guild_botbans(guild_id)
+    await BotbanIndex.refresh(guild_id)
+    return BotbanIndex.contains(user_id, guild_id)
 
 
 async def get_user_botbans(user_id: int) -> List[int]:
@@ -34,12 +304,8 @@ async def get_user_botbans(user_id: int) -> List[int]:
     :param user_id: User ID to search for
     :return: List of guild IDs that have botbanned this user
     """
-    ret = await db.fetchall("""
-        SELECT guild_id FROM botbans
-        WHERE user_id = %s
-    """, user_id)
-
-    return [row[0] for row in ret]
+    await BotbanIndex.refresh()
+    return BotbanIndex.user_guilds(user_id)
 
 
 async def get_guild_botbans(guild_id: int) -> List[int]:
@@ -49,19 +315,8 @@ async def get_guild_botbans(guild_id: int) -> List[int]:
     :param guild_id: ID of guild to search in
     :return: List of IDs of all botbanned users in this guild
     """
-    try:
-        return _botban_cache[guild_id]
-    except KeyError:
-        ret = await db.fetchall("""
-            SELECT user_id FROM botbans
-            WHERE guild_id = %s 
-        """, guild_id)
-
-        ret = [row[0] for row in ret]
-
-        _botban_cache[guild_id] = ret
-
-        return ret
+    await BotbanIndex.refresh(guild_id)
+    return BotbanIndex.guild_users(guild_id)
 
 
 async def toggle_botban(user_id: int, guild_id: int) -> bool:
@@ -72,31 +327,68 @@ async def toggle_botban(user_id: int, guild_id: int) -> bool:
     :param guild_id: ID of guild toggle botban in
     :return: Boolean of whether this user is now botbanned
     """
-    botbanned = False
-    # Check if user is botbanned
-    if await is_botbanned(user_id, guild_id):
-        # Remove from botban
-        await db.execute("""
-            DELETE FROM botbans
-            WHERE user_id = %s AND guild_id = %s
-        """, user_id, guild_id)
-    else:
-        await db.execute("""
-            INSERT INTO botbans
-            (user_id, guild_id)
-            VALUES (%s, %s)
-        """, user_id, guild_id)
-        botbanned = True
-
-    # Invalidate the guild cache
-    try:
-        del _botban_cache[guild_id]
-    except KeyError:
-        pass
+    # The index is only updated once the write is made or queued, as it may
+    # not be flushed yet
+    key = ("botbans", guild_id, user_id)
+    # The read and write share one connection and transaction, unless the
+    # write is only queued
+    async with WriteBehind.transaction():
+        await BotbanIndex.hold(guild_id)
+        botbanned = not await is_botbanned(user_id, guild_id)
+        if botbanned:
+            await WriteBehind.toggle(key, _insert_botban, user_id, guild_id)
+            BotbanIndex.add(user_id, guild_id)
+        else:
+            # Remove from botban
+            await WriteBehind.toggle(key, _delete_botban, user_id, guild_id)
+            BotbanIndex.remove(user_id, guild_id)
+    await Invalidation.publish("botbans", guild_id)
+    await Invalidation.invalidate_tags(f"botbans:{guild_id}")
 
     return botbanned
 
 
+Invalidation.subscribe("botbans", BotbanIndex.invalidate)
+
+SharedSettings.register("botbans", lambda: grouped(
+    _select_all_botbans, lambda user_ids: array("Q", user_ids).tobytes()))
+SharedSettings.register("botban_users", lambda: grouped(
+    _select_all_botbans_by_user,
+    lambda guild_ids: array("Q", guild_ids).tobytes()))
+
+
+def _dump_botbans() -> Optional[Dict[int, array]]:
+    # Only a complete index can be restored
+    if not BotbanIndex.loaded or BotbanIndex.local is not None:
+        return None
+    return BotbanIndex.guilds
+
+
+def _restore_botbans(guilds: Optional[Dict[int, array]]) -> List[None]:
+    if guilds is None:
+        return []
+    for guild_id, user_ids in guilds.items():
+        for user_id in user_ids:
+            BotbanIndex.add(user_id, guild_id)
+    BotbanIndex.loaded = True
+    # The whole index is revalidated at once
+    return [None]
+
+
+async def _revalidate_botbans(_):
+    BotbanIndex.loaded = False
+    await BotbanIndex.load()
+
+
+Snapshot.register("botbans", _dump_botbans, _restore_botbans,
+                  _revalidate_botbans)
+
+
+@bot.on_ready
+async def load_botbans():
+    await BotbanIndex.load()
+
+
 @bot.global_auth
 async def bot_banned(ctx):
     return not await is_botbanned(ctx.author_id, ctx.guild_id)
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import annotations
+
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, Optional, Set
+
+import cachetools
+
+_missing = object()
+
+# Number of invalidated tags whose epochs are kept by a TaggedTTLCache
+TAG_EPOCH_LIMIT = 10000
+
+
+class StaleLFUCache(cachetools.LFUCache):
+    """
+    LFU cache which keeps the entries it evicts, so they can still be served
+    while the database is unavailable.
+
+    Evicted entries are moved to a stale store holding at most `stale_size'
+    entries, dropping the least recently evicted first. Entries removed on
+    purpose, with del, pop or clear, are not kept.
+    """
+
+    def __init__(self, maxsize: int, stale_size: Optional[int] = None) -> None:
+        """
+        Initialise the cache.
+
+        :param maxsize: Maximum number of live entries
+        :param stale_size: Maximum number of stale entries, defaulting to
+        maxsize
+        """
+        super().__init__(maxsize)
+        self.stale_size = maxsize if stale_size is None else stale_size
+        self.stale: OrderedDict = OrderedDict()
+        self.stale_hits = 0
+
+    def __setitem__(self, key: Hashable, value: Any) -> None:
+        super().__setitem__(key, value)
+        self.stale.pop(key, None)
+
+    def popitem(self):
+        key, value = super().popitem()
+        if self.stale_size > 0:
+            self.stale[key] = value
+            self.stale.move_to_end(key)
+            while len(self.stale) > self.stale_size:
+                self.stale.popitem(last=False)
+        return key, value
+
+    def clear(self):
+        # MutableMapping.clear() would evict every entry with popitem()
+        for key in list(self):
+            del self[key]
+
+    def get_stale(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Retrieve an entry, whether live or evicted.
+
+        :param key: Key of the entry
+        :param default: Value returned if the key is in neither store
+        :return: Value of the entry
+        """
+        value = self.get(key, _missing)
+        if value is _missing:
+            value = self.stale.get(key, _missing)
+            if value is _missing:
+                return default
+            self.stale_hits += 1
+        return value
+
+    def has_stale(self, key: Hashable) -> bool:
+        """
+        Return if the key is either live or evicted.
+        """
+        return key in self or key in self.stale
+
+    def clear_stale(self):
+        """
+        Drop every evicted entry.
+        """
+        self.stale.clear()
+
+
+class TaggedTTLCache:
+    """
+    LRU cache in which every entry has its own time to live and a set of
+    tags, so that every entry with a given tag can be evicted at once.
+
+    Values read before one of their tags was invalidated may already be out
+    of date, so readers take the epoch before reading and pass it to set(),
+    which drops the value if any of its tags were invalidated since. Only
+    the epochs of the last `TAG_EPOCH_LIMIT' invalidated tags are kept, and
+    values read before the oldest of those are always dropped.
+    """
+    __slots__ = ["maxsize", "_data", "_tags", "_tag_epochs", "_floor",
+                 "epoch"]
+
+    def __init__(self, maxsize: int) -> None:
+        """
+        Initialise the cache.
+
+        :param maxsize: Maximum number of entries
+        """
+        self.maxsize = maxsize
+        # Key to expiry time, value and tags, from least to most recently used
+        self._data: OrderedDict = OrderedDict()
+        self._tags: Dict[str, Set[Hashable]] = {}
+        # Number of invalidations so far, and the epoch at which each tag was
+        # last invalidated, from least to most recent
+        self.epoch = 0
+        self._tag_epochs: OrderedDict = OrderedDict()
+        # Epoch before which values may have missed an invalidation
+        self._floor = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Retrieve an entry which has not expired.
+
+        :param key: Key of the entry
+        :param default: Value returned if the entry is missing or expired
+        :return: Value of the entry
+        """
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        if entry[0] <= time.monotonic():
+            self._remove(key)
+            return default
+        self._data.move_to_end(key)
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any, ttl: float,
+            tags: Iterable[str] = (), since: Optional[int] = None):
+        """
+        Add an entry, evicting the least recently used entries if the cache
+        is full.
+
+        :param key: Key of the entry
+        :param value: Value of the entry
+        :param ttl: Time in seconds until the entry expires
+        :param tags: Tags of the entry
+        :param since: Epoch taken before the value was read, so that it is
+        not added if any of its tags were invalidated since, or None to
+        always add it
+        """
+        if self.maxsize <= 0:
+            return
+        tags = frozenset(tags)
+        if since is not None and (since < self._floor or any(
+                self._tag_epochs.get(tag, 0) > since for tag in tags)):
+            return
+        self._remove(key)
+        while len(self._data) >= self.maxsize:
+            self._remove(next(iter(self._data)))
+        self._data[key] = (time.monotonic() + ttl, value, tags)
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+
+    def invalidate_tags(self, *tags: str) -> int:
+        """
+        Remove every entry with any of the given tags.
+
+        :param tags: Tags to invalidate
+        :return: Number of entries removed
+        """
+        self.epoch += 1
+        removed = 0
+        for tag in tags:
+            self._tag_epochs[tag] = self.epoch
+            self._tag_epochs.move_to_end(tag)
+            for key in self._tags.pop(tag, ()):
+                if key in self._data:
+                    self._remove(key)
+                    removed += 1
+        while len(self._tag_epochs) > TAG_EPOCH_LIMIT:
+            _, self._floor = self._tag_epochs.popitem(last=False)
+        return removed
+
+    def clear(self):
+        """
+        Remove every entry.
+        """
+        self.epoch += 1
+        self._floor = self.epoch
+        self._tag_epochs.clear()
+        self._data.clear()
+        self._tags.clear()
+
+    def _remove(self, key: Hashable):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
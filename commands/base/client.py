@@ -4,6 +4,7 @@ from __future__ import annotations
 
 import asyncio
 import json
+import os
 import re
 import time
 import warnings
@@ -231,6 +232,8 @@ class Bot:
         content = message.content
         if not content: return
         if message.author.bot: return
+        # Reads may go to replicas until this invocation writes
+        db.start_session()
 
         if isinstance(message.channel, discord.abc.PrivateChannel):
             invoker = self.invoker
@@ -245,6 +248,13 @@ class Bot:
                 return
         content = content[len(invoker):].strip()
 
+        if db.bind_invocations:
+            async with db.connection(lazy=True):
+                await self._invoke(message, content, invoker)
+        else:
+            await self._invoke(message, content, invoker)
+
+    async def _invoke(self, message: Message, content: str, invoker: str):
         ctx = await Context.make(self, message, self.root_command, content,
                                  invoker)
 
@@ -1526,10 +1536,14 @@ class Bot:
 
 from .command import Command
 from .context import Context
+from .database import Database as db
 from .toggle import CommandToggle
+from .ipc import ClusterLink
 
+# Processes started by cluster.py only connect their own shards
+ClusterLink.configure(os.environ)
 with open("config.json") as f:
-    bot = Bot(json.load(f))
+    bot = Bot(json.load(f), **ClusterLink.shard_options())
 
 
 # noinspection PyProtectedMember
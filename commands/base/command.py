@@ -38,8 +38,15 @@ class Command:
     function it was constructed with.
     """
     __slots__ = ["id", "_parent", "path", "_function", "_error_responses",
-                 "qualified_id", "subcommands", "auth", "_auth_timers",
-                 "_converters", "__weakref__"]
+                 "qualified_id", "index", "ancestor_mask", "subcommands",
+                 "auth", "_auth_timers", "_converters", "__weakref__"]
+
+    # Incremented whenever a command is added to the tree
+    generation = 0
+    # Qualified IDs of every command created, in order of their indexes
+    qualified_ids: List[str] = []
+    # Every command in the tree, by qualified ID
+    registry: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
 
     def __init__(self, id_: str, function: Callable[[Context], Awaitable[None]],
                  parent: Optional[Command] = None) -> None:
@@ -60,6 +67,16 @@ class Command:
             self.path = f"."
             self.qualified_id = ""
 
+        # Each command gets its own bit in masks of commands, such as the
+        # toggles of a guild. Parents are always created before their
+        # children, so have lower indexes.
+        self.index = len(Command.qualified_ids)
+        Command.qualified_ids.append(self.qualified_id)
+        Command.registry[self.qualified_id] = self
+        self.ancestor_mask = self.bit
+        if parent is not None:
+            self.ancestor_mask |= parent.ancestor_mask
+
         self.subcommands: Dict[str, Command] = {}
 
         self._converters: Dict[str, Callable[[str, Context], Any]] = {}
@@ -72,6 +89,13 @@ class Command:
     def parent(self) -> Optional[Command]:
         return self._parent() if self._parent is not None else None
 
+    @property
+    def bit(self) -> int:
+        """
+        Bit representing this command in masks of commands.
+        """
+        return 1 << self.index
+
     @property
     def function(self) -> Callable[[Context], Awaitable[None]]:
         return self._function
@@ -148,9 +172,13 @@ class Command:
             if id_ is None:
                 id_ = func.__name__
             cmd = Command(id_, func, parent)
+            Command.generation += 1
             cmd.authorise(CommandToggle())
             self.subcommands[id_] = cmd
-            self.update_aliases(cmd)
+            # Commands registered during startup are named in one pass by
+            # language.build_alias_index()
+            if language.alias_index_built:
+                self.update_aliases(cmd)
             if auths is not None:
                 for auth in auths:
                     cmd.authorise(auth)
@@ -1,25 +1,838 @@
 # -*- coding: utf-8 -*-
-from typing import Tuple, Any
+from bisect import bisect_left
+from collections import deque
+from contextlib import AsyncExitStack, asynccontextmanager
+from contextvars import ContextVar
+from typing import (Tuple, Any, AsyncIterator, Awaitable, Callable, Dict,
+                    Iterable, List, Optional, Union)
 
-import aiomysql
 import asyncio
-import json
+import time
+
+import cachetools
+
+from .cache import TaggedTTLCache
+
+
+# Upper bounds of the query latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5)
+SLOW_QUERY_TIME = 0.1
+SLOW_QUERY_LOG_SIZE = 100
+STREAM_BATCH_SIZE = 1000
+# Number of raw SQL strings whose query objects and statistics are kept
+RAW_QUERY_LIMIT = 1000
+
+# Defaults for the "db_cache" config
+RESULT_CACHE_SIZE = 10000
+RESULT_CACHE_TTL = 60.0
+
+# Defaults for the "db_breaker" config
+QUERY_TIMEOUT = 5.0
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 30.0
+
+# Defaults for the "db_pool" config
+POOL_MINSIZE = 1
+POOL_MAXSIZE = 10
+POOL_RECYCLE = -1
+POOL_WARM = 0
+BIND_IDLE = 1.0
+
+# Defaults for the "db_migrations" config
+MIGRATE_ON_CONNECT = False
+MIGRATIONS_DIR = "migrations"
+
+# Whether reads in the current context must go to the primary, as it has
+# written to the database
+_read_primary: ContextVar[bool] = ContextVar("read_primary", default=False)
+
+_missing = object()
+
+
+class _Binding:
+    """
+    Connection bound to a context by Database.connection(). Only one query
+    runs on it at a time, and the others wait for it.
+
+    A lazy binding only acquires its connection for the first query which
+    needs the primary, and returns it to the pool once it has been idle for
+    a while, acquiring another for the next such query.
+    """
+    __slots__ = ["conn", "lock", "owner", "closed", "transaction", "lazy",
+                 "_stack", "_idle"]
+
+    def __init__(self, conn, lazy: bool = False) -> None:
+        self.conn = conn
+        self.lock = asyncio.Lock()
+        # Task running a query on the connection
+        self.owner: Optional[asyncio.Task] = None
+        self.closed = False
+        self.transaction = False
+        self.lazy = lazy
+        self._stack = AsyncExitStack()
+        self._idle: Optional[asyncio.TimerHandle] = None
+
+    def idle(self, delay: float):
+        """
+        Release the connection of a lazy binding after the given delay, or
+        as soon as possible once the binding is closed.
+        """
+        if self._idle is not None:
+            self._idle.cancel()
+        if self.closed:
+            delay = 0
+        self._idle = asyncio.get_event_loop().call_later(
+            delay, lambda: asyncio.ensure_future(self.release()))
+
+    async def release(self):
+        """
+        Return the connection of a lazy binding to the pool, unless a query
+        is running on it.
+        """
+        if self._idle is not None:
+            self._idle.cancel()
+            self._idle = None
+        if self.conn is None or self.lock.locked():
+            return
+        self.conn = None
+        stack, self._stack = self._stack, AsyncExitStack()
+        await stack.aclose()
+
+
+_binding: ContextVar[Optional[_Binding]] = ContextVar("binding", default=None)
+
+
+class DatabaseUnavailable(Exception):
+    """
+    Exception raised by Database queries when the database cannot be reached,
+    either because the query timed out or lost its connection, or because the
+    circuit breaker is open after too many such failures.
+    """
+    pass
+
+
+class Query:
+    """
+    Class used to represent a named SQL query, along with statistics on how it
+    has been used.
+    """
+    __slots__ = ["name", "sql", "redact", "timeout", "cache_ttl", "primary",
+                 "count",
+                 "errors", "rows", "total_time", "max_time", "histogram",
+                 "cache_hits", "cache_misses"]
+
+    def __init__(self, name: str, sql: str, redact: bool = False,
+                 timeout: Optional[float] = None,
+                 cache_ttl: Optional[float] = None,
+                 primary: bool = False) -> None:
+        """
+        Initialise the query object.
+
+        :param name: Name used to identify the query in statistics
+        :param sql: SQL query to execute
+        :param redact: Whether to hide the query's parameters in the slow
+        query log
+        :param timeout: Deadline for the query in seconds, or None to use
+        the default deadline
+        :param cache_ttl: Time in seconds its cached results are kept for, or
+        None to use the default time
+        :param primary: Whether the query always reads from the primary
+        """
+        self.name = name
+        self.sql = sql
+        self.redact = redact
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self.primary = primary
+        self.count = 0
+        self.errors = 0
+        self.rows = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        # One count per bucket, plus one for anything slower than the last
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def record(self, elapsed: float, rows: int) -> None:
+        """
+        Record a single execution of this query.
+
+        :param elapsed: Time taken to execute the query, in seconds
+        :param rows: Number of rows returned or affected
+        """
+        self.count += 1
+        self.rows += rows
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        self.histogram[bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Retrieve the statistics of this query.
+
+        :return: Dict of statistics
+        """
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "rows": self.rows,
+            "total_time": self.total_time,
+            "mean_time": self.total_time / self.count if self.count else 0.0,
+            "max_time": self.max_time,
+            "histogram": dict(zip([*LATENCY_BUCKETS, float("inf")],
+                                  self.histogram)),
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses
+        }
+
+
+# Statements controlling transactions, which only pass through _guarded
+_begin = Query("transaction.begin", "BEGIN")
+_commit = Query("transaction.commit", "COMMIT")
+_rollback = Query("transaction.rollback", "ROLLBACK")
+
+
+class PoolStats:
+    """
+    Class used to hold statistics on connections acquired from the pool.
+    """
+    __slots__ = ["acquires", "total_wait", "max_wait", "saturations"]
+
+    def __init__(self) -> None:
+        self.acquires = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.saturations = 0
+
+    def record(self, waited: float) -> None:
+        """
+        Record a single connection acquisition.
+
+        :param waited: Time spent waiting for the connection, in seconds
+        """
+        self.acquires += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+
+
+class CircuitBreaker:
+    """
+    Class used to stop queries being sent to a database which is not
+    responding.
+
+    The breaker opens after `failure_threshold' queries in a row fail to
+    reach the database, after which queries fail immediately. Once
+    `reset_timeout' seconds have passed, a single trial query is let
+    through, which closes the breaker if it succeeds and opens it again if
+    it fails.
+    """
+    __slots__ = ["failure_threshold", "reset_timeout", "failures",
+                 "opened_at", "trial", "opens", "rejections", "timeouts"]
+
+    def __init__(self, failure_threshold: int = FAILURE_THRESHOLD,
+                 reset_timeout: float = RESET_TIMEOUT) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial = False
+        self.opens = 0
+        self.rejections = 0
+        self.timeouts = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half-open"
+
+    def check(self) -> bool:
+        """
+        Raise DatabaseUnavailable if a query may not be sent now.
+
+        :return: Whether the query is the trial query
+        """
+        state = self.state
+        if state == "open" or (state == "half-open" and self.trial):
+            self.rejections += 1
+            raise DatabaseUnavailable("Database circuit breaker is open")
+        if state == "half-open":
+            self.trial = True
+            return True
+        return False
+
+    def abandon(self, trial: bool):
+        """
+        Record a query that was cancelled, so neither reached nor failed to
+        reach the database. A cancelled trial lets the next query be tried.
+
+        :param trial: Whether the query was the trial query
+        """
+        if trial:
+            self.trial = False
+
+    def success(self):
+        """
+        Record a query that reached the database.
+        """
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def failure(self):
+        """
+        Record a query that could not reach the database.
+        """
+        self.failures += 1
+        if self.trial or (self.opened_at is None and
+                          self.failures >= self.failure_threshold):
+            self.opens += 1
+            self.opened_at = time.monotonic()
+        self.trial = False
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Retrieve the state of the breaker.
+
+        :return: Dict of statistics
+        """
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "opens": self.opens,
+            "rejections": self.rejections,
+            "timeouts": self.timeouts
+        }
 
 
 class Database:
     """
     Class used to represent the database connection used by the bot.
+
+    Queries may either be given as raw SQL strings or as Query objects
+    registered with Database.query(). Every query run is timed, and its
+    statistics can be retrieved with Database.stats(). Statistics are only
+    kept for the most recently used raw SQL strings.
+
+    The connection pool is not created on import. Database.configure() must
+    be given the bot config first, after which the pool is created either by
+    awaiting Database.connect() or on the first query.
+
+    The "db_backend" config selects either "mysql", which connects with
+    aiomysql using "db_credentials", or "sqlite", which uses the embedded
+    backend in sqlite.py with the options in "db_sqlite".
+
+    Either may list read replicas under "replicas", each given as the
+    options which differ from the primary's. Reads are then sent to the
+    replica with the fewest connections in use, and writes to the primary.
+    Once a task has written to the database, its later reads go to the
+    primary too, so that it always sees its own writes. Each command
+    invocation starts a new session with Database.start_session().
+
+    Several queries can be run on one primary connection with
+    `async with Database.connection()', or in a single transaction with
+    `async with Database.transaction()'. Queries made in that context,
+    including by tasks it starts, use the bound connection, waiting for it
+    if it is already running another query.
+    If "bind_invocations" is set in "db_pool", each command invocation gets
+    a lazy binding. It only binds a primary connection once the invocation
+    writes, and releases it after `bind_idle' seconds without a query, so
+    invocations waiting on users do not hold connections, and reads before
+    the first write still go to replicas.
+
+    Reads can be cached with fetchone_cached and fetchall_cached, keyed by
+    query and arguments. Cached results expire after the query's cache_ttl,
+    or the "ttl" in "db_cache", and can be tagged so that writers can evict
+    them with invalidate_tags(). Settings are tagged with their table and
+    ID, such as "toggles:<guild id>", which their writers invalidate.
+
+    Every query has a deadline, set in the "db_breaker" config, which starts
+    once the query has a connection. Queries which time out or cannot
+    connect raise DatabaseUnavailable, and after
+    too many of them in a row the circuit breaker opens, failing queries
+    immediately until the database recovers.
     """
     __slots__ = []
     pool = None
+    replica_pools: List[Any] = []
+    backend = "mysql"
+    credentials: Dict[str, Any] = {}
+    replicas: List[Dict[str, Any]] = []
+    pool_options: Dict[str, Any] = {}
+    warm = POOL_WARM
+    bind_invocations = False
+    bind_idle = BIND_IDLE
+    migrate_on_connect = MIGRATE_ON_CONNECT
+    migrations_dir = MIGRATIONS_DIR
+    _connect_lock = None
+    queries: Dict[str, Query] = {}
+    # Query objects of raw SQL strings, keyed by their text
+    raw_queries = cachetools.LRUCache(RAW_QUERY_LIMIT)
+    pool_stats = PoolStats()
+    slow_queries = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+    slow_query_time = SLOW_QUERY_TIME
+    redact_params = False
+    primary_reads = 0
+    replica_reads = 0
+    query_timeout: Optional[float] = QUERY_TIMEOUT
+    breaker = CircuitBreaker()
+    # Errors meaning the database could not be reached, set by the driver
+    connection_errors: Tuple[type, ...] = (OSError,)
+    # Unbuffered cursor class used by stream(), set by the driver
+    stream_cursor = None
+    result_cache = TaggedTTLCache(RESULT_CACHE_SIZE)
+    result_cache_ttl = RESULT_CACHE_TTL
+    invalidated = 0
+
+    @classmethod
+    def configure(cls, config: Dict[str, Any]):
+        """
+        Set the credentials and pool options used to connect, without
+        connecting.
+
+        :param config: Bot config, containing the "db_credentials" or
+        "db_sqlite" entry and optional "db_backend", "db_pool",
+        "db_telemetry", "db_migrations", "db_breaker" and "db_cache" entries
+        """
+        cls.backend = config.get("db_backend", "mysql")
+        if cls.backend == "mysql":
+            cls.credentials = dict(config["db_credentials"])
+        elif cls.backend == "sqlite":
+            cls.credentials = dict(config["db_sqlite"])
+        else:
+            raise ValueError(f"Unknown database backend \"{cls.backend}\"")
+        cls.replicas = [{**cls.credentials, **replica}
+                        for replica in cls.credentials.pop("replicas", [])]
+        for replica in cls.replicas:
+            replica.pop("replicas", None)
+
+        pool = config.get("db_pool", {})
+        cls.pool_options = {
+            "minsize": pool.get("minsize", POOL_MINSIZE),
+            "maxsize": pool.get("maxsize", POOL_MAXSIZE),
+            "pool_recycle": pool.get("pool_recycle", POOL_RECYCLE)
+        }
+        cls.warm = pool.get("warm", POOL_WARM)
+        cls.bind_invocations = pool.get("bind_invocations", False)
+        cls.bind_idle = pool.get("bind_idle", BIND_IDLE)
+
+        telemetry = config.get("db_telemetry", {})
+        cls.slow_query_time = telemetry.get("slow_query_time",
+                                            SLOW_QUERY_TIME)
+        cls.redact_params = telemetry.get("redact_params", False)
+
+        migrations = config.get("db_migrations", {})
+        cls.migrate_on_connect = migrations.get("auto", MIGRATE_ON_CONNECT)
+        cls.migrations_dir = migrations.get("directory", MIGRATIONS_DIR)
+
+        breaker = config.get("db_breaker", {})
+        cls.query_timeout = breaker.get("query_timeout", QUERY_TIMEOUT)
+        cls.breaker = CircuitBreaker(
+            breaker.get("failure_threshold", FAILURE_THRESHOLD),
+            breaker.get("reset_timeout", RESET_TIMEOUT))
+
+        cache = config.get("db_cache", {})
+        cls.result_cache = TaggedTTLCache(cache.get("size",
+                                                    RESULT_CACHE_SIZE))
+        cls.result_cache_ttl = cache.get("ttl", RESULT_CACHE_TTL)
+
     @classmethod
-    async def _make(cls, **credentials):
+    async def connect(cls):
         """
-        Initialise the database class.
+        Create the connection pool if it does not exist yet, apply any
+        missing schema migrations if enabled in the "db_migrations" config,
+        then open and check `warm' connections so that the first queries do
+        not need to.
+        This is safe to call concurrently, and is called automatically by the
+        first query if it has not been awaited beforehand.
+        """
+        if cls.pool is not None:
+            return
+        if cls._connect_lock is None:
+            cls._connect_lock = asyncio.Lock()
+
+        async with cls._connect_lock:
+            if cls.pool is not None:
+                return
+            if cls.backend == "sqlite":
+                from . import sqlite as driver
+            else:
+                import aiomysql as driver
+            cls.connection_errors = (OSError, driver.OperationalError,
+                                     driver.InterfaceError)
+            cls.stream_cursor = driver.SSCursor
+            pools = await asyncio.gather(*(
+                driver.create_pool(**credentials, **cls.pool_options,
+                                   autocommit=True)
+                for credentials in [cls.credentials, *cls.replicas]
+            ))
+            if cls.migrate_on_connect:
+                from .migrations import migrate
+                await migrate(pools[0], cls.backend, cls.migrations_dir)
+            await asyncio.gather(*(cls._warm(pool, min(cls.warm, pool.maxsize))
+                                   for pool in pools))
+            cls.replica_pools = pools[1:]
+            cls.pool = pools[0]
+
+    @staticmethod
+    async def _warm(pool, count: int):
+        """
+        Open the given number of connections in the pool at once, checking
+        each of them works before returning them to the pool.
 
-        :param credentials: MySQL database credentials.
+        :param pool: Connection pool to warm
+        :param count: Number of connections to open
         """
-        cls.pool = await aiomysql.create_pool(**credentials, autocommit=True)
+        async def ping():
+            async with pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute("SELECT 1")
+
+        await asyncio.gather(*(ping() for _ in range(count)))
+
+    @classmethod
+    async def close(cls):
+        """
+        Close every connection in the pool. The pool will be created again if
+        another query is made.
+        """
+        if cls.pool is None:
+            return
+        pools = [cls.pool, *cls.replica_pools]
+        cls.pool = None
+        cls.replica_pools = []
+        for pool in pools:
+            pool.close()
+        await asyncio.gather(*(pool.wait_closed() for pool in pools))
+
+    @staticmethod
+    def start_session():
+        """
+        Start a new session in the current context, in which reads may go to
+        replicas until the first write.
+        """
+        _read_primary.set(False)
+
+    @staticmethod
+    def use_primary():
+        """
+        Send every later read in the current context to the primary, such as
+        when refilling a cache with a row a replica may not have caught up
+        with yet.
+        """
+        _read_primary.set(True)
+
+    @classmethod
+    @asynccontextmanager
+    async def connection(cls, lazy: bool = False):
+        """
+        Bind a primary connection to the current context, so that every
+        query made in it runs on the same connection. If a connection is
+        already bound, it is reused, unless its binding is lazy.
+
+        :param lazy: Whether to bind a connection only once a query needs the
+        primary, and to release it while idle. No connection is yielded.
+        """
+        binding = _binding.get()
+        if binding is not None and not binding.closed:
+            if not binding.lazy:
+                yield binding.conn
+                return
+            # Only hold one connection at a time
+            await binding.release()
+
+        if lazy:
+            binding = _Binding(None, lazy=True)
+            token = _binding.set(binding)
+            try:
+                yield None
+            finally:
+                binding.closed = True
+                _binding.reset(token)
+                await binding.release()
+            return
+
+        async with cls._pooled() as conn:
+            binding = _Binding(conn)
+            token = _binding.set(binding)
+            try:
+                yield conn
+            finally:
+                binding.closed = True
+                _binding.reset(token)
+
+    @classmethod
+    @asynccontextmanager
+    async def transaction(cls):
+        """
+        Run every query made in the current context in a single transaction
+        on a bound connection, which is committed if the body succeeds and
+        rolled back if it raises. Transactions inside a transaction are part
+        of the outer one.
+        """
+        async with cls.connection() as conn:
+            binding = _binding.get()
+            if binding.transaction:
+                yield conn
+                return
+
+            # Wait for queries of other tasks on the connection to finish
+            async with cls._acquire():
+                await cls._guarded(_begin, conn.begin())
+            binding.transaction = True
+            try:
+                yield conn
+            except BaseException:
+                binding.transaction = False
+                # An open transaction must be ended, even with the breaker open
+                async with cls._acquire():
+                    await cls._guarded(_rollback, conn.rollback(),
+                                       check=False)
+                raise
+            binding.transaction = False
+            async with cls._acquire():
+                await cls._guarded(_commit, conn.commit(), check=False)
+
+    @classmethod
+    def query(cls, name: str, sql: str, *, redact: bool = False,
+              timeout: Optional[float] = None,
+              cache_ttl: Optional[float] = None,
+              primary: bool = False) -> Query:
+        """
+        Register a named query. The returned object can be passed to any of the
+        query methods in place of an SQL string.
+
+        :param name: Unique name of the query
+        :param sql: SQL query to execute
+        :param redact: Whether to hide the query's parameters in the slow
+        query log
+        :param timeout: Deadline for the query in seconds, or None to use
+        the default deadline
+        :param cache_ttl: Time in seconds results cached by fetchone_cached
+        and fetchall_cached are kept for, or None to use the default time
+        :param primary: Whether the query always reads from the primary,
+        such as when a replica lagging behind would make it miss rows for
+        good
+        :return: Registered query object
+        """
+        if name in cls.queries:
+            raise ValueError(f"Query \"{name}\" is already registered")
+        query = Query(name, sql, redact, timeout, cache_ttl, primary)
+        cls.queries[name] = query
+        return query
+
+    @classmethod
+    def _resolve(cls, query: Union[str, Query]) -> Query:
+        """
+        Retrieve the query object for a query. Raw SQL strings are never
+        looked up as query names, and their query objects are kept apart from
+        the registered queries, only for the most recently used strings.
+
+        :param query: SQL string or query object
+        :return: Query object
+        """
+        if isinstance(query, Query):
+            return query
+        try:
+            return cls.raw_queries[query]
+        except KeyError:
+            cls.raw_queries[query] = ret = Query(" ".join(query.split()),
+                                                 query)
+            return ret
+
+    @classmethod
+    @asynccontextmanager
+    async def _acquire(cls, read: bool = False, primary: bool = False):
+        """
+        Acquire the connection bound to the current context, waiting for any
+        query running on it to finish, or a connection from the pool if none
+        is bound.
+
+        :param read: Whether the connection is only used for reading, so may
+        be acquired from the least busy replica
+        :param primary: Whether a read must be made on the primary
+        """
+        binding = _binding.get()
+        if binding is None or binding.closed or \
+                (binding.lazy and read and not _read_primary.get()):
+            async with cls._pooled(read, primary) as conn:
+                yield conn
+            return
+
+        task = asyncio.current_task()
+        if binding.owner is task:
+            # Waiting would never end, and another connection would run
+            # outside the bound transaction
+            raise RuntimeError("A query was made while the bound connection "
+                               "is streaming rows to the same task")
+        try:
+            async with binding.lock:
+                binding.owner = task
+                try:
+                    if binding.conn is None:
+                        binding.conn = await binding._stack \
+                            .enter_async_context(cls._pooled())
+                    yield binding.conn
+                finally:
+                    binding.owner = None
+        finally:
+            if binding.lazy:
+                binding.idle(cls.bind_idle)
+
+    @classmethod
+    @asynccontextmanager
+    async def _pooled(cls, read: bool = False, primary: bool = False):
+        """
+        Acquire a connection from the pool, recording how long it took and
+        whether the pool had no connections left to give out.
+
+        :param read: Whether the connection is only used for reading, so may
+        be acquired from the least busy replica
+        :param primary: Whether a read must be made on the primary, without
+        sending the later reads of the context there too
+        """
+        if cls.pool is None:
+            await cls.connect()
+        pool = cls.pool
+        if read:
+            if cls.replica_pools and not primary and \
+                    not _read_primary.get():
+                pool = min(cls.replica_pools,
+                           key=lambda replica: replica.size - replica.freesize)
+                cls.replica_reads += 1
+            else:
+                cls.primary_reads += 1
+        else:
+            _read_primary.set(True)
+        if pool.freesize == 0 and pool.size >= pool.maxsize:
+            cls.pool_stats.saturations += 1
+        start = time.perf_counter()
+        async with pool.acquire() as conn:
+            cls.pool_stats.record(time.perf_counter() - start)
+            yield conn
+
+    @classmethod
+    @asynccontextmanager
+    async def _timed(cls, query: Query, data: Tuple[Any, ...]):
+        """
+        Time the execution of a query. The body must append the number of
+        rows returned or affected to the yielded list.
+
+        :param query: Query being executed
+        :param data: Arguments used in the query
+        """
+        rows = []
+        start = time.perf_counter()
+        try:
+            yield rows
+        except BaseException:
+            query.errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            query.record(elapsed, sum(rows))
+            if elapsed >= cls.slow_query_time:
+                if query.redact or cls.redact_params:
+                    data = "<redacted>"
+                cls.slow_queries.append((time.time(), query.name, elapsed,
+                                         data))
+
+    @classmethod
+    async def _run(cls, query: Query, run: Callable[..., Awaitable[Any]],
+                   data: Any, read: bool = False) -> Any:
+        """
+        Acquire a connection and run a query on it through the circuit
+        breaker. The query's deadline only starts once the connection is
+        acquired, so waiting for a busy pool is never counted as a failure to
+        reach the database.
+
+        :param query: Query being executed
+        :param run: Coroutine function executing the query, given the
+        connection, the query and its arguments
+        :param data: Arguments for the query
+        :param read: Whether the query only reads from the database
+        :return: Return value of the coroutine
+        """
+        trial = cls.breaker.check()
+        try:
+            async with cls._acquire(read, query.primary) as conn:
+                coro = run(conn, query, data)
+                return await cls._deadline(query, coro, trial)
+        except cls.connection_errors as e:
+            # A new connection could not be opened
+            cls.breaker.failure()
+            raise DatabaseUnavailable(str(e)) from e
+        except DatabaseUnavailable:
+            raise
+        except BaseException:
+            # Failed or cancelled before the query was sent
+            cls.breaker.abandon(trial)
+            raise
+
+    @classmethod
+    async def _guarded(cls, query: Query, coro: Awaitable[Any],
+                       read: bool = False, check: bool = True) -> Any:
+        """
+        Run a query on a connection that is already held through the circuit
+        breaker, within its deadline.
+
+        :param query: Query being executed
+        :param coro: Coroutine executing the query
+        :param read: Whether the query only reads from the database
+        :param check: Whether the query is rejected while the breaker is
+        open, rather than only recorded
+        :return: Return value of the coroutine
+        """
+        if not read:
+            # The query runs in its own task, which cannot set this for us
+            _read_primary.set(True)
+        trial = False
+        if check:
+            try:
+                trial = cls.breaker.check()
+            except DatabaseUnavailable:
+                coro.close()
+                raise
+        return await cls._deadline(query, coro, trial)
+
+    @classmethod
+    async def _deadline(cls, query: Query, coro: Awaitable[Any],
+                        trial: bool) -> Any:
+        """
+        Await a query within its deadline, recording the outcome in the
+        circuit breaker.
+
+        :param query: Query being executed
+        :param coro: Coroutine executing the query
+        :param trial: Whether the query is the breaker's trial query
+        :return: Return value of the coroutine
+        """
+        timeout = query.timeout if query.timeout is not None \
+            else cls.query_timeout
+        try:
+            ret = await asyncio.wait_for(coro, timeout)
+        except asyncio.TimeoutError as e:
+            cls.breaker.timeouts += 1
+            cls.breaker.failure()
+            raise DatabaseUnavailable(f"Query \"{query.name}\" timed out "
+                                      f"after {timeout}s") from e
+        except cls.connection_errors as e:
+            cls.breaker.failure()
+            raise DatabaseUnavailable(str(e)) from e
+        except Exception:
+            # Any other error still came from a working database
+            cls.breaker.success()
+            raise
+        except BaseException:
+            # Cancelled before the database answered
+            cls.breaker.abandon(trial)
+            raise
+        cls.breaker.success()
+        return ret
 
     @classmethod
     async def fetchone(cls, query, *data):
@@ -28,17 +841,23 @@ class Database:
         prepared statements. If the resulting row only contains one item, return
         said item, else return the full row. If no row is found, return None.
 
-        :param query: SQL query to execute
+        :param query: SQL query or registered query to execute
         :param data: Arguments for prepared statements in query
         :return: Fetched row from database
         """
-        async with cls.pool.acquire() as conn:
+        query = cls._resolve(query)
+        return await cls._run(query, cls._fetchone, data, True)
+
+    @classmethod
+    async def _fetchone(cls, conn, query: Query, data: Tuple[Any, ...]):
+        async with cls._timed(query, data) as rows:
             async with conn.cursor() as cur:
-                await cur.execute(query, data)
+                await cur.execute(query.sql, data)
                 ret = await cur.fetchone()
                 if ret is None:
                     return ret
-                elif len(ret) == 1:
+                rows.append(1)
+                if len(ret) == 1:
                     return ret[0]
                 else:
                     return ret
@@ -49,26 +868,40 @@ class Database:
         Fetch all rows from the given query, using the given parameters for
         prepared statements. If no rows are found, return None.
 
-        :param query: SQL query to execute
+        :param query: SQL query or registered query to execute
         :param data: Arguments for prepared statements in query
         :return: Fetched rows from database
         """
-        async with cls.pool.acquire() as conn:
+        query = cls._resolve(query)
+        return await cls._run(query, cls._fetchall, data, True)
+
+    @classmethod
+    async def _fetchall(cls, conn, query: Query, data: Tuple[Any, ...]):
+        async with cls._timed(query, data) as rows:
             async with conn.cursor() as cur:
-                await cur.execute(query, data)
-                return await cur.fetchall()
+                await cur.execute(query.sql, data)
+                ret = await cur.fetchall()
+                rows.append(len(ret))
+                return ret
 
     @classmethod
     async def execute(cls, query, *data) -> int:
         """
         Execute the given query.
 
-        :param query: SQL query to execute
+        :param query: SQL query or registered query to execute
         :param data: Arguments for prepared statements in query
         """
-        async with cls.pool.acquire() as conn:
+        query = cls._resolve(query)
+        return await cls._run(query, cls._execute, data)
+
+    @classmethod
+    async def _execute(cls, conn, query: Query,
+                       data: Tuple[Any, ...]) -> int:
+        async with cls._timed(query, data) as rows:
             async with conn.cursor() as cur:
-                await cur.execute(query, data)
+                await cur.execute(query.sql, data)
+                rows.append(max(cur.rowcount, 0))
                 return cur.rowcount
 
     @classmethod
@@ -77,19 +910,186 @@ class Database:
         Execute the given query multiple times, once for each entry in the
         data_groups parameter.
 
-        :param query: SQL query to execute
+        :param query: SQL query or registered query to execute
         :param data_groups: List of tuples of arguments to use in prepared
         statements
         """
-        async with cls.pool.acquire() as conn:
+        query = cls._resolve(query)
+        return await cls._run(query, cls._executemany, data_groups)
+
+    @classmethod
+    async def _executemany(cls, conn, query: Query,
+                           data_groups: Tuple[Tuple[Any, ...], ...]) -> int:
+        async with cls._timed(query, data_groups) as rows:
             async with conn.cursor() as cur:
-                await cur.executemany(query, data_groups)
+                await cur.executemany(query.sql, data_groups)
+                rows.append(max(cur.rowcount, 0))
                 return cur.rowcount
 
+    @classmethod
+    async def fetchone_cached(cls, query, *data, tags: Iterable[str] = ()):
+        """
+        Fetch a single row from the given query like fetchone, returning the
+        cached result if the same query was run with the same parameters
+        recently.
+
+        :param query: SQL query or registered query to execute
+        :param data: Arguments for prepared statements in query
+        :param tags: Tags to evict the result with in invalidate_tags()
+        :return: Fetched row from database
+        """
+        return await cls._cached(cls.fetchone, query, data, tags)
+
+    @classmethod
+    async def fetchall_cached(cls, query, *data, tags: Iterable[str] = ()):
+        """
+        Fetch all rows from the given query like fetchall, returning the
+        cached result if the same query was run with the same parameters
+        recently. The result must not be modified, as it is shared.
+
+        :param query: SQL query or registered query to execute
+        :param data: Arguments for prepared statements in query
+        :param tags: Tags to evict the result with in invalidate_tags()
+        :return: Fetched rows from database
+        """
+        return await cls._cached(cls.fetchall, query, data, tags)
+
+    @classmethod
+    async def _cached(cls, fetch, query, data: Tuple[Any, ...],
+                      tags: Iterable[str]):
+        query = cls._resolve(query)
+        key = (fetch.__name__, query.name, data)
+        try:
+            hash(key)
+        except TypeError:
+            # Unhashable arguments cannot be used as a key, so are not cached
+            return await fetch(query, *data)
+        ret = cls.result_cache.get(key, _missing)
+        if ret is not _missing:
+            query.cache_hits += 1
+            return ret
+        query.cache_misses += 1
+
+        epoch = cls.result_cache.epoch
+        ret = await fetch(query, *data)
+        # Results read before one of their tags was invalidated are dropped
+        ttl = query.cache_ttl if query.cache_ttl is not None \
+            else cls.result_cache_ttl
+        cls.result_cache.set(key, ret, ttl, tags, since=epoch)
+        return ret
+
+    @classmethod
+    def invalidate_tags(cls, *tags: str):
+        """
+        Evict every cached result with any of the given tags from this
+        process. Use Invalidation.invalidate_tags() to also evict them from
+        other processes.
+
+        :param tags: Tags to invalidate
+        """
+        cls.invalidated += cls.result_cache.invalidate_tags(*tags)
+
+    @classmethod
+    async def stream(cls, query, *data, batch_size: int = STREAM_BATCH_SIZE,
+                     batches: bool = False) -> AsyncIterator[Any]:
+        """
+        Stream the rows from the given query from an unbuffered cursor,
+        fetching `batch_size' rows at a time, so that memory use does not grow
+        with the size of the result. Unlike fetchall, rows are always tuples.
+
+        The connection is held until every row has been read, so the
+        generator should either be exhausted, or closed with aclose() when
+        stopping early. Each batch has its own deadline, and the time spent
+        by the caller between batches is not counted in the query's
+        statistics.
+
+        :param query: SQL query or registered query to execute
+        :param data: Arguments for prepared statements in query
+        :param batch_size: Number of rows fetched from the database at once
+        :param batches: Whether to yield lists of rows rather than single rows
+        :return: Async generator of rows or lists of rows
+        """
+        query = cls._resolve(query)
+        if cls.pool is None:
+            await cls.connect()
+        count = 0
+        elapsed = 0.0
+        try:
+            async with cls._acquire(True, query.primary) as conn:
+                async with conn.cursor(cls.stream_cursor) as cur:
+                    start = time.perf_counter()
+                    await cls._guarded(query, cur.execute(query.sql, data),
+                                       True)
+                    while True:
+                        rows = await cls._guarded(query,
+                                                  cur.fetchmany(batch_size),
+                                                  True)
+                        elapsed += time.perf_counter() - start
+                        if not rows:
+                            break
+                        count += len(rows)
+                        if batches:
+                            yield list(rows)
+                        else:
+                            for row in rows:
+                                yield row
+                        start = time.perf_counter()
+        except Exception:
+            query.errors += 1
+            raise
+        finally:
+            query.record(elapsed, count)
+
+    @classmethod
+    def stats(cls) -> Dict[str, Any]:
+        """
+        Retrieve statistics on every query run so far, the connection pool,
+        the result cache and the slow query log.
+
+        :return: Dict of statistics
+        """
+        pool = cls.pool
+        pool_stats = cls.pool_stats
+        acquires = pool_stats.acquires
+        queries = [*cls.queries.values(), *cls.raw_queries.values()]
+        hits = sum(query.cache_hits for query in queries)
+        misses = sum(query.cache_misses for query in queries)
+        return {
+            "backend": cls.backend,
+            "breaker": cls.breaker.stats(),
+            "reads": {
+                "primary": cls.primary_reads,
+                "replica": cls.replica_reads
+            },
+            "replicas": [{
+                "size": replica.size,
+                "free": replica.freesize,
+                "in_use": replica.size - replica.freesize
+            } for replica in cls.replica_pools],
+            "queries": {query.name: query.stats()
+                        for query in cls.queries.values()
+                        if query.count or query.cache_hits},
+            "raw_queries": {query.name: query.stats()
+                            for query in cls.raw_queries.values()
+                            if query.count or query.cache_hits},
+            "pool": {
+                "size": pool.size if pool is not None else 0,
+                "free": pool.freesize if pool is not None else 0,
+                "in_use": pool.size - pool.freesize if pool is not None else 0,
+                "maxsize": pool.maxsize if pool is not None else 0,
+                "acquires": acquires,
+                "mean_wait": pool_stats.total_wait / acquires
+                if acquires else 0.0,
+                "max_wait": pool_stats.max_wait,
+                "saturations": pool_stats.saturations
+            },
+            "result_cache": {
+                "size": len(cls.result_cache),
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+                "invalidated": cls.invalidated
+            },
+            "slow_queries": list(cls.slow_queries)
+        }
 
-with open("config.json") as f:
-    # need to load the config file again to get credentials
-    config = json.load(f)
-    asyncio.get_event_loop().run_until_complete(
-        Database._make(**config["db_credentials"])
-    )
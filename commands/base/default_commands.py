@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 
+import math
 from typing import Optional, Callable, Awaitable, Tuple, Union, List, TypeVar
 
+import cachetools
 from discord import Member, Embed
 
 from commands.base.client import Ratelimit
@@ -9,9 +11,11 @@ from . import bot, Command, CommandError, authorise, Context
 from . import get_alias, toggle_alias
 from . import language
 from . import toggle_botban, get_guild_botbans
-from . import toggle, is_toggled, get_guild_toggles, CommandToggle
+from . import toggle, get_toggle_mask, get_guild_toggles, CommandToggle
 from . import Lister, BasePager
 from . import database
+from .invalidation import Invalidation
+from .ipc import ClusterLink
 from .authority import bot_mod, bot_admin, pm, no_pm, owner
 from .converters import Required
 
@@ -67,7 +71,7 @@ async def language_command(ctx, newlang=None, set_guild=None):
         return
 
     newlang = newlang.lower()
-    if newlang not in language.LanguageManager.data:
+    if newlang not in language.LanguageManager.folders:
         raise CommandError("invalid_lang")
 
     if set_guild in ["server", "guild"] and not ctx.is_private:
@@ -172,7 +176,7 @@ async def add_permissions(target: Command, ctx: Context, embed: Embed) -> None:
             embed.add_field(name=header, value=line)
 
         elif isinstance(auth, CommandToggle) and \
-                (await is_toggled(ctx.guild_id, target.qualified_id)):
+                (await get_toggle_mask(ctx.guild_id)) & target.bit:
 
             # Handle toggles separate
             header = ctx.get_output("toggle_header")
@@ -193,7 +197,38 @@ async def add_permissions(target: Command, ctx: Context, embed: Embed) -> None:
         header = ctx.get_output("auth_header")
         embed.add_field(name=header, value=line)
 
-    Help.run_interjections(target, ctx, embed)
+
+HELP_CACHE_SIZE = 500
+
+# Rendered help pages, keyed by the path used, the target command, the
+# language, the invoker and which parts of the target the invoker can see.
+# Interjections may depend on anything in the context, and pages with any
+# <choice> would repeat the same choice, so neither are cached
+_help_cache = cachetools.LRUCache(HELP_CACHE_SIZE)
+_help_cache_state = None
+
+
+def clear_help_cache():
+    """
+    Remove all rendered help pages from the help cache.
+    """
+    _help_cache.clear()
+
+
+# Toggles changed by other processes change which subcommands are listed
+Invalidation.subscribe("toggles", lambda guild_id: clear_help_cache())
+
+
+def _check_help_cache():
+    """
+    Clear the help cache if any languages have been loaded or unloaded, or any
+    commands registered, since the cached pages were rendered.
+    """
+    global _help_cache_state
+    state = (language.LanguageManager.generation, Command.generation)
+    if state != _help_cache_state:
+        clear_help_cache()
+        _help_cache_state = state
 
 
 @bot.command("help")
@@ -217,6 +252,36 @@ async def help_command(ctx: Context, *path: str):
         successes.append(element)
         target = found
 
+    visible = []
+    for sub in set(target.subcommands.values()):
+        if await sub.validate_auth(ctx) is None:
+            visible.append(sub)
+
+    _check_help_cache()
+    key = (path, target.qualified_id, ctx.lang, ctx.invoker,
+           frozenset(sub.qualified_id for sub in visible),
+           bool(await get_toggle_mask(ctx.guild_id) & target.bit))
+
+    try:
+        pages = _help_cache[key]
+    except KeyError:
+        choices_made = language.choices_made
+        pages = await render_help_pages(ctx, target, path, visible)
+        # Choices made by other tasks while rendering also prevent caching,
+        # which only costs rendering the pages again
+        if language.choices_made == choices_made:
+            _help_cache[key] = pages
+
+    # The pager adds footers to its pages, and interjections add fields to
+    # the first, so give them copies
+    pages = [Embed.from_dict(page.to_dict()) for page in pages]
+    Help.run_interjections(target, ctx, pages[0])
+    await BasePager(ctx, *pages).start()
+
+
+async def render_help_pages(ctx: Context, target: Command,
+                            path: Tuple[str, ...], visible: List[Command]
+                            ) -> List[Embed]:
     # Build the messages. Page 1 will have a description and usage
     # Pages 2 onwards will have different subcommands.
 
@@ -231,13 +296,12 @@ async def help_command(ctx: Context, *path: str):
     usages = language.get_command_help_lines(target, ctx)
     subcommands = []
 
-    for sub in set(target.subcommands.values()):
-        if await sub.validate_auth(ctx) is None:
-            try:
-                line = language.get_command_parent_help(sub, ctx)
-                subcommands.append(line)
-            except language.LanguageError:
-                pass
+    for sub in visible:
+        try:
+            line = language.get_command_parent_help(sub, ctx)
+            subcommands.append(line)
+        except language.LanguageError:
+            pass
 
     pages = []
 
@@ -274,7 +338,7 @@ async def help_command(ctx: Context, *path: str):
 
         pages.append(embed)
 
-    await BasePager(ctx, *pages).start()
+    return pages
 
 
 # ======================
@@ -322,6 +386,7 @@ async def toggle_shared_function(ctx: Context, *commands: Command):
     paths = [cmd.qualified_id for cmd in commands]
 
     await updater(ctx.guild_id, *paths)
+    clear_help_cache()
 
     await ctx.post_line("success", ", ".join(paths), numerical_ref=len(commands))
 
@@ -357,4 +422,72 @@ async def toggle_list(ctx: Context):
 @authorise(owner)
 @bot.command("quit")
 async def quit_command(ctx: Context):
+    if ClusterLink.connected():
+        # The launcher asks every process of the cluster to quit
+        ClusterLink.send("quit", None)
+    else:
+        await bot._bot.logout()
+
+
+async def _quit_cluster():
     await bot._bot.logout()
+
+
+ClusterLink.register("quit", _quit_cluster)
+
+
+# =======================
+# === Cluster Command ===
+# =======================
+
+async def _cluster_stats() -> dict:
+    shards = ClusterLink.shard_ids or sorted(bot._bot.shards) or [0]
+    latency = bot._bot.latency
+    return {
+        "shards": f"{shards[0]}-{shards[-1]}",
+        "guilds": len(bot._bot.guilds),
+        # Latency is NaN until a shard has connected
+        "latency": round(latency * 1000) if math.isfinite(latency) else None
+    }
+
+
+ClusterLink.register("stats", _cluster_stats)
+
+
+@bot.on_ready
+async def notify_cluster_ready():
+    ClusterLink.send("ready", None)
+
+
+@authorise(owner)
+@bot.command("cluster")
+async def cluster_command(ctx: Context):
+    if ClusterLink.connected():
+        stats = await ClusterLink.request("stats")
+    else:
+        stats = {0: await _cluster_stats()}
+    lines = []
+    for cluster_id, info in sorted(stats.items()):
+        if not info:
+            continue
+        # Processes whose shards have not connected have no latency
+        if info["latency"] is None:
+            latency = ctx.get_output("no_latency")
+        else:
+            latency = ctx.get_output("cluster_latency", info["latency"])
+        lines.append(ctx.get_output("cluster_stats", cluster_id,
+                                    info["shards"], info["guilds"], latency))
+    guilds = sum(info["guilds"] for info in stats.values() if info)
+    lines.append(ctx.get_output("cluster_total", guilds, len(lines),
+                                numerical_ref=len(lines)))
+    await ctx.post("\n".join(lines))
+
+
+@cluster_command.subcommand("reload")
+async def cluster_reload(ctx: Context):
+    if not ClusterLink.connected():
+        raise CommandError("not_clustered")
+    restarting = await ClusterLink.request("reload")
+    if not restarting:
+        raise CommandError("already_reloading")
+    await ctx.post_line("reloading", restarting, numerical_ref=restarting)
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import annotations
+
+import asyncio
+import json
+import time
+import uuid
+from typing import (Any, Callable, Dict, Hashable, List, Optional, Set,
+                    Tuple)
+
+from .database import Database as db
+from .writebehind import WriteBehind
+
+TABLE = "cache_invalidations"
+
+# Defaults for the "invalidation" config
+POLL_INTERVAL = 1.0
+RETENTION = 3600.0
+# Time after which an invalidation is assumed to be visible to every reader,
+# as auto-increment IDs may be committed out of order
+GRACE_PERIOD = 5.0
+PRUNE_INTERVAL = 60.0
+# Time after a change during which replicas may still return the old row,
+# including the time a write may be held by write-behind
+REPLICA_LAG = 30.0
+
+_insert_invalidation = db.query("cache_invalidations.insert", f"""
+    INSERT INTO {TABLE}
+    (origin, tbl, cache_key, created)
+    VALUES (%s, %s, %s, %s);
+""")
+# Replicas may lag behind by more than GRACE_PERIOD, so invalidations are
+# always read from the primary, or some would be skipped for good
+_select_last_invalidation = db.query("cache_invalidations.select_last", f"""
+    SELECT COALESCE(MAX(id), 0) FROM {TABLE};
+""", primary=True)
+_select_invalidation_range = db.query("cache_invalidations.select_range", f"""
+    SELECT COALESCE(MIN(id), 0), COALESCE(MAX(id), 0) FROM {TABLE};
+""", primary=True)
+_select_invalidations = db.query("cache_invalidations.select", f"""
+    SELECT id, origin, tbl, cache_key, created FROM {TABLE}
+    WHERE id > %s
+    ORDER BY id;
+""", primary=True)
+_prune_invalidations = db.query("cache_invalidations.prune", f"""
+    DELETE FROM {TABLE}
+    WHERE created < %s;
+""")
+
+# Invalidations must only be written after the changes they describe
+WriteBehind.trailing_tables.add(TABLE)
+
+# Name published in place of a table for tags of cached query results
+QUERY_TAGS = "query_tags"
+
+
+class Invalidation:
+    """
+    Class used to keep caches consistent between bot processes sharing one
+    database.
+
+    Modules caching rows from a table subscribe to it with a handler which
+    evicts a single key from their caches. Whenever a process changes a row,
+    it publishes the table and cache key to the cache_invalidations table,
+    which every other process polls every `interval' seconds, calling the
+    handlers subscribed to that table.
+
+    When write-behind is enabled, invalidations are only written once every
+    other pending write has been flushed, so that other processes never
+    reload a row before the change to it is visible.
+
+    Replicas may lag behind the primary, so caches reloading a row changed
+    in the last `replica_lag' seconds, by any process, call read_fresh()
+    to read it from the primary.
+    """
+    __slots__ = []
+    enabled = False
+    interval = POLL_INTERVAL
+    retention = RETENTION
+    origin = uuid.uuid4().hex
+    handlers: Dict[str, List[Callable[[Any], None]]] = {}
+    # Functions called with the table and key of every change, whether made
+    # by this process or another, even while invalidation is disabled
+    watchers: List[Callable[[str, Any], None]] = []
+    replica_lag = REPLICA_LAG
+    # Time of every change made in the last `replica_lag' seconds, oldest
+    # first, by table and key
+    changed: Dict[Tuple[str, Hashable], float] = {}
+    last_id: Optional[int] = None
+    seen: Set[int] = set()
+    received = 0
+    published = 0
+    _poll_task: Optional[asyncio.Task] = None
+    _last_prune = 0.0
+
+    @classmethod
+    def configure(cls, config: Dict[str, Any]):
+        """
+        Set the invalidation options from the bot config.
+
+        :param config: Bot config, containing the optional "invalidation"
+        entry
+        """
+        options = config.get("invalidation", {})
+        cls.enabled = options.get("enabled", False)
+        cls.interval = options.get("interval", POLL_INTERVAL)
+        cls.retention = options.get("retention", RETENTION)
+        cls.replica_lag = options.get("replica_lag", REPLICA_LAG)
+
+    @classmethod
+    def subscribe(cls, table: str, handler: Callable[[Any], None]):
+        """
+        Register a handler to be called with the cache key of every change
+        made to the given table by another process.
+
+        :param table: Name of table to subscribe to
+        :param handler: Function evicting the given key from a cache
+        """
+        cls.handlers.setdefault(table, []).append(handler)
+
+    @classmethod
+    def record_change(cls, table: str, key: Hashable):
+        """
+        Record that a row has changed, so that caches refilling it read from
+        the primary until replicas have caught up.
+        """
+        now = time.monotonic()
+        cls.changed.pop((table, key), None)
+        cls.changed[table, key] = now
+        cutoff = now - cls.replica_lag
+        while cls.changed:
+            oldest = next(iter(cls.changed))
+            if cls.changed[oldest] >= cutoff:
+                break
+            del cls.changed[oldest]
+
+    @classmethod
+    def read_fresh(cls, table: str, key: Hashable):
+        """
+        Send the reads refilling a cache with the given row to the primary,
+        if the row changed recently. This must be called before the reads.
+        """
+        changed = cls.changed.get((table, key))
+        if changed is not None and \
+                changed >= time.monotonic() - cls.replica_lag:
+            db.use_primary()
+
+    @classmethod
+    async def publish(cls, table: str, key: Hashable):
+        """
+        Notify every other process that the row with the given cache key in
+        the given table has changed. The key must be serialisable as JSON.
+
+        :param table: Name of table changed
+        :param key: Cache key of the row changed
+        """
+        for watcher in cls.watchers:
+            watcher(table, key)
+        if not cls.enabled:
+            return
+        cache_key = json.dumps(key)
+        cls.published += 1
+        await WriteBehind.submit((TABLE, table, cache_key),
+                                 _insert_invalidation,
+                                 cls.origin, table, cache_key, time.time())
+
+    @classmethod
+    async def invalidate_tags(cls, *tags: str):
+        """
+        Evict every query result cached by Database with any of the given
+        tags, in this process and every other.
+
+        :param tags: Tags to invalidate
+        """
+        db.invalidate_tags(*tags)
+        for tag in tags:
+            await cls.publish(QUERY_TAGS, tag)
+
+    @classmethod
+    async def replay(cls, since: int) -> bool:
+        """
+        Apply every invalidation published after the given ID, including
+        those published by this process before it was restarted.
+
+        :param since: ID of the last invalidation applied
+        :return: Whether every invalidation since then could be applied,
+        rather than some having been pruned already
+        """
+        first, last = await db.fetchone(_select_invalidation_range)
+        if last == since:
+            return True
+        # An empty table, or a gap after since, may hide pruned invalidations
+        if first == 0 or first > since + 1 or last < since:
+            return False
+        for _, _, table, cache_key, _ in await db.fetchall(
+                _select_invalidations, since):
+            cls._apply(table, json.loads(cache_key))
+        return True
+
+    @classmethod
+    async def start(cls):
+        """
+        Start polling for invalidations published by other processes from
+        this point onwards.
+        """
+        if not cls.enabled or cls._poll_task is not None:
+            return
+        cls.last_id = await db.fetchone(_select_last_invalidation)
+        cls._poll_task = asyncio.ensure_future(cls._poll_periodically())
+
+    @classmethod
+    async def close(cls):
+        """
+        Stop polling for invalidations.
+        """
+        if cls._poll_task is not None:
+            cls._poll_task.cancel()
+            cls._poll_task = None
+
+    @classmethod
+    async def poll(cls):
+        """
+        Apply every invalidation published since the last poll.
+        """
+        rows = await db.fetchall(_select_invalidations, cls.last_id)
+        visible = time.time() - GRACE_PERIOD
+        advance = True
+        for id_, origin, table, cache_key, created in rows:
+            if id_ not in cls.seen:
+                cls.seen.add(id_)
+                if origin != cls.origin:
+                    cls.received += 1
+                    cls._apply(table, json.loads(cache_key))
+
+            # Only move past invalidations once no earlier ID can still
+            # appear, keeping later ones in seen so they are not reapplied
+            if advance and created < visible:
+                cls.last_id = id_
+                cls.seen.discard(id_)
+            else:
+                advance = False
+
+        if time.monotonic() - cls._last_prune >= PRUNE_INTERVAL:
+            cls._last_prune = time.monotonic()
+            await db.execute(_prune_invalidations,
+                             time.time() - cls.retention)
+
+    @classmethod
+    def stats(cls) -> Dict[str, int]:
+        """
+        Retrieve statistics on the invalidations sent and received.
+
+        :return: Dict of statistics
+        """
+        return {
+            "published": cls.published,
+            "received": cls.received,
+            "last_id": cls.last_id
+        }
+
+    @classmethod
+    def _apply(cls, table: str, key: Any):
+        if isinstance(key, list):
+            # JSON has no tuples
+            key = tuple(key)
+        for watcher in cls.watchers:
+            watcher(table, key)
+        for handler in cls.handlers.get(table, []):
+            handler(key)
+
+    @classmethod
+    async def _poll_periodically(cls):
+        while True:
+            await asyncio.sleep(cls.interval)
+            try:
+                await cls.poll()
+            except Exception as e:
+                print(f"Failed to poll cache invalidations: {e}")
+
+
+Invalidation.subscribe(QUERY_TAGS, db.invalidate_tags)
+Invalidation.watchers.append(Invalidation.record_change)
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import annotations
+
+import asyncio
+import json
+import threading
+from multiprocessing.connection import Client, Connection
+from typing import (Any, Awaitable, Callable, Dict, List, Mapping, Optional,
+                    Tuple)
+
+# Environment variables set by cluster.py for each process it starts
+CLUSTER_ID = "CLUSTER_ID"
+CLUSTER_ADDRESS = "CLUSTER_ADDRESS"
+CLUSTER_AUTHKEY = "CLUSTER_AUTHKEY"
+SHARD_IDS = "SHARD_IDS"
+SHARD_COUNT = "SHARD_COUNT"
+
+REQUEST_TIMEOUT = 30.0
+
+Handler = Callable[..., Awaitable[Any]]
+
+
+def parse_address(address: Any) -> Any:
+    """
+    Convert an address from the config or environment into one accepted by
+    multiprocessing.connection, where a host and port is a tuple.
+    """
+    return tuple(address) if isinstance(address, list) else address
+
+
+class ClusterLink:
+    """
+    Class used by each bot process started by cluster.py to talk to the
+    launcher over a local multiprocessing connection.
+
+    Every message is a tuple of an operation, a request ID, which is None if
+    no reply is expected, and the operation's arguments. Replies are sent as
+    ("reply", request ID, result). Handlers for the operations sent by the
+    launcher are registered with ClusterLink.register(), and their return
+    value is sent back as the reply.
+
+    Processes not started by cluster.py have no link, and run on their own.
+    """
+    __slots__ = []
+    cluster_id: Optional[int] = None
+    shard_ids: Optional[List[int]] = None
+    shard_count: Optional[int] = None
+    address: Any = None
+    authkey: Optional[bytes] = None
+    handlers: Dict[str, Handler] = {}
+    conn: Optional[Connection] = None
+    _requests: Dict[int, asyncio.Future] = {}
+    _next_request = 0
+    _send_lock = threading.Lock()
+    _loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @classmethod
+    def configure(cls, environ: Mapping[str, str]):
+        """
+        Read the cluster and shards of this process from its environment.
+
+        :param environ: Environment variables, such as os.environ
+        """
+        if CLUSTER_ID not in environ:
+            return
+        cls.cluster_id = int(environ[CLUSTER_ID])
+        cls.address = parse_address(json.loads(environ[CLUSTER_ADDRESS]))
+        cls.authkey = bytes.fromhex(environ[CLUSTER_AUTHKEY])
+        cls.shard_ids = [int(i) for i in environ[SHARD_IDS].split(",")]
+        cls.shard_count = int(environ[SHARD_COUNT])
+
+    @classmethod
+    def shard_options(cls) -> Dict[str, Any]:
+        """
+        Return the arguments selecting this process's shards, to be passed to
+        discord.AutoShardedClient.
+        """
+        if cls.shard_ids is None:
+            return {}
+        return {"shard_ids": cls.shard_ids, "shard_count": cls.shard_count}
+
+    @classmethod
+    def local_path(cls, path: Optional[str]) -> Optional[str]:
+        """
+        Return the path of a file only used by this process, which is given a
+        suffix with the cluster ID when run by cluster.py, as every process
+        shares one config.
+
+        :param path: Path from the config, or None if the file is not used
+        :return: Path for this process
+        """
+        if path is None or cls.cluster_id is None:
+            return path
+        return f"{path}.{cls.cluster_id}"
+
+    @classmethod
+    def register(cls, operation: str, handler: Handler):
+        """
+        Register the coroutine function handling an operation sent by the
+        launcher.
+
+        :param operation: Name of the operation
+        :param handler: Coroutine function called with the operation's
+        arguments, returning the result to reply with
+        """
+        cls.handlers[operation] = handler
+
+    @classmethod
+    def connected(cls) -> bool:
+        return cls.conn is not None
+
+    @classmethod
+    async def start(cls):
+        """
+        Connect to the launcher, if this process was started by one.
+        """
+        if cls.cluster_id is None or cls.conn is not None:
+            return
+        cls._loop = asyncio.get_event_loop()
+        cls.conn = await cls._loop.run_in_executor(
+            None, lambda: Client(cls.address, authkey=cls.authkey))
+        cls.send("hello", None, cls.cluster_id)
+        threading.Thread(target=cls._read, args=(cls.conn,),
+                         name="cluster-link", daemon=True).start()
+
+    @classmethod
+    def close(cls):
+        """
+        Disconnect from the launcher.
+        """
+        if cls.conn is None:
+            return
+        conn = cls.conn
+        cls.conn = None
+        conn.close()
+        for future in cls._requests.values():
+            future.cancel()
+        cls._requests.clear()
+
+    @classmethod
+    def send(cls, operation: str, request_id: Optional[int], *args: Any):
+        """
+        Send a message to the launcher, if connected.
+        """
+        if cls.conn is None:
+            return
+        with cls._send_lock:
+            cls.conn.send((operation, request_id, *args))
+
+    @classmethod
+    async def request(cls, operation: str, *args: Any,
+                      timeout: float = REQUEST_TIMEOUT) -> Any:
+        """
+        Send an operation to the launcher and wait for its reply.
+
+        :param operation: Name of the operation
+        :param args: Arguments of the operation
+        :param timeout: Time in seconds to wait for the reply
+        :return: Result of the operation
+        """
+        if cls.conn is None:
+            raise ConnectionError("Not connected to a cluster launcher")
+        cls._next_request += 1
+        request_id = cls._next_request
+        future = cls._requests[request_id] = cls._loop.create_future()
+        try:
+            cls.send(operation, request_id, *args)
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            cls._requests.pop(request_id, None)
+
+    @classmethod
+    def _read(cls, conn: Connection):
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                break
+            cls._loop.call_soon_threadsafe(cls._dispatch, message)
+        if cls.conn is conn:
+            print("Lost connection to the cluster launcher")
+            cls._loop.call_soon_threadsafe(cls.close)
+
+    @classmethod
+    def _dispatch(cls, message: Tuple):
+        operation, request_id, *args = message
+        if operation == "reply":
+            future = cls._requests.get(request_id)
+            if future is not None and not future.done():
+                future.set_result(args[0])
+            return
+        handler = cls.handlers.get(operation)
+        if handler is None:
+            print(f"Unknown cluster operation \"{operation}\"")
+            return
+        asyncio.ensure_future(cls._handle(handler, request_id, args))
+
+    @classmethod
+    async def _handle(cls, handler: Handler, request_id: Optional[int],
+                      args: List[Any]):
+        try:
+            result = await handler(*args)
+        except Exception as e:
+            print(f"Failed to handle cluster operation: {e}")
+            result = None
+        if request_id is not None:
+            cls.send("reply", request_id, result)
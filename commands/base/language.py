@@ -3,15 +3,23 @@
 from __future__ import annotations
 
 import random
-import cachetools
+import sys
+import time
+import asyncio
 from os import listdir, path
-from typing import Union, Optional, Dict, List, Any, TypeVar, Callable, Tuple
+from typing import (Union, Optional, Dict, List, Any, TypeVar, Callable, Tuple,
+                    Set)
 from xml.etree import ElementTree as etree
 
 from .command import Command
 from .context import Context
-from .database import Database as db
+from .database import Database as db, DatabaseUnavailable
 from .client import bot
+from .writebehind import WriteBehind
+from .invalidation import Invalidation
+from .snapshot import Snapshot
+from .shared import SharedSettings, grouped
+from .tiered import TieredCache
 
 route = "./languages/"
 
@@ -27,12 +35,71 @@ class LanguageError(Exception):
     pass
 
 
+def _clean_text(text: Optional[str]) -> str:
+    if text is None:
+        return ""
+    if "\n" in text:
+        text = "\n".join(line.strip() for line in text.split("\n"))
+    return text.strip()
+
+
+class CommandInfo:
+    """
+    Record of the help information of a command in a single language, built
+    when the language is loaded. Text is stored with its whitespace cleaned,
+    but with the invoker placeholders left in place.
+    """
+    __slots__ = ["qualified_name", "description", "help_sections",
+                 "parent_help", "site_link"]
+
+    def __init__(self, qualified_name: str, description: Optional[str],
+                 help_sections: List[Tuple[str, str]],
+                 parent_help: Optional[Tuple[str, str]],
+                 site_link: Optional[str]) -> None:
+        """
+        Initialise the command info object.
+
+        :param qualified_name: Names of the command and its ancestors
+        :param description: Description text, if any
+        :param help_sections: List of tuples of each help section's args and
+        text
+        :param parent_help: Tuple of the parent help section's args and text,
+        if any
+        :param site_link: Link to the command's online documentation
+        """
+        self.qualified_name = qualified_name
+        self.description = description
+        self.help_sections = help_sections
+        self.parent_help = parent_help
+        self.site_link = site_link
+
+
 class LanguageManager:
     """
     Class used to hold the XML data for each language.
+
+    Only the default language and the languages listed in the "preload" entry
+    of the "languages" config are parsed at startup. Every other language is
+    parsed in an executor the first time it is requested, and may be unloaded
+    again if it is unused for longer than the "unload_after" config entry (in
+    seconds).
     """
     data = {}
     default = "english"
+    folders: Dict[str, str] = {}
+    headers: Dict[str, Dict[str, str]] = {}
+    tables: Dict[str, Dict[str, etree.Element]] = {}
+    list_tables: Dict[str, Dict[str, List[etree.Element]]] = {}
+    chains: Dict[str, List[str]] = {}
+    catalogs: Dict[str, Dict[str, CommandInfo]] = {}
+    last_used: Dict[str, float] = {}
+    preload = set()
+    unload_after: Optional[float] = None
+    # Incremented whenever a language is loaded or unloaded
+    generation = 0
+    _unloader_started = False
+    # Languages being loaded in the background by resolve
+    _pending: Set[str] = set()
     # Loading stuff
 
     @staticmethod
@@ -84,46 +151,391 @@ class LanguageManager:
 
         return root
 
+    @staticmethod
+    def read_header(folder) -> Optional[Dict[str, str]]:
+        """
+        Read the attributes of the root element of a language folder's
+        language.xml, without parsing the rest of the file.
+
+        :param folder: Path to desired language folder
+        :return: Attributes of the <language> element, or None if unreadable
+        """
+        try:
+            for _, element in etree.iterparse(
+                    path.join(route, folder, "language.xml"), ("start",)):
+                return dict(element.attrib)
+        except (etree.ParseError, OSError):
+            pass
+        print(f"Failed to import language \"{folder}\"")
+        return None
+
     @classmethod
-    def load(cls):
+    def scan(cls):
         """
-        Load all languages found in the root language folder into memory.
+        Find every language in the root language folder, recording its ID and
+        header attributes without loading it.
         """
         for folder in listdir(route):
             if path.isdir(path.join(route, folder)):
-                root = cls.load_lang(folder)
-                if root is not None:
-                    cls.data[root.attrib["id"]] = root
+                header = cls.read_header(folder)
+                if header is not None:
+                    cls.folders[header["id"]] = folder
+                    cls.headers[header["id"]] = header
 
     @classmethod
-    def get_object_tree(cls, lang: str):
+    def load(cls):
+        """
+        Find all languages in the root language folder, loading the default
+        language and any preloaded languages into memory.
+        """
+        config = bot.config.get("languages", {})
+        cls.preload = {cls.default, *config.get("preload", [])}
+        cls.unload_after = config.get("unload_after")
+
+        cls.scan()
+        for lang in cls.preload:
+            # No commands exist yet, so there are no aliases to update
+            cls.load_language(lang, update_aliases=False)
+
+    @staticmethod
+    def index_elements(root: etree.Element
+                       ) -> Tuple[Dict[str, etree.Element],
+                                  Dict[str, List[etree.Element]]]:
+        """
+        Index every command, output value and help element in a language by
+        the same path used to search for it, so that lookups do not need to
+        search the tree.
+
+        :param root: Root XML element of language
+        :return: Tuple of a dict of paths to single elements, and a dict of
+        paths to lists of <helpsection> elements
+        """
+        elements = {}
+        lists = {}
+
+        def index_command(element, element_path):
+            for child in element:
+                if child.tag == "command":
+                    child_path = \
+                        f"{element_path}/command[@id='{child.get('id')}']"
+                    # Match find(), which returns the first matching element
+                    if child_path not in elements:
+                        elements[child_path] = child
+                        index_command(child, child_path)
+                elif child.tag == "output":
+                    for item in child:
+                        id_ = item.get("id")
+                        if id_ is not None:
+                            elements.setdefault(
+                                f"{element_path}/output/*[@id='{id_}']", item)
+                else:
+                    child_path = f"{element_path}/{child.tag}"
+                    elements.setdefault(child_path, child)
+                    if child.tag == "helpsection":
+                        lists.setdefault(child_path, []).append(child)
+
+        index_command(root, ".")
+        return elements, lists
+
+    @staticmethod
+    def build_catalog(root: etree.Element,
+                      elements: Dict[str, etree.Element],
+                      lists: Dict[str, List[etree.Element]]
+                      ) -> Dict[str, CommandInfo]:
+        """
+        Build the help information of every command in a language from its
+        overlay tables, keyed by command path.
+
+        :param root: Root XML element of language
+        :param elements: Overlay table of single elements
+        :param lists: Overlay table of <helpsection> lists
+        :return: Dict of command paths to command info
         """
-        Retrieve the root element of the given language.
+        def text_of(element_path):
+            element = elements.get(element_path)
+            if element is None:
+                return None
+            return _clean_text(element.text)
+
+        def sections_of(element_path):
+            return [(element.get("args", ""), _clean_text(element.text))
+                    for element in lists.get(element_path, [])]
+
+        catalog = {".": CommandInfo("", text_of("./description"),
+                                    sections_of("./helpsection"), None,
+                                    root.get("site-link"))}
+
+        # Shorter paths first, so parents are always built before children
+        paths = sorted((path_ for path_, element in elements.items()
+                        if element.tag == "command"), key=len)
+        for command_path in paths:
+            element = elements[command_path]
+            parent = catalog[command_path[:command_path.rindex("/command[")]]
+            qualified_name = " ".join(filter(None, [parent.qualified_name,
+                                                    element.get("name")]))
+
+            parent_help = elements.get(command_path + "/parenthelpsection")
+            if parent_help is not None:
+                parent_help = (parent_help.get("args", ""),
+                               _clean_text(parent_help.text))
+
+            catalog[command_path] = CommandInfo(
+                qualified_name,
+                text_of(command_path + "/description"),
+                sections_of(command_path + "/helpsection"),
+                parent_help,
+                element.get("site-link")
+            )
+
+        return catalog
+
+    @classmethod
+    def load_language(cls, lang: str, update_aliases: bool = True,
+                      _loading: Tuple[str, ...] = (),
+                      _parsed: Optional[Dict[str, etree.Element]] = None
+                      ) -> Optional[etree.Element]:
+        """
+        Load the language with the given ID into memory if it is not already
+        loaded, along with the language it inherits from.
+
+        Every language other than the default inherits from the language given
+        in the parent attribute of its <language> element, or the default
+        language if it has none. The elements it does not define itself are
+        resolved through this chain once at load time into an overlay table,
+        so lookups never need to search more than one language.
 
         :param lang: Language ID
-        :return: Root XML element of language
+        :param update_aliases: Whether to add the language's command names to
+        the existing command tree
+        :param _loading: Languages whose parents are currently being loaded
+        :param _parsed: Roots of languages already parsed by
+        load_language_async, which are not parsed again
+        :return: Root XML element of language, or None if it cannot be loaded
         """
         if lang in cls.data:
             return cls.data[lang]
-        return cls.data[cls.default]
+        if lang not in cls.folders:
+            return None
+
+        parent = None
+        if lang != cls.default:
+            parent = cls.headers[lang].get("parent", cls.default)
+            if parent in _loading or \
+                    cls.load_language(parent, update_aliases,
+                                      _loading + (lang,), _parsed) is None:
+                print(f"Failed to load parent \"{parent}\" of language "
+                      f"\"{lang}\"")
+                parent = cls.default
+                cls.load_language(parent, update_aliases)
+
+        if _parsed is not None and lang in _parsed:
+            root = _parsed[lang]
+        else:
+            root = cls.load_lang(cls.folders[lang])
+        if root is None:
+            return None
+
+        elements, lists = cls.index_elements(root)
+        if parent is not None:
+            elements = {**cls.tables[parent], **elements}
+            lists = {**cls.list_tables[parent], **lists}
+            cls.chains[lang] = [lang, *cls.chains[parent]]
+        else:
+            cls.chains[lang] = [lang]
+
+        cls.data[lang] = root
+        cls.tables[lang] = elements
+        cls.list_tables[lang] = lists
+        cls.catalogs[lang] = cls.build_catalog(root, elements, lists)
+        cls.generation += 1
+        cls.last_used[lang] = time.monotonic()
+        if update_aliases:
+            _add_language_aliases(lang)
+        return root
+
+    @classmethod
+    async def load_language_async(cls, lang: str
+                                  ) -> Optional[etree.Element]:
+        """
+        Load the language with the given ID into memory like load_language,
+        but parse the files of it and the languages it inherits from in an
+        executor, so that the event loop is not blocked.
+
+        :param lang: Language ID
+        :return: Root XML element of language, or None if it cannot be loaded
+        """
+        if lang in cls.data:
+            return cls.data[lang]
+        loop = asyncio.get_event_loop()
+        parsed = {}
+        pending = lang
+        while pending in cls.folders and pending not in cls.data \
+                and pending not in parsed:
+            parsed[pending] = await loop.run_in_executor(
+                None, cls.load_lang, cls.folders[pending])
+            if pending == cls.default:
+                break
+            pending = cls.headers[pending].get("parent", cls.default)
+        return cls.load_language(lang, _parsed=parsed)
+
+    @classmethod
+    def unload_language(cls, lang: str):
+        """
+        Remove a loaded language from memory. The default language, preloaded
+        languages and languages inherited by a loaded language are never
+        unloaded.
+
+        :param lang: Language ID
+        """
+        if lang in cls.preload or lang not in cls.data:
+            return
+        if any(lang in chain[1:] for chain in cls.chains.values()):
+            return
+        _remove_language_aliases(lang)
+        del cls.data[lang]
+        del cls.tables[lang]
+        del cls.list_tables[lang]
+        del cls.catalogs[lang]
+        del cls.chains[lang]
+        cls.generation += 1
+        cls.last_used.pop(lang, None)
+
+    @classmethod
+    def unload_unused(cls):
+        """
+        Unload every language that has not been used in the last
+        `unload_after' seconds.
+        """
+        if cls.unload_after is None:
+            return
+        cutoff = time.monotonic() - cls.unload_after
+        unused = [lang for lang, used in cls.last_used.items()
+                  if used < cutoff]
+        # Longest chains first, so children are unloaded before the parents
+        # they keep loaded
+        unused.sort(key=lambda lang: len(cls.chains.get(lang, ())),
+                    reverse=True)
+        for lang in unused:
+            cls.unload_language(lang)
+
+    @classmethod
+    async def touch(cls, lang: str):
+        """
+        Mark the given language as used, loading it if it is not in memory.
+
+        :param lang: Language ID
+        """
+        if lang in cls.data or \
+                await cls.load_language_async(lang) is not None:
+            cls.last_used[lang] = time.monotonic()
+
+    @classmethod
+    def memory_report(cls) -> Dict[str, int]:
+        """
+        Estimate the memory used by each loaded language, in bytes. This counts
+        every element in the language's tree, along with its text and
+        attributes, and its overlay tables and command catalog.
+
+        :return: Dict of language IDs to their estimated size
+        """
+        report = {}
+        for lang, root in cls.data.items():
+            total = 0
+            for element in root.iter():
+                total += sys.getsizeof(element)
+                total += sys.getsizeof(element.text)
+                total += sys.getsizeof(element.tail)
+                total += sys.getsizeof(element.attrib)
+                for key, value in element.attrib.items():
+                    total += sys.getsizeof(key) + sys.getsizeof(value)
+            total += sys.getsizeof(cls.tables[lang])
+            total += sys.getsizeof(cls.list_tables[lang])
+            total += sys.getsizeof(cls.catalogs[lang])
+            for info in cls.catalogs[lang].values():
+                total += sys.getsizeof(info)
+            report[lang] = total
+        return report
+
+    @classmethod
+    def resolve(cls, lang: str) -> str:
+        """
+        Retrieve the ID of the language that should be used for the given
+        language. This is the language itself, or the default language if it
+        is not loaded.
+
+        Languages are loaded by touch() before they are used, so a language
+        that is not loaded here is loaded in the background instead of
+        blocking the event loop, and the default language is used until then.
+        Without a running event loop, it is loaded straight away.
+
+        :param lang: Language ID
+        :return: Language ID of a loaded language
+        """
+        if lang in cls.data:
+            return lang
+        if lang not in cls.folders:
+            return cls.default
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            if cls.load_language(lang) is not None:
+                return lang
+            return cls.default
+        if lang not in cls._pending:
+            cls._pending.add(lang)
+            asyncio.ensure_future(cls._load_pending(lang))
+        return cls.default
+
+    @classmethod
+    async def _load_pending(cls, lang: str):
+        try:
+            await cls.touch(lang)
+        finally:
+            cls._pending.discard(lang)
+
+    @classmethod
+    def get_command_info(cls, command_path: str, lang: str) -> CommandInfo:
+        """
+        Retrieve the help information of a command in the given language. If
+        the command does not exist in the language or any it inherits from,
+        raise LanguageError.
+
+        :param command_path: Path of the command
+        :param lang: Language ID
+        :return: Command info
+        """
+        info = cls.catalogs[cls.resolve(lang)].get(command_path)
+        if info is None:
+            raise LanguageError(f"No english output value for '{command_path}'")
+        return info
+
+    @classmethod
+    def get_object_tree(cls, lang: str):
+        """
+        Retrieve the root element of the given language, loading it if needed.
+
+        :param lang: Language ID
+        :return: Root XML element of language
+        """
+        return cls.data[cls.resolve(lang)]
 
     @classmethod
     def _get_lang_or_eng(cls, element_path: str, lang: str, _ret_none=False
                          ) -> Union[etree.Element, None]:
-        root = cls.get_object_tree(lang)
-        element: etree.Element = root.find(element_path)
+        lang = cls.resolve(lang)
+        element = cls.tables[lang].get(element_path)
         if element is not None:
             return element
 
-        # print(f"No data for '{element_path}' in language '{lang}'")
-        root = cls.get_object_tree(cls.default)
-        element = root.find(element_path)
-        if element is None:
-            if _ret_none:  # Simple name lol
-                return None
-            raise LanguageError(f"No english output value for '{element_path}'")
+        # Paths that are not indexed are searched through the whole chain
+        for chain_lang in cls.chains[lang]:
+            element = cls.data[chain_lang].find(element_path)
+            if element is not None:
+                return element
 
-        return element
+        if _ret_none:  # Simple name lol
+            return None
+        raise LanguageError(f"No english output value for '{element_path}'")
 
     @classmethod
     def get_language_element(cls, element_path: str, lang: str
@@ -131,8 +543,8 @@ class LanguageManager:
         """
         Search through a language via the given XPath to retrieve a specific
         element. If that element is not found in the given language, search the
-        English language file with the same XPath. If still nothing is found,
-        raise LanguageError.
+        languages it inherits from with the same XPath, ending with English. If
+        still nothing is found, raise LanguageError.
 
         :param element_path: XPath to desired element
         :param lang: Language to initially search in
@@ -154,29 +566,47 @@ class LanguageManager:
     @classmethod
     def get_language_element_list(cls, element_path: str, lang: str
                                   ) -> List[etree.Element]:
-        # Try if the language works
-        root = cls.get_object_tree(lang)
-        element: etree.Element = root.find(element_path)
-        if element is None:
-            language = cls.default
+        lang = cls.resolve(lang)
+        elements = cls.list_tables[lang].get(element_path)
+        if elements is not None:
+            return elements
 
-        # Return list of items
-        return list(root.iterfind(element_path))
+        # Paths that are not indexed are searched through the whole chain
+        for chain_lang in cls.chains[lang]:
+            elements = list(cls.data[chain_lang].iterfind(element_path))
+            if elements:
+                return elements
+        return []
 
 
 # Initial load
 LanguageManager.load()
 
 
-def _clean_element_text(element: etree.Element, ctx: Context) -> str:
-    text = element.text
-    if "\n" in text:
-        text = "\n".join(line.strip() for line in text.split("\n"))
-    return text.strip() \
+@bot.on_ready
+async def start_language_unloader():
+    """
+    Periodically unload languages that have not been used recently.
+    """
+    if LanguageManager.unload_after is None or \
+            LanguageManager._unloader_started:
+        return
+    LanguageManager._unloader_started = True
+    while True:
+        await asyncio.sleep(LanguageManager.unload_after)
+        LanguageManager.unload_unused()
+
+
+def _fill_invokers(text: str, ctx: Context) -> str:
+    return text \
         .replace("\uF000", ctx.invoker) \
         .replace("\uF001", bot.invoker)
 
 
+def _clean_element_text(element: etree.Element, ctx: Context) -> str:
+    return _fill_invokers(_clean_text(element.text), ctx)
+
+
 # - Output parsers -----------------------------------------------------
 
 def convert_list(element: etree.Element, **kwargs: Any
@@ -214,6 +644,11 @@ def convert_dict(element: etree.Element, **kwargs: Any
     return output
 
 
+# Number of <choice> elements converted, so that callers caching converted
+# output can tell whether it was chosen at random
+choices_made = 0
+
+
 def _weight_choice(items: List[T], weights: List[Union[float, int]]) -> T:
     assert len(items) == len(weights)
     prob = sum(weights)
@@ -236,6 +671,8 @@ def convert_choice(element: etree.Element, **kwargs: Any) -> str:
     :param element: <choice> element to convert
     :return: Random child element
     """
+    global choices_made
+    choices_made += 1
     lines = []
     weights = []
     use_weights = False
@@ -394,19 +831,13 @@ def get_command_qualified_name(command: Command, ctx: Context) -> str:
     """
     Retrieve the full name of a command, consisting of the names of all of its
     ancestor commands separated by spaces and starting from the topmost command.
-    This command will retrieve
 
     :param command: Command object to retrieve name of
     :param ctx: Command context
     :return: Full command name
     """
-    output = []
-    while command.parent is not None:  # Cut off before processing root
-        element = LanguageManager.get_language_element(command.path, ctx.lang)
-        output.append(element.get("name"))
-        command = command.parent
-
-    return " ".join(reversed(output))
+    info = LanguageManager.get_command_info(command.path, ctx.lang)
+    return info.qualified_name
 
 
 def get_command_description(command: Command, ctx: Context) -> str:
@@ -418,9 +849,11 @@ def get_command_description(command: Command, ctx: Context) -> str:
     :param ctx: Command context
     :return: Description string
     """
-    element_path: str = command.path + f"/description"
-    element = LanguageManager.get_language_element(element_path, ctx.lang)
-    return _clean_element_text(element, ctx)
+    info = LanguageManager.get_command_info(command.path, ctx.lang)
+    if info.description is None:
+        raise LanguageError("No english output value for "
+                            f"'{command.path}/description'")
+    return _fill_invokers(info.description, ctx)
 
 
 def get_command_help_lines(command: Command, ctx: Context
@@ -434,20 +867,12 @@ def get_command_help_lines(command: Command, ctx: Context
     :return: List of tuples containing the example command usage and the
     associated explanation string
     """
-    element_path: str = command.path + "/helpsection"
-    elements = LanguageManager.get_language_element_list(element_path,
-                                                         ctx.lang)
+    info = LanguageManager.get_command_info(command.path, ctx.lang)
 
-    # Coerce elements into nice lines
-    output = []
-    qual_name = get_command_qualified_name(command, ctx)
-
-    for element in elements:
-        args = element.get("args", "")
-        cmd = f"{ctx.invoker}{qual_name} {args}"
-        output.append((cmd, _clean_element_text(element, ctx)))
-
-    return output
+    # Coerce sections into nice lines
+    return [(f"{ctx.invoker}{info.qualified_name} {args}",
+             _fill_invokers(text, ctx))
+            for args, text in info.help_sections]
 
 
 def get_command_parent_help(command: Command, ctx: Context
@@ -460,16 +885,14 @@ def get_command_parent_help(command: Command, ctx: Context
     :param ctx: Command context
     :return: Help section for parent of command
     """
-    element_path = command.path + "/parenthelpsection"
-    element = LanguageManager.get_language_element(element_path, ctx.lang)
-
-    if element is not None:
-        qual_name = get_command_qualified_name(command, ctx)
-        args = element.get("args", "")
-        cmd = f"{ctx.invoker}{qual_name} {args}"
-        return cmd, _clean_element_text(element, ctx)
+    info = LanguageManager.get_command_info(command.path, ctx.lang)
+    if info.parent_help is None:
+        raise LanguageError("No english output value for "
+                            f"'{command.path}/parenthelpsection'")
 
-    return None
+    args, text = info.parent_help
+    cmd = f"{ctx.invoker}{info.qualified_name} {args}"
+    return cmd, _fill_invokers(text, ctx)
 
 
 def get_command_link(command: Command, ctx: Context) -> str:
@@ -480,8 +903,7 @@ def get_command_link(command: Command, ctx: Context) -> str:
     :param ctx: Command context
     :return: Link to website documentation
     """
-    element = LanguageManager.get_language_element(command.path, ctx.lang)
-    return element.get("site-link")
+    return LanguageManager.get_command_info(command.path, ctx.lang).site_link
 
 
 def get_language_names():
@@ -491,8 +913,8 @@ def get_language_names():
     :return: List of language names
     """
     ret = {}
-    for lang, root in LanguageManager.data.items():
-        name = root.attrib["name"]
+    for lang, header in LanguageManager.headers.items():
+        name = header.get("name")
         if name is None:
             ret[lang] = lang
         else:
@@ -525,8 +947,135 @@ def get_command_names(command: Command) -> List[str]:
     return output
 
 
-_guild_cache = cachetools.LFUCache(100)
-_channel_cache = cachetools.LFUCache(500)
+def _index_command_names(lang: str) -> Dict[str, List[str]]:
+    """
+    Collect the names and aliases of every command in a language in a single
+    pass over its overlay table, keyed by the path that Command objects use to
+    refer to them. Commands the language does not define itself use the names
+    of the language it inherits from.
+
+    :param lang: Language ID
+    :return: Dict of command paths to the list of that command's names
+    """
+    output = {}
+    for command_path, element in LanguageManager.tables[lang].items():
+        if element.tag == "command":
+            names = [element.get("name")]
+            alias = element.get("alias")
+            if alias is not None:
+                names.extend(alias.split())
+            output[command_path] = names
+    return output
+
+
+def _apply_command_names(command: Command,
+                         indexes: Dict[str, Dict[str, List[str]]]) -> int:
+    """
+    Recursively add the names in each language index to the subcommand dicts
+    of the given command and all of its subcommands.
+
+    :param command: Command to update the subcommands of
+    :param indexes: Dict of language IDs to command name indexes
+    :return: Number of subcommands updated
+    """
+    count = 0
+    for sub in set(command.subcommands.values()):
+        names = {sub.id: sub, sub.id + "_": sub}
+        for lang, index in indexes.items():
+            sub_names = index.get(sub.path)
+            if sub_names is None:
+                raise LanguageError(f"No english output value for '{sub.path}'")
+            names.update((f"{lang} {key}", sub) for key in sub_names)
+        command.subcommands.update(names)
+        count += 1 + _apply_command_names(sub, indexes)
+    return count
+
+
+alias_index_built = False
+
+
+def build_alias_index():
+    """
+    Add the names of every command in every loaded language to the command
+    tree at once. This must be called after all command modules have been
+    imported; any commands registered afterwards will have their names added
+    individually by Command.update_aliases().
+    """
+    global alias_index_built
+    start = time.perf_counter()
+
+    indexes = {lang: _index_command_names(lang)
+               for lang in LanguageManager.data}
+    count = _apply_command_names(bot.root_command, indexes)
+    alias_index_built = True
+
+    elapsed = (time.perf_counter() - start) * 1000
+    print(f"Indexed {count} commands in {len(indexes)} languages "
+          f"in {elapsed:.2f}ms")
+
+
+def _add_language_aliases(lang: str):
+    """
+    Add the names of every command in the tree for a newly loaded language.
+
+    :param lang: Language ID
+    """
+    if alias_index_built:
+        _apply_command_names(bot.root_command,
+                             {lang: _index_command_names(lang)})
+
+
+def _remove_language_aliases(lang: str, command: Optional[Command] = None):
+    """
+    Remove the names of every command in the tree for an unloaded language.
+
+    :param lang: Language ID
+    :param command: Command to update the subcommands of, defaults to root
+    """
+    if command is None:
+        command = bot.root_command
+    prefix = f"{lang} "
+    for key in [k for k in command.subcommands if k.startswith(prefix)]:
+        del command.subcommands[key]
+    for sub in set(command.subcommands.values()):
+        _remove_language_aliases(lang, sub)
+
+
+def _load_lang(id_: int, encoded: Optional[memoryview]) -> Optional[str]:
+    return None if encoded is None else str(encoded, "utf-8")
+
+
+_guild_cache = TieredCache(100, "guild_lang", load=_load_lang)
+_channel_cache = TieredCache(500, "channel_lang", load=_load_lang)
+
+_select_channel_lang = db.query("channel_lang.select", """
+    SELECT lang FROM channel_lang
+    WHERE channel_id = %s;
+""")
+_select_guild_lang = db.query("guild_lang.select", """
+    SELECT lang FROM guild_lang
+    WHERE guild_id = %s;
+""")
+_select_all_channel_langs = db.query("channel_lang.select_all", """
+    SELECT channel_id, lang FROM channel_lang
+    ORDER BY channel_id;
+""")
+_select_all_guild_langs = db.query("guild_lang.select_all", """
+    SELECT guild_id, lang FROM guild_lang
+    ORDER BY guild_id;
+""")
+_upsert_guild_lang = db.query("guild_lang.upsert", """
+    INSERT INTO guild_lang
+    VALUES (%s, %s)
+    ON DUPLICATE KEY UPDATE
+        lang = %s;
+""")
+_upsert_channel_lang = db.query("channel_lang.upsert", """
+    INSERT INTO channel_lang
+    VALUES (%s, %s)
+    ON DUPLICATE KEY UPDATE
+        lang = %s;
+""")
 
 
 async def get_lang(guild_id, channel_id):
@@ -538,15 +1087,18 @@ async def get_lang(guild_id, channel_id):
     :return: Language name
     """
     try:
-        channel_lang = _channel_cache[channel_id]
+        channel_lang = await _channel_cache.lookup(channel_id)
     except KeyError:
-        channel_lang = await db.fetchone("""
-            SELECT lang FROM channel_lang
-            WHERE channel_id = %s;
-        """, channel_id)
-        _channel_cache[channel_id] = channel_lang
+        await WriteBehind.barrier("channel_lang")
+        Invalidation.read_fresh("channel_lang", channel_id)
+        try:
+            channel_lang = await db.fetchone(_select_channel_lang, channel_id)
+            _channel_cache[channel_id] = channel_lang
+        except DatabaseUnavailable:
+            channel_lang = _channel_cache.get_stale(channel_id)
 
     if channel_lang is not None:
+        await LanguageManager.touch(channel_lang)
         return channel_lang
 
     # channel id not found, check guild
@@ -554,15 +1106,18 @@ async def get_lang(guild_id, channel_id):
         if guild_id is None:
             guild_lang = None
         else:
-            guild_lang = _guild_cache[guild_id]
+            guild_lang = await _guild_cache.lookup(guild_id)
     except KeyError:
-        guild_lang = await db.fetchone("""
-            SELECT lang FROM guild_lang
-            WHERE guild_id = %s;
-        """, guild_id)
-        _guild_cache[guild_id] = guild_lang
+        await WriteBehind.barrier("guild_lang")
+        Invalidation.read_fresh("guild_lang", guild_id)
+        try:
+            guild_lang = await db.fetchone(_select_guild_lang, guild_id)
+            _guild_cache[guild_id] = guild_lang
+        except DatabaseUnavailable:
+            guild_lang = _guild_cache.get_stale(guild_id)
 
     if guild_lang is not None:
+        await LanguageManager.touch(guild_lang)
         return guild_lang
 
     return LanguageManager.default
@@ -576,12 +1131,10 @@ async def set_guild_lang(guild_id, lang):
     :param lang: New language string
     """
     _guild_cache[guild_id] = lang
-    await db.execute("""
-        INSERT INTO guild_lang
-        VALUES (%s, %s)
-        ON DUPLICATE KEY UPDATE 
-            lang = %s;
-    """, guild_id, lang, lang)
+    await WriteBehind.submit(("guild_lang", guild_id), _upsert_guild_lang,
+                             guild_id, lang, lang)
+    await Invalidation.publish("guild_lang", guild_id)
+    await Invalidation.invalidate_tags(f"guild_lang:{guild_id}")
 
 
 async def set_channel_lang(channel_id, lang):
@@ -593,9 +1146,44 @@ async def set_channel_lang(channel_id, lang):
     """
     # need to test if lang matches the guild lang
     _channel_cache[channel_id] = lang
-    await db.execute("""
-        INSERT INTO channel_lang
-        VALUES (%s, %s)
-        ON DUPLICATE KEY UPDATE 
-            lang = %s;
-    """, channel_id, lang, lang)
+    await WriteBehind.submit(("channel_lang", channel_id),
+                             _upsert_channel_lang, channel_id, lang, lang)
+    await Invalidation.publish("channel_lang", channel_id)
+    await Invalidation.invalidate_tags(f"channel_lang:{channel_id}")
+
+
+Invalidation.subscribe("guild_lang", _guild_cache.discard)
+Invalidation.subscribe("channel_lang", _channel_cache.discard)
+
+# Each ID has a single language
+SharedSettings.register("guild_lang", lambda: grouped(
+    _select_all_guild_langs, lambda langs: langs[0].encode()))
+SharedSettings.register("channel_lang", lambda: grouped(
+    _select_all_channel_langs, lambda langs: langs[0].encode()))
+
+
+def _dump_langs() -> Dict[str, Dict[int, Optional[str]]]:
+    return {"guild_lang": dict(_guild_cache),
+            "channel_lang": dict(_channel_cache)}
+
+
+def _restore_langs(langs: Dict[str, Dict[int, Optional[str]]]
+                   ) -> List[Tuple[str, int]]:
+    _guild_cache.update(langs["guild_lang"])
+    _channel_cache.update(langs["channel_lang"])
+    return [(table, id_) for table, ids in langs.items() for id_ in ids]
+
+
+async def _revalidate_langs(keys: List[Tuple[str, int]]):
+    caches = {"guild_lang": (_guild_cache, _select_guild_lang),
+              "channel_lang": (_channel_cache, _select_channel_lang)}
+    for table, id_ in keys:
+        caches[table][0].discard(id_)
+    for table, id_ in keys:
+        cache, query = caches[table]
+        await WriteBehind.barrier(table)
+        Invalidation.read_fresh(table, id_)
+        cache[id_] = await db.fetchone(query, id_)
+
+
+Snapshot.register("languages", _dump_langs, _restore_langs, _revalidate_langs)
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Versioned schema migrations for the Database class.
+
+Migrations are SQL scripts named `<version>_<name>.sql', stored in one folder
+per database backend, e.g. `migrations/mysql/0002_indexes.sql'. The versions
+applied to a database are recorded in its schema_version table, and any
+missing versions are applied in order by migrate().
+
+Migrations never drop data, so they can be applied while other processes are
+running. They must also be safe to apply to a database created by hand with
+create_db.sql, so each statement either uses IF NOT EXISTS, or is one whose
+"already exists" errors are ignored when running on MySQL.
+"""
+
+from __future__ import annotations
+
+import re
+import time
+from os import listdir, path
+from typing import List, Optional
+
+MIGRATIONS_DIR = "migrations"
+
+# MySQL errors raised by statements which have already been applied:
+# table exists, duplicate column, duplicate key name, and can't drop key
+DUPLICATE_ERRORS = {1050, 1060, 1061, 1091}
+
+_filename = re.compile(r"^(\d+)_(\w+)\.sql$")
+_delimiter = re.compile(r"^\s*DELIMITER\s+(\S+)\s*$", re.I)
+
+_create_schema_version = """
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER NOT NULL PRIMARY KEY,
+        name VARCHAR(255) NOT NULL,
+        applied DOUBLE NOT NULL
+    );
+"""
+_select_versions = """
+    SELECT version FROM schema_version;
+"""
+_insert_version = """
+    INSERT INTO schema_version
+    VALUES (%s, %s, %s);
+"""
+
+# Statements used to stop two processes migrating at once
+_locks = {
+    "mysql": ("SELECT GET_LOCK('schema_migrations', 60);",
+              "SELECT RELEASE_LOCK('schema_migrations');"),
+    # SQLite can run DDL in a transaction, so each migration is atomic
+    "sqlite": ("BEGIN IMMEDIATE;", "COMMIT;")
+}
+
+
+class Migration:
+    """
+    Class used to represent a single migration script.
+    """
+    __slots__ = ["version", "name", "path"]
+
+    def __init__(self, version: int, name: str, path_: str) -> None:
+        self.version = version
+        self.name = name
+        self.path = path_
+
+    def statements(self) -> List[str]:
+        """
+        Read the statements in this migration's script.
+
+        :return: List of SQL statements
+        """
+        with open(self.path) as f:
+            return split_statements(f.read())
+
+
+def split_statements(script: str) -> List[str]:
+    """
+    Split an SQL script into its statements. Statements end with a line
+    ending in the current delimiter, which is ";" unless changed by a
+    DELIMITER line, as in the mysql client.
+
+    :param script: SQL script
+    :return: List of SQL statements, without their delimiters
+    """
+    statements = []
+    delimiter = ";"
+    current = []
+    for line in script.splitlines():
+        match = _delimiter.match(line)
+        if match is not None:
+            delimiter = match.group(1)
+            continue
+        stripped = line.rstrip()
+        if stripped.endswith(delimiter):
+            current.append(stripped[:-len(delimiter)])
+            statement = "\n".join(current).strip()
+            if statement:
+                statements.append(statement)
+            current = []
+        else:
+            current.append(line)
+    # Anything after the last delimiter is only kept if it is not comments
+    if any(line.strip() and not line.strip().startswith("--")
+           for line in current):
+        statements.append("\n".join(current).strip())
+    return statements
+
+
+def find_migrations(directory: str) -> List[Migration]:
+    """
+    Find every migration in a folder.
+
+    :param directory: Folder containing migration scripts
+    :return: List of migrations, in order of version
+    """
+    migrations = []
+    if not path.isdir(directory):
+        return migrations
+    for filename in listdir(directory):
+        match = _filename.match(filename)
+        if match is not None:
+            migrations.append(Migration(int(match.group(1)), match.group(2),
+                                        path.join(directory, filename)))
+    migrations.sort(key=lambda migration: migration.version)
+    versions = [migration.version for migration in migrations]
+    if len(set(versions)) != len(versions):
+        raise ValueError(f"Duplicate migration versions in \"{directory}\"")
+    return migrations
+
+
+async def _execute(cur, backend: str, statement: str):
+    try:
+        # No arguments, so that % is not treated as a placeholder
+        await cur.execute(statement)
+    except Exception as e:
+        code = e.args[0] if e.args else None
+        if backend != "mysql" or code not in DUPLICATE_ERRORS:
+            raise
+
+
+async def _apply(cur, backend: str, migration: Migration) -> bool:
+    """
+    Apply a single migration while holding the migration lock.
+
+    :return: Whether the migration was applied, rather than having been
+    applied by another process while waiting for the lock
+    """
+    lock, unlock = _locks[backend]
+    await cur.execute(lock)
+    if backend == "mysql":
+        # GET_LOCK returns 0 on timeout and NULL on error, rather than raising
+        row = await cur.fetchone()
+        if not row or row[0] != 1:
+            raise RuntimeError("Timed out waiting for another process to "
+                               "finish migrating the database")
+    try:
+        await cur.execute(_select_versions)
+        if migration.version in {row[0] for row in await cur.fetchall()}:
+            await cur.execute(unlock)
+            return False
+        for statement in migration.statements():
+            await _execute(cur, backend, statement)
+        await cur.execute(_insert_version, (migration.version,
+                                            migration.name, time.time()))
+    except BaseException:
+        await cur.execute("ROLLBACK;" if backend == "sqlite" else unlock)
+        raise
+    await cur.execute(unlock)
+    return True
+
+
+async def migrate(pool, backend: str, directory: str = MIGRATIONS_DIR,
+                  target: Optional[int] = None) -> List[int]:
+    """
+    Apply every migration which has not been applied to the database yet.
+
+    :param pool: Connection pool of the database to migrate
+    :param backend: Name of the database backend, either "mysql" or "sqlite"
+    :param directory: Folder containing a folder of migrations for each
+    backend
+    :param target: Last version to apply, or None to apply every version
+    :return: List of versions applied
+    """
+    migrations = find_migrations(path.join(directory, backend))
+    applied = []
+
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(_create_schema_version)
+            await cur.execute(_select_versions)
+            done = {row[0] for row in await cur.fetchall()}
+
+            for migration in migrations:
+                if target is not None and migration.version > target:
+                    break
+                if migration.version in done:
+                    continue
+                if await _apply(cur, backend, migration):
+                    applied.append(migration.version)
+                    print(f"Applied migration {migration.version} "
+                          f"({migration.name})")
+
+    return applied
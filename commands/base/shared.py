@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import annotations
+
+import asyncio
+import mmap
+import os
+import struct
+import time
+from array import array
+from bisect import bisect_left
+from typing import (Any, AsyncIterator, Callable, Dict, Hashable, List,
+                    Optional, Tuple)
+
+from .database import Database as db
+from .invalidation import Invalidation
+
+SHARED_MAGIC = b"42SHARE\0"
+SHARED_VERSION = 1
+# Magic, version, the time the build started and the number of sections
+_header = struct.Struct("<8sIdI")
+# Name, number of keys, and the offsets of the keys, value offsets and values
+_section = struct.Struct("<16sQQQQ")
+
+# Defaults for the "shared_settings" config
+SHARED_PATH = "settings.shared"
+BUILD_INTERVAL = 300.0
+CHECK_INTERVAL = 10.0
+# Time before a build started from which changes may not be in it, covering
+# delayed write-behind flushes and invalidations
+DIRTY_MARGIN = 60.0
+
+Build = Callable[[], AsyncIterator[Tuple[int, bytes]]]
+
+_missing = object()
+
+
+async def grouped(query, encode: Callable[[List[Any]], bytes]
+                  ) -> AsyncIterator[Tuple[int, bytes]]:
+    """
+    Stream rows of (key, value) ordered by key, yielding each key with its
+    values encoded as bytes. Used to build sections.
+
+    :param query: SQL query or registered query returning (key, value) rows
+    :param encode: Function encoding the list of values of a key
+    :return: Async generator of keys and encoded values
+    """
+    key = None
+    values = []
+    async for row_key, value in db.stream(query):
+        if row_key != key and values:
+            yield key, encode(values)
+            values = []
+        key = row_key
+        values.append(value)
+    if values:
+        yield key, encode(values)
+
+
+def _align(offset: int) -> int:
+    return (offset + 7) & ~7
+
+
+class SharedSettings:
+    """
+    Class used to share one read-only copy of every guild's settings between
+    every bot process on a host.
+
+    One process, with "builder" set in the "shared_settings" config, reads
+    every settings table every `build_interval' seconds and writes them to a
+    file, with one section per table. Each section holds a sorted array of
+    IDs, an array of offsets, and the encoded settings of each ID. Every
+    process maps the file into memory and finds IDs by bisecting the array in
+    place, so the settings are held in memory once, however many processes
+    read them, and a lookup never needs to query the database. An ID missing
+    from a section has no settings.
+
+    Settings changed after a build started are not in the file, so every
+    change published to Invalidation, by this process or another, marks its
+    key dirty. Dirty keys are looked up as usual, until a build started at
+    least `margin' seconds after the change is mapped.
+    """
+    __slots__ = []
+    enabled = False
+    builder = False
+    path = SHARED_PATH
+    build_interval = BUILD_INTERVAL
+    check_interval = CHECK_INTERVAL
+    margin = DIRTY_MARGIN
+    built = 0.0
+    builds: Dict[str, Build] = {}
+    sections: Dict[str, Tuple[memoryview, memoryview, memoryview]] = {}
+    dirty: Dict[str, Dict[Hashable, float]] = {}
+    hits = 0
+    misses = 0
+    _map: Optional[mmap.mmap] = None
+    _view: Optional[memoryview] = None
+    _stat: Optional[Tuple[int, int]] = None
+    _task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def configure(cls, config: Dict[str, Any]):
+        """
+        Set the shared settings options from the bot config.
+
+        :param config: Bot config, containing the optional "shared_settings"
+        entry
+        """
+        options = config.get("shared_settings", {})
+        cls.enabled = options.get("enabled", False)
+        cls.builder = options.get("builder", False)
+        cls.path = options.get("path", SHARED_PATH)
+        cls.build_interval = options.get("build_interval", BUILD_INTERVAL)
+        cls.check_interval = options.get("check_interval", CHECK_INTERVAL)
+        cls.margin = options.get("margin", DIRTY_MARGIN)
+
+    @classmethod
+    def register(cls, name: str, build: Build):
+        """
+        Register a section of the file.
+
+        :param name: Unique name of the section, which is the name of the
+        table published to Invalidation when its settings change
+        :param build: Async generator function yielding every ID with
+        settings, in increasing order, along with its encoded settings
+        """
+        if name in cls.builds:
+            raise ValueError(f"Section \"{name}\" is already registered")
+        if len(name.encode()) > 16:
+            raise ValueError(f"Section name \"{name}\" is too long")
+        cls.builds[name] = build
+
+    @classmethod
+    def lookup(cls, name: str, key: int) -> Any:
+        """
+        Find the encoded settings of an ID in a section.
+
+        :param name: Name of the section
+        :param key: ID to find
+        :return: Encoded settings, None if the ID has no settings, or _missing
+        if the file cannot answer, because it is not mapped, does not have
+        the section, or the key is dirty
+        """
+        section = cls.sections.get(name)
+        if section is None or key in cls.dirty.get(name, ()):
+            return _missing
+        keys, offsets, data = section
+        i = bisect_left(keys, key)
+        if i == len(keys) or keys[i] != key:
+            cls.misses += 1
+            return None
+        cls.hits += 1
+        return data[offsets[i]:offsets[i + 1]]
+
+    @classmethod
+    def is_active(cls, name: str) -> bool:
+        """
+        Return if the file is mapped and has the given section.
+        """
+        return name in cls.sections
+
+    @classmethod
+    def is_dirty(cls, name: str, key: Hashable) -> bool:
+        """
+        Return if the given key may have changed since the file was built.
+        """
+        return key in cls.dirty.get(name, ())
+
+    @classmethod
+    def mark_dirty(cls, name: str, key: Hashable):
+        """
+        Record that the given key has changed, so is not read from the file.
+        """
+        if cls.enabled and name in cls.builds:
+            cls.dirty.setdefault(name, {})[key] = time.time()
+
+    @classmethod
+    def map(cls) -> bool:
+        """
+        Map the file if it exists and has changed since it was last mapped.
+
+        :return: Whether a new file was mapped
+        """
+        if not cls.enabled:
+            return False
+        try:
+            stat = os.stat(cls.path)
+        except FileNotFoundError:
+            return False
+        if (stat.st_mtime_ns, stat.st_ino) == cls._stat:
+            return False
+
+        with open(cls.path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapped)
+        try:
+            magic, version, built, count = _header.unpack_from(view)
+            if magic != SHARED_MAGIC or version != SHARED_VERSION:
+                raise ValueError("unknown format")
+            sections = {}
+            for i in range(count):
+                name, size, keys, offsets, data = _section.unpack_from(
+                    view, _header.size + i * _section.size)
+                offsets_view = view[offsets:offsets + 8 * (size + 1)].cast("Q")
+                sections[name.rstrip(b"\0").decode()] = (
+                    view[keys:keys + 8 * size].cast("Q"), offsets_view,
+                    view[data:data + offsets_view[size]])
+        except (struct.error, ValueError, TypeError) as e:
+            view.release()
+            mapped.close()
+            print(f"Failed to map shared settings: {e}")
+            return False
+
+        cls._unmap()
+        cls._map = mapped
+        cls._view = view
+        cls._stat = (stat.st_mtime_ns, stat.st_ino)
+        cls.sections = sections
+        cls.built = built
+        # Changes from well before the build started are now in the file
+        cutoff = built - cls.margin
+        for keys in cls.dirty.values():
+            for key in [key for key, changed in keys.items()
+                        if changed < cutoff]:
+                del keys[key]
+        return True
+
+    @classmethod
+    def _unmap(cls):
+        for section in cls.sections.values():
+            for view in section:
+                view.release()
+        cls.sections = {}
+        if cls._view is not None:
+            cls._view.release()
+            cls._view = None
+        if cls._map is not None:
+            try:
+                cls._map.close()
+            except BufferError:
+                # A lookup result is still referenced, so leave the file to
+                # be unmapped once it is garbage collected
+                pass
+            cls._map = None
+        cls._stat = None
+
+    @classmethod
+    async def build(cls):
+        """
+        Read every registered section from the database and replace the file
+        with them.
+        """
+        started = time.time()
+        built = []
+        for name, build in cls.builds.items():
+            keys = array("Q")
+            offsets = array("Q", [0])
+            data = bytearray()
+            async for key, value in build():
+                keys.append(key)
+                data += value
+                offsets.append(len(data))
+            built.append((name, keys, offsets, data))
+
+        # Write to a temporary file first, so readers never map half a file
+        temp = cls.path + ".tmp"
+        with open(temp, "wb") as f:
+            f.write(_header.pack(SHARED_MAGIC, SHARED_VERSION, started,
+                                 len(built)))
+            position = _align(_header.size + len(built) * _section.size)
+            table = []
+            for name, keys, offsets, data in built:
+                keys_at = position
+                offsets_at = _align(keys_at + 8 * len(keys))
+                data_at = _align(offsets_at + 8 * len(offsets))
+                position = _align(data_at + len(data))
+                table.append((name, keys, offsets, data, keys_at,
+                              offsets_at, data_at))
+                f.write(_section.pack(name.encode(), len(keys), keys_at,
+                                      offsets_at, data_at))
+            for name, keys, offsets, data, keys_at, offsets_at, data_at \
+                    in table:
+                for at, chunk in ((keys_at, keys.tobytes()),
+                                  (offsets_at, offsets.tobytes()),
+                                  (data_at, bytes(data))):
+                    f.write(b"\0" * (at - f.tell()))
+                    f.write(chunk)
+        os.replace(temp, cls.path)
+        print(f"Built shared settings in {time.time() - started:.2f}s")
+
+    @classmethod
+    async def start(cls):
+        """
+        Map the file, and keep mapping newer files, building them first if
+        this process is the builder. This must be awaited once the database
+        is available.
+        """
+        if not cls.enabled or cls._task is not None:
+            return
+        cls.map()
+        cls._task = asyncio.ensure_future(cls._run())
+
+    @classmethod
+    def close(cls):
+        """
+        Stop building and mapping files, and unmap the current file.
+        """
+        if cls._task is not None:
+            cls._task.cancel()
+            cls._task = None
+        cls._unmap()
+
+    @classmethod
+    def stats(cls) -> Dict[str, Any]:
+        """
+        Retrieve statistics on the mapped file.
+
+        :return: Dict of statistics
+        """
+        return {
+            "built": cls.built,
+            "size": len(cls._map) if cls._map is not None else 0,
+            "keys": {name: len(section[0])
+                     for name, section in cls.sections.items()},
+            "dirty": {name: len(keys) for name, keys in cls.dirty.items()},
+            "hits": cls.hits,
+            "misses": cls.misses
+        }
+
+    @classmethod
+    async def _run(cls):
+        last_build = 0.0
+        while True:
+            if cls.builder and \
+                    time.monotonic() - last_build >= cls.build_interval:
+                last_build = time.monotonic()
+                try:
+                    await cls.build()
+                except Exception as e:
+                    print(f"Failed to build shared settings: {e}")
+            cls.map()
+            await asyncio.sleep(cls.check_interval)
+
+
+# Every change is dirty, whether made by this process or another
+Invalidation.watchers.append(SharedSettings.mark_dirty)
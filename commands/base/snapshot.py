@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import annotations
+
+import asyncio
+import os
+import pickle
+import struct
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+SNAPSHOT_MAGIC = b"42CACHE\0"
+SNAPSHOT_VERSION = 1
+# Magic, version and the time the snapshot was taken
+_header = struct.Struct("<8sId")
+
+# Defaults for the "snapshot" config
+SNAPSHOT_PATH = "cache.snapshot"
+MAX_AGE = 86400.0
+REVALIDATE_WINDOW = 300.0
+REVALIDATE_BATCH = 50
+# Longest wait between batches, so small caches are revalidated quickly
+MAX_BATCH_DELAY = 1.0
+
+Dump = Callable[[], Any]
+Restore = Callable[[Any], List[Any]]
+Revalidate = Callable[[List[Any]], Awaitable[None]]
+
+
+class Snapshot:
+    """
+    Class used to keep the settings caches warm across restarts.
+
+    Each cache registers a function to dump its contents, one to restore
+    them, returning the keys restored, and one to reload a list of keys from
+    the database. On a graceful shutdown the contents of every cache are saved
+    to a binary file, which is restored on the next start before connecting to
+    Discord, as long as it is newer than `max_age' seconds.
+
+    Restored entries may be stale, so once the database is connected every
+    restored key is reloaded in the background in small batches, spread over
+    at most `revalidate_window' seconds.
+    """
+    __slots__ = []
+    enabled = False
+    path = SNAPSHOT_PATH
+    max_age = MAX_AGE
+    revalidate_window = REVALIDATE_WINDOW
+    caches: Dict[str, Tuple[Dump, Restore, Revalidate]] = {}
+    restored: Dict[str, List[Any]] = {}
+    _revalidate_task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def configure(cls, config: Dict[str, Any]):
+        """
+        Set the snapshot options from the bot config.
+
+        :param config: Bot config, containing the optional "snapshot" entry
+        """
+        options = config.get("snapshot", {})
+        cls.enabled = options.get("enabled", False)
+        cls.path = options.get("path", SNAPSHOT_PATH)
+        cls.max_age = options.get("max_age", MAX_AGE)
+        cls.revalidate_window = options.get("revalidate_window",
+                                            REVALIDATE_WINDOW)
+
+    @classmethod
+    def register(cls, name: str, dump: Dump, restore: Restore,
+                 revalidate: Revalidate):
+        """
+        Register a cache to be saved in snapshots.
+
+        :param name: Unique name of the cache in snapshots
+        :param dump: Function returning the contents of the cache, which must
+        be picklable
+        :param restore: Function adding dumped contents to the cache, returning
+        the list of keys restored
+        :param revalidate: Coroutine function reloading the given keys from
+        the database. It must drop every key from the cache before reloading
+        any of them, so that keys are not left stale if reloading fails.
+        """
+        if name in cls.caches:
+            raise ValueError(f"Cache \"{name}\" is already registered")
+        cls.caches[name] = (dump, restore, revalidate)
+
+    @classmethod
+    def save(cls):
+        """
+        Save the contents of every registered cache to the snapshot file.
+        """
+        if not cls.enabled:
+            return
+        data = {}
+        for name, (dump, _, _) in cls.caches.items():
+            try:
+                data[name] = dump()
+            except Exception as e:
+                print(f"Failed to dump cache \"{name}\": {e}")
+
+        # Write to a temporary file first, so a crash never leaves half a
+        # snapshot behind
+        temp = cls.path + ".tmp"
+        with open(temp, "wb") as f:
+            f.write(_header.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, time.time()))
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, cls.path)
+        print(f"Saved cache snapshot to {cls.path}")
+
+    @classmethod
+    def restore(cls):
+        """
+        Restore the contents of every registered cache from the snapshot file,
+        if it exists, has the current version and is recent enough. The
+        snapshot is removed afterwards, so that it is never restored twice.
+        """
+        if not cls.enabled or not os.path.isfile(cls.path):
+            return
+        try:
+            with open(cls.path, "rb") as f:
+                magic, version, taken = _header.unpack(
+                    f.read(_header.size))
+                if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                    print("Ignoring cache snapshot with an unknown format")
+                    return
+                age = time.time() - taken
+                if age > cls.max_age:
+                    print(f"Ignoring cache snapshot from {age:.0f}s ago")
+                    return
+                data = pickle.load(f)
+        except (OSError, struct.error, pickle.UnpicklingError, EOFError) as e:
+            print(f"Failed to read cache snapshot: {e}")
+            return
+        finally:
+            os.remove(cls.path)
+
+        for name, contents in data.items():
+            if name not in cls.caches:
+                continue
+            try:
+                cls.restored[name] = cls.caches[name][1](contents)
+            except Exception as e:
+                print(f"Failed to restore cache \"{name}\": {e}")
+        count = sum(len(keys) for keys in cls.restored.values())
+        print(f"Restored {count} cache entries from {age:.0f}s ago")
+
+    @classmethod
+    async def start(cls):
+        """
+        Start revalidating restored entries in the background. This must be
+        awaited once the database is available.
+        """
+        if cls.restored and cls._revalidate_task is None:
+            cls._revalidate_task = asyncio.ensure_future(cls._revalidate())
+
+    @classmethod
+    async def _revalidate(cls):
+        batches = []
+        for name, keys in cls.restored.items():
+            revalidate = cls.caches[name][2]
+            for i in range(0, len(keys), REVALIDATE_BATCH):
+                batches.append((name, revalidate,
+                                keys[i:i + REVALIDATE_BATCH]))
+        cls.restored = {}
+        if not batches:
+            return
+
+        delay = min(cls.revalidate_window / len(batches), MAX_BATCH_DELAY)
+        for name, revalidate, keys in batches:
+            try:
+                await revalidate(keys)
+            except Exception as e:
+                print(f"Failed to revalidate cache \"{name}\": {e}")
+            await asyncio.sleep(delay)
+        cls._revalidate_task = None
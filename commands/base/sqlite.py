@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite backend for the Database class.
+
+This module provides a connection pool with the same interface as the parts
+of aiomysql used by Database, running each connection on its own worker
+thread. Queries are written for MySQL, and are translated to SQLite by a small
+dialect layer covering the MySQL-only constructs used by the framework.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import re
+import sqlite3
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from os import path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+SCHEMA = "create_db.sqlite.sql"
+
+# Messages of sqlite3 errors meaning the database itself could not be used,
+# rather than that the query was wrong
+_unavailable_messages = ("database is locked", "disk i/o error",
+                         "unable to open database")
+
+
+class OperationalError(sqlite3.OperationalError):
+    """
+    Exception raised in place of sqlite3.OperationalError when the database
+    cannot be used, as aiomysql raises OperationalError when the server
+    cannot be reached.
+    """
+    pass
+
+
+class InterfaceError(sqlite3.ProgrammingError):
+    """
+    Exception raised when a connection is used after being closed, as
+    aiomysql raises InterfaceError for closed connections.
+    """
+    pass
+
+
+# - Dialect ------------------------------------------------------------
+
+def _toggle_toggle(conn: sqlite3.Connection, guild: int, cmd: str) -> int:
+    """
+    Equivalent of the toggle_toggle stored procedure in create_db.sql.
+    """
+    if guild is None or cmd is None:
+        return 0
+    cur = conn.execute("""
+        DELETE FROM toggles
+        WHERE guild_id = ? AND command = ?
+    """, (guild, cmd))
+    if cur.rowcount == 0:
+        cur = conn.execute("""
+            INSERT OR IGNORE INTO toggles
+            VALUES (?, ?)
+        """, (guild, cmd))
+    return cur.rowcount
+
+
+# Stored procedures, implemented in python
+procedures: Dict[str, Callable[..., int]] = {
+    "toggle_toggle": _toggle_toggle
+}
+
+_call = re.compile(r"^\s*CALL\s+(\w+)\s*\(.*\)\s*;?\s*$", re.I | re.S)
+_insert_ignore = re.compile(r"\bINSERT\s+IGNORE\b", re.I)
+_on_duplicate = re.compile(r"\bON\s+DUPLICATE\s+KEY\s+UPDATE\b", re.I)
+_values_function = re.compile(r"\bVALUES\s*\(\s*(\w+)\s*\)", re.I)
+_for_update = re.compile(r"\bFOR\s+UPDATE\b", re.I)
+
+
+@lru_cache(maxsize=256)
+def translate(sql: str) -> Union[str, Callable[..., int]]:
+    """
+    Translate a MySQL query into SQLite. This covers:
+
+    - CALL of the stored procedures defined in create_db.sql, which are
+      returned as python functions instead of SQL
+    - INSERT IGNORE, which becomes INSERT OR IGNORE
+    - ON DUPLICATE KEY UPDATE, which becomes an upsert, with VALUES(column)
+      becoming excluded.column. This requires SQLite 3.35 or later.
+    - SELECT ... FOR UPDATE, as SQLite locks the whole database instead
+    - %s placeholders, which become ?
+
+    :param sql: MySQL query
+    :return: SQLite query, or procedure function
+    """
+    call = _call.match(sql)
+    if call is not None:
+        return procedures[call.group(1).lower()]
+
+    sql = _insert_ignore.sub("INSERT OR IGNORE", sql)
+    duplicate = _on_duplicate.search(sql)
+    if duplicate is not None:
+        update = _values_function.sub(r"excluded.\1",
+                                      sql[duplicate.end():])
+        sql = sql[:duplicate.start()] + "ON CONFLICT DO UPDATE SET" + update
+    sql = _for_update.sub("", sql)
+    return sql.replace("%s", "?").replace("%%", "%")
+
+
+# - Pool ---------------------------------------------------------------
+
+class Cursor:
+    """
+    Class used to represent a cursor on a pooled SQLite connection.
+    """
+    __slots__ = ["_conn", "_rows", "_pos", "rowcount"]
+
+    def __init__(self, conn: Connection) -> None:
+        self._conn = conn
+        self._rows: List[Tuple[Any, ...]] = []
+        self._pos = 0
+        self.rowcount = -1
+
+    async def __aenter__(self) -> Cursor:
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        self._rows = []
+
+    def _run(self, sql: str, data_groups: Sequence[Sequence[Any]]
+             ) -> Tuple[List[Tuple[Any, ...]], int]:
+        conn = self._conn.raw
+        query = translate(sql)
+        rows = []
+        rowcount = 0
+        for data in data_groups:
+            if callable(query):
+                rowcount += query(conn, *data)
+            else:
+                cur = conn.execute(query, tuple(data))
+                rows = cur.fetchall()
+                rowcount += max(cur.rowcount, 0) if not rows else len(rows)
+        return rows, rowcount
+
+    async def execute(self, sql: str, data: Sequence[Any] = ()) -> int:
+        self._rows, self.rowcount = await self._conn.run(self._run, sql,
+                                                         [data])
+        self._pos = 0
+        return self.rowcount
+
+    async def executemany(self, sql: str,
+                          data_groups: Sequence[Sequence[Any]]) -> int:
+        self._rows, self.rowcount = await self._conn.run(self._run, sql,
+                                                         data_groups)
+        self._pos = 0
+        return self.rowcount
+
+    async def fetchone(self) -> Optional[Tuple[Any, ...]]:
+        if self._pos >= len(self._rows):
+            return None
+        self._pos += 1
+        return self._rows[self._pos - 1]
+
+    async def fetchmany(self, size: int = 1) -> List[Tuple[Any, ...]]:
+        rows = self._rows[self._pos:self._pos + size]
+        self._pos += len(rows)
+        return rows
+
+    async def fetchall(self) -> List[Tuple[Any, ...]]:
+        rows = self._rows[self._pos:]
+        self._pos = len(self._rows)
+        return rows
+
+
+class SSCursor:
+    """
+    Class used to represent an unbuffered cursor on a pooled SQLite
+    connection, which reads rows from SQLite as they are fetched, like
+    aiomysql.SSCursor.
+    """
+    __slots__ = ["_conn", "_cur", "rowcount"]
+
+    def __init__(self, conn: Connection) -> None:
+        self._conn = conn
+        self._cur: Optional[sqlite3.Cursor] = None
+        self.rowcount = -1
+
+    async def __aenter__(self) -> SSCursor:
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    def _run(self, sql: str, data: Sequence[Any]) -> sqlite3.Cursor:
+        query = translate(sql)
+        if callable(query):
+            raise sqlite3.NotSupportedError(
+                "Procedures cannot be run on an unbuffered cursor")
+        return self._conn.raw.execute(query, tuple(data))
+
+    async def execute(self, sql: str, data: Sequence[Any] = ()) -> int:
+        await self.close()
+        self._cur = await self._conn.run(self._run, sql, data)
+        return self.rowcount
+
+    async def fetchone(self) -> Optional[Tuple[Any, ...]]:
+        rows = await self.fetchmany(1)
+        return rows[0] if rows else None
+
+    async def fetchmany(self, size: int = 1) -> List[Tuple[Any, ...]]:
+        if self._cur is None:
+            return []
+        return await self._conn.run(self._cur.fetchmany, size)
+
+    async def fetchall(self) -> List[Tuple[Any, ...]]:
+        if self._cur is None:
+            return []
+        return await self._conn.run(self._cur.fetchall)
+
+    async def close(self) -> None:
+        if self._cur is not None:
+            await self._conn.run(self._cur.close)
+            self._cur = None
+
+
+class Connection:
+    """
+    Class used to represent a single SQLite connection, which is only ever
+    used from its own worker thread.
+    """
+    __slots__ = ["raw", "_executor"]
+
+    def __init__(self) -> None:
+        self.raw: Optional[sqlite3.Connection] = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    async def run(self, func: Callable[..., Any], *args: Any) -> Any:
+        """
+        Run a function on this connection's worker thread.
+
+        :param func: Function to run
+        :param args: Arguments to pass to the function
+        :return: Return value of the function
+        """
+        loop = asyncio.get_event_loop()
+        try:
+            return await loop.run_in_executor(self._executor, func, *args)
+        except sqlite3.OperationalError as e:
+            if str(e).lower().startswith(_unavailable_messages):
+                raise OperationalError(*e.args) from e
+            raise
+        except sqlite3.ProgrammingError as e:
+            if "closed" in str(e):
+                raise InterfaceError(*e.args) from e
+            raise
+
+    async def open(self, database: str, schema: Optional[str]) -> None:
+        def connect():
+            # isolation_level=None leaves the connection in autocommit mode
+            self.raw = sqlite3.connect(database, isolation_level=None)
+            if database != ":memory:":
+                self.raw.execute("PRAGMA journal_mode=WAL")
+            self.raw.execute("PRAGMA busy_timeout=5000")
+            if schema is not None:
+                with open(schema) as f:
+                    self.raw.executescript(f.read())
+
+        await self.run(connect)
+
+    def cursor(self, cursor_class: Optional[type] = None
+               ) -> Union[Cursor, SSCursor]:
+        return (cursor_class or Cursor)(self)
+
+    async def begin(self) -> None:
+        # Take the write lock up front, so that a transaction which reads
+        # before writing cannot fail to upgrade its lock
+        await self.run(self.raw.execute, "BEGIN IMMEDIATE")
+
+    async def commit(self) -> None:
+        await self.run(self.raw.execute, "COMMIT")
+
+    async def rollback(self) -> None:
+        await self.run(self.raw.execute, "ROLLBACK")
+
+    async def close(self) -> None:
+        if self.raw is not None:
+            await self.run(self.raw.close)
+        self._executor.shutdown(wait=False)
+
+
+class _Acquire:
+    __slots__ = ["_pool", "_conn"]
+
+    def __init__(self, pool: Pool) -> None:
+        self._pool = pool
+        self._conn = None
+
+    async def __aenter__(self) -> Connection:
+        self._conn = await self._pool._acquire()
+        return self._conn
+
+    async def __aexit__(self, *exc_info) -> None:
+        self._pool._release(self._conn)
+
+
+class Pool:
+    """
+    Class used to represent a pool of SQLite connections to one database file.
+    """
+
+    def __init__(self, database: str, minsize: int, maxsize: int,
+                 schema: Optional[str]) -> None:
+        if database == ":memory:":
+            # Each connection would otherwise get its own empty database
+            minsize = maxsize = 1
+        self.database = database
+        self.schema = schema
+        self.minsize = minsize
+        self.maxsize = max(maxsize, 1)
+        self.size = 0
+        self._free: deque = deque()
+        self._used = set()
+        self._cond = asyncio.Condition()
+        self._closed = False
+
+    @property
+    def freesize(self) -> int:
+        return len(self._free)
+
+    async def _open(self) -> Connection:
+        conn = Connection()
+        self.size += 1
+        try:
+            # Only the first connection needs to create the schema
+            await conn.open(self.database,
+                            self.schema if self.size == 1 else None)
+        except BaseException:
+            self.size -= 1
+            raise
+        return conn
+
+    async def _fill(self) -> None:
+        while self.size < self.minsize:
+            self._free.append(await self._open())
+
+    async def _acquire(self) -> Connection:
+        async with self._cond:
+            while True:
+                if self._closed:
+                    raise RuntimeError("Cannot acquire from a closed pool")
+                if self._free:
+                    conn = self._free.popleft()
+                    break
+                if self.size < self.maxsize:
+                    conn = await self._open()
+                    break
+                await self._cond.wait()
+            self._used.add(conn)
+            return conn
+
+    def _release(self, conn: Connection) -> None:
+        self._used.discard(conn)
+        self._free.append(conn)
+        asyncio.ensure_future(self._notify())
+
+    async def _notify(self) -> None:
+        async with self._cond:
+            self._cond.notify()
+
+    def acquire(self) -> _Acquire:
+        return _Acquire(self)
+
+    def close(self) -> None:
+        self._closed = True
+
+    async def wait_closed(self) -> None:
+        while self._free:
+            await self._free.popleft().close()
+        for conn in list(self._used):
+            await conn.close()
+        self._used.clear()
+        self.size = 0
+
+
+async def create_pool(database: str, minsize: int = 1, maxsize: int = 10,
+                      schema: Optional[str] = SCHEMA,
+                      **options: Any) -> Pool:
+    """
+    Create a pool of connections to an SQLite database, creating any missing
+    tables with the given schema.
+
+    :param database: Path to the database file, or ":memory:"
+    :param minsize: Number of connections to open immediately
+    :param maxsize: Maximum number of connections to open
+    :param schema: Path to an SQL script creating the database schema, or
+    None to leave the database as it is
+    :param options: Other aiomysql pool options, which are ignored
+    :return: Connection pool
+    """
+    if schema is not None and not path.isfile(schema):
+        raise FileNotFoundError(f"No SQLite schema found at \"{schema}\"")
+    pool = Pool(database, minsize, maxsize, schema)
+    await pool._fill()
+    return pool
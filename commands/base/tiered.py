@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import annotations
+
+import asyncio
+import pickle
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+import cachetools
+
+from .cache import StaleLFUCache
+from .invalidation import Invalidation
+from .shared import SharedSettings, _missing
+
+# Defaults for the "l2_cache" config
+L2_PATH = "cache.l2.sqlite3"
+L2_MAX_AGE = 86400.0
+# Number of decoded SharedSettings entries kept by each TieredCache
+SHARED_HOT_SIZE = 64
+
+_schema = """
+    CREATE TABLE IF NOT EXISTS entries (
+        namespace TEXT NOT NULL,
+        cache_key BLOB NOT NULL,
+        value BLOB NOT NULL,
+        stored REAL NOT NULL,
+        PRIMARY KEY (namespace, cache_key)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS meta (
+        name TEXT NOT NULL PRIMARY KEY,
+        value
+    );
+"""
+
+Encode = Callable[[Hashable, Any], Any]
+Decode = Callable[[Hashable, Any], Any]
+Load = Callable[[Hashable, Optional[memoryview]], Any]
+
+
+def _dump_key(key: Hashable) -> bytes:
+    return pickle.dumps(key, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+class L2Store:
+    """
+    Class used to hold the settings evicted from the in-memory caches in a
+    local SQLite file, between those caches and the database.
+
+    Each TieredCache evicts its least frequently used entries here rather
+    than dropping them, and looks here before querying the database. Entries
+    only live in one tier at a time, so that changes made in memory never
+    leave an older copy on disk. Entries older than `max_age' seconds are
+    ignored.
+
+    The file is only used from its own thread, so the event loop never waits
+    for the disk. Writes are queued to that thread without waiting, and
+    reads wait for every write queued before them.
+
+    The file outlives the bot, so changes made by other processes while it
+    was stopped are caught up on by replaying their invalidations in
+    L2Store.start(). If they cannot all be replayed, the file is cleared.
+    """
+    __slots__ = []
+    enabled = False
+    path = L2_PATH
+    max_age = L2_MAX_AGE
+    # Only used by the L2 thread
+    conn: Optional[sqlite3.Connection] = None
+    caches: Dict[str, TieredCache] = {}
+    _executor: Optional[ThreadPoolExecutor] = None
+
+    @classmethod
+    def configure(cls, config: Dict[str, Any]):
+        """
+        Set the L2 cache options from the bot config.
+
+        :param config: Bot config, containing the optional "l2_cache" entry
+        """
+        options = config.get("l2_cache", {})
+        cls.enabled = options.get("enabled", False)
+        cls.path = options.get("path", L2_PATH)
+        cls.max_age = options.get("max_age", L2_MAX_AGE)
+
+    @classmethod
+    def open(cls) -> bool:
+        """
+        Start the thread using the file if it is enabled and not started yet,
+        which opens the file and drops expired entries. This is called
+        automatically by the first lookup.
+
+        :return: Whether the file is enabled
+        """
+        if not cls.enabled:
+            return False
+        if cls._executor is None:
+            cls._executor = ThreadPoolExecutor(max_workers=1)
+            cls._submit(cls._open)
+        return True
+
+    @classmethod
+    def _open(cls):
+        conn = sqlite3.connect(cls.path, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # The file is only a cache, so commits need not wait for the disk
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_schema)
+        conn.execute("DELETE FROM entries WHERE stored < ?",
+                     (time.time() - cls.max_age,))
+        cls.conn = conn
+
+    @classmethod
+    def _submit(cls, func: Callable[..., Any], *args: Any):
+        """
+        Queue a function to the L2 thread without waiting for it.
+        """
+        if cls.open():
+            cls._executor.submit(cls._logged, func, *args)
+
+    @classmethod
+    async def _run(cls, func: Callable[..., Any], *args: Any) -> Any:
+        """
+        Run a function in the L2 thread and wait for its result, which is
+        _missing if it fails.
+        """
+        if not cls.open():
+            return _missing
+        return await asyncio.get_event_loop().run_in_executor(
+            cls._executor, cls._logged, func, *args)
+
+    @classmethod
+    def _logged(cls, func: Callable[..., Any], *args: Any) -> Any:
+        if cls.conn is None and func != cls._open:
+            # The file could not be opened
+            return _missing
+        try:
+            return func(*args)
+        except Exception as e:
+            # The file is only a cache, so errors are treated as misses
+            print(f"L2 cache error: {e}")
+            return _missing
+
+    @classmethod
+    async def start(cls):
+        """
+        Evict every entry changed by another process since the bot last
+        stopped. This must be awaited once the database is available, before
+        Invalidation.start().
+        """
+        if not cls.open() or not Invalidation.enabled:
+            return
+        since = await cls.get_meta("last_invalidation")
+        if since is None or since is _missing or \
+                not await Invalidation.replay(since):
+            print("Clearing L2 cache, as changes since it was written are "
+                  "unknown")
+            cls.clear()
+
+    @classmethod
+    def close(cls):
+        """
+        Record how far invalidations have been applied, and close the file
+        once every queued write is done.
+        """
+        if cls._executor is None:
+            return
+        if Invalidation.last_id is not None:
+            cls.set_meta("last_invalidation", Invalidation.last_id)
+        cls._submit(cls._close)
+        cls._executor.shutdown(wait=True)
+        cls._executor = None
+
+    @classmethod
+    def _close(cls):
+        cls.conn.close()
+        cls.conn = None
+
+    @classmethod
+    async def get(cls, namespace: str, key: Hashable) -> Any:
+        """
+        Remove an entry from the file and return its value.
+
+        :param namespace: Namespace of the cache holding the entry
+        :param key: Key of the entry
+        :return: Stored value, or _missing if not found
+        """
+        return await cls._run(cls._get, namespace, _dump_key(key))
+
+    @classmethod
+    def _get(cls, namespace: str, dumped: bytes) -> Any:
+        row = cls.conn.execute("""
+            SELECT value, stored FROM entries
+            WHERE namespace = ? AND cache_key = ?
+        """, (namespace, dumped)).fetchone()
+        if row is None:
+            return _missing
+        cls.conn.execute("""
+            DELETE FROM entries
+            WHERE namespace = ? AND cache_key = ?
+        """, (namespace, dumped))
+        if row[1] < time.time() - cls.max_age:
+            return _missing
+        return pickle.loads(row[0])
+
+    @classmethod
+    def set(cls, namespace: str, key: Hashable, value: Any):
+        """
+        Queue an entry to be stored in the file.
+
+        :param namespace: Namespace of the cache holding the entry
+        :param key: Key of the entry
+        :param value: Picklable value to store
+        """
+        if not cls.open():
+            return
+        # Pickled now, as the value may change before the thread stores it
+        cls._submit(cls._set, namespace, _dump_key(key),
+                    pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL),
+                    time.time())
+
+    @classmethod
+    def _set(cls, namespace: str, dumped: bytes, value: bytes,
+             stored: float):
+        cls.conn.execute("""
+            INSERT OR REPLACE INTO entries
+            VALUES (?, ?, ?, ?)
+        """, (namespace, dumped, value, stored))
+
+    @classmethod
+    def delete(cls, namespace: str, key: Hashable):
+        """
+        Queue an entry to be removed from the file, if it is there.
+        """
+        if not cls.open():
+            return
+        cls._submit(cls._delete, namespace, _dump_key(key))
+
+    @classmethod
+    def _delete(cls, namespace: str, dumped: bytes):
+        cls.conn.execute("""
+            DELETE FROM entries
+            WHERE namespace = ? AND cache_key = ?
+        """, (namespace, dumped))
+
+    @classmethod
+    def clear(cls, namespace: Optional[str] = None):
+        """
+        Queue every entry in a namespace, or in every namespace, to be
+        removed.
+        """
+        cls._submit(cls._clear, namespace)
+
+    @classmethod
+    def _clear(cls, namespace: Optional[str]):
+        if namespace is None:
+            cls.conn.execute("DELETE FROM entries")
+        else:
+            cls.conn.execute("DELETE FROM entries WHERE namespace = ?",
+                             (namespace,))
+
+    @classmethod
+    async def get_meta(cls, name: str) -> Any:
+        return await cls._run(cls._get_meta, name)
+
+    @classmethod
+    def _get_meta(cls, name: str) -> Any:
+        row = cls.conn.execute("SELECT value FROM meta WHERE name = ?",
+                               (name,)).fetchone()
+        return None if row is None else row[0]
+
+    @classmethod
+    def set_meta(cls, name: str, value: Any):
+        cls._submit(cls._set_meta, name, value)
+
+    @classmethod
+    def _set_meta(cls, name: str, value: Any):
+        cls.conn.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                         (name, value))
+
+    @classmethod
+    def stats(cls) -> Dict[str, Dict[str, int]]:
+        """
+        Retrieve the hits of each tier of every cache.
+
+        :return: Dict of statistics for each namespace
+        """
+        return {namespace: {
+            "l1_size": len(cache),
+            "l1_hits": cache.l1_hits,
+            "l2_hits": cache.l2_hits,
+            "shared_hits": cache.shared_hits,
+            "misses": cache.misses
+        } for namespace, cache in cls.caches.items()}
+
+
+class TieredCache(StaleLFUCache):
+    """
+    LFU cache which evicts its entries to the L2Store, when it is enabled,
+    rather than keeping them in memory.
+
+    Values can be converted to something else to be stored on disk, such as
+    when they are only meaningful to the running process.
+
+    Caches given a `load' function also read entries from the SharedSettings
+    section named after their namespace, before the L2Store. Those entries
+    are decoded from the mapped file on every lookup, with only the last
+    `SHARED_HOT_SIZE' kept decoded, and are never copied into memory, which
+    then only holds the entries changed since the file was built.
+    """
+
+    def __init__(self, maxsize: int, namespace: str,
+                 encode: Optional[Encode] = None,
+                 decode: Optional[Decode] = None,
+                 load: Optional[Load] = None) -> None:
+        """
+        Initialise the cache.
+
+        :param maxsize: Maximum number of entries in memory
+        :param namespace: Unique name of the cache in the L2Store
+        :param encode: Function converting a key and value to be stored
+        :param decode: Function converting a key and stored value back
+        :param load: Function converting a key and its encoded settings in
+        SharedSettings, or None if it has none, into a value
+        """
+        if namespace in L2Store.caches:
+            raise ValueError(f"Cache \"{namespace}\" is already registered")
+        super().__init__(maxsize)
+        self.namespace = namespace
+        self.encode = encode
+        self.decode = decode
+        self.load = load
+        self.l1_hits = 0
+        self.l2_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        # Token of the lookup of each key waiting for the L2Store, removed
+        # if the key changes before it returns
+        self._reading: Dict[Hashable, object] = {}
+        # Decoded SharedSettings entries, and the build they were decoded from
+        self._hot = cachetools.LRUCache(SHARED_HOT_SIZE)
+        self._hot_built: Optional[float] = None
+        L2Store.caches[namespace] = self
+
+    def __setitem__(self, key: Hashable, value: Any) -> None:
+        super().__setitem__(key, value)
+        self._reading.pop(key, None)
+        # The value on disk, if any, is now out of date
+        L2Store.delete(self.namespace, key)
+
+    def popitem(self) -> Tuple[Hashable, Any]:
+        if not L2Store.enabled:
+            return super().popitem()
+        # Skip StaleLFUCache, as the entry is kept on disk instead
+        key, value = super(StaleLFUCache, self).popitem()
+        L2Store.set(self.namespace, key,
+                    value if self.encode is None else self.encode(key, value))
+        return key, value
+
+    async def lookup(self, key: Hashable) -> Any:
+        """
+        Retrieve an entry from memory, SharedSettings or the L2Store, moving
+        it into memory if it came from the L2Store. Raise KeyError if the key
+        is in none of them.
+
+        :param key: Key of the entry
+        :return: Value of the entry
+        """
+        if self.load is not None and SharedSettings.built != self._hot_built:
+            self._remap()
+        try:
+            value = self[key]
+        except KeyError:
+            pass
+        else:
+            self.l1_hits += 1
+            return value
+
+        if self.load is not None:
+            value = self._lookup_shared(key)
+            if value is not _missing:
+                self.shared_hits += 1
+                return value
+
+        token = self._reading[key] = object()
+        value = await L2Store.get(self.namespace, key)
+        if self._reading.get(key) is not token:
+            # Changed while reading, so the value on disk is out of date
+            value = _missing
+        else:
+            del self._reading[key]
+        if value is not _missing:
+            self.l2_hits += 1
+            if self.decode is not None:
+                value = self.decode(key, value)
+            self[key] = value
+            return value
+
+        self.misses += 1
+        raise KeyError(key)
+
+    def _remap(self):
+        """
+        Drop the entries decoded from an older SharedSettings file, and the
+        entries in memory which the new file holds.
+        """
+        self._hot.clear()
+        self._hot_built = SharedSettings.built
+        if not SharedSettings.is_active(self.namespace):
+            return
+        for key in [key for key in self
+                    if not SharedSettings.is_dirty(self.namespace, key)]:
+            del self[key]
+
+    def _lookup_shared(self, key: Hashable) -> Any:
+        """
+        Decode an entry from SharedSettings, unless it is dirty or the file
+        is not mapped.
+
+        :return: Value of the entry, or _missing if the file cannot answer
+        """
+        # Dirty keys are checked first, as they may be decoded already
+        if SharedSettings.is_dirty(self.namespace, key):
+            return _missing
+        value = self._hot.get(key, _missing)
+        if value is not _missing:
+            return value
+        encoded = SharedSettings.lookup(self.namespace, key)
+        if encoded is _missing:
+            return _missing
+        value = self._hot[key] = self.load(key, encoded)
+        return value
+
+    def discard(self, key: Hashable):
+        """
+        Remove an entry from every tier.
+        """
+        self.pop(key, None)
+        self.stale.pop(key, None)
+        self._reading.pop(key, None)
+        L2Store.delete(self.namespace, key)
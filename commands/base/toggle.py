@@ -1,10 +1,160 @@
 # -*- coding: utf-8 -*-
-from typing import List, Optional
+import json
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
-import cachetools
 from . import db
+from .database import DatabaseUnavailable, Query
+from .command import Command
+from .invalidation import Invalidation
+from .snapshot import Snapshot
+from .shared import SharedSettings, grouped
+from .tiered import TieredCache
+
+TOGGLE_CACHE_SIZE = 20000
+
+# Internal cache of the mask of disabled commands in each guild, with one bit
+# set for the index of each disabled command
+_toggle_cache = TieredCache(TOGGLE_CACHE_SIZE, "toggles")
+# Disabled paths which do not belong to any command, such as those of removed
+# commands, for the guilds that have any
+_unknown_toggles: Dict[int, Set[str]] = {}
+# Value of Command.generation when the cached masks were built
+_toggle_cache_generation = 0
+
+_select_guild_toggles = db.query("toggles.select_guild", """
+    SELECT command FROM toggles
+    WHERE guild_id = %s
+""")
+_select_guild_toggles_under = db.query("toggles.select_guild_under", """
+    SELECT command FROM toggles
+    WHERE guild_id = %s
+      AND (command = %s OR command LIKE %s ESCAPE '!')
+""")
+_select_all_toggles = db.query("toggles.select_all", """
+    SELECT guild_id, command FROM toggles
+    ORDER BY guild_id;
+""")
+
+# Statements with one placeholder, or row of placeholders, per command path,
+# formatted with the placeholders for the number of paths
+_select_toggles_in = ("toggles.select_in", """
+    SELECT command FROM toggles
+    WHERE guild_id = %s
+      AND command IN ({})
+    FOR UPDATE;
+""", "%s")
+_delete_toggles_in = ("toggles.delete_in", """
+    DELETE FROM toggles
+    WHERE guild_id = %s
+      AND command IN ({});
+""", "%s")
+_insert_toggles = ("toggles.insert_many", """
+    INSERT IGNORE INTO toggles
+    (guild_id, command)
+    VALUES {};
+""", "(%s, %s)")
+_sized_queries: Dict[Tuple[str, int], Query] = {}
+
+
+def _escape_like(text: str) -> str:
+    """
+    Escape the wildcards in a string to be matched literally by LIKE, using
+    "!" as the escape character.
+    """
+    return text.replace("!", "!!").replace("%", "!%").replace("_", "!_")
+
+
+def _split_paths(paths: Iterable[str]) -> Tuple[int, Set[str]]:
+    """
+    Convert command paths into a mask of commands, along with the set of paths
+    which do not belong to any command.
+    """
+    mask = 0
+    unknown = set()
+    for path in paths:
+        cmd = Command.registry.get(path)
+        if cmd is None:
+            unknown.add(path)
+        else:
+            mask |= cmd.bit
+    return mask, unknown
+
+
+def _sized_query(statement: Tuple[str, str, str], paths: List[str]
+                 ) -> Tuple[Query, List[str]]:
+    """
+    Retrieve the query for a statement with the given number of paths. The
+    paths are padded to the next power of two by repeating the last one,
+    which does not change the result of any of the statements, so that
+    only a few sizes of each statement are ever registered.
+
+    :return: Query, and the padded list of paths
+    """
+    name, template, placeholder = statement
+    size = 1 << (len(paths) - 1).bit_length()
+    paths = paths + [paths[-1]] * (size - len(paths))
+    try:
+        query = _sized_queries[name, size]
+    except KeyError:
+        query = _sized_queries[name, size] = db.query(
+            f"{name}.{size}", template.format(", ".join([placeholder] * size)))
+    return query, paths
+
 
-_toggle_cache = cachetools.LFUCache(100)
+def _mask_paths(mask: int) -> List[str]:
+    """
+    Convert a mask of commands into their paths, in order of index.
+    """
+    ret = []
+    while mask:
+        low = mask & -mask
+        ret.append(Command.qualified_ids[low.bit_length() - 1])
+        mask ^= low
+    return ret
+
+
+async def get_toggle_mask(guild_id: Optional[int]) -> int:
+    """
+    Retrieve the mask of disabled commands in the given guild. A command is
+    disabled if its bit is set in the mask, and is disabled either directly
+    or through one of its parents if the mask shares any bits with the
+    command's ancestor_mask.
+
+    While the database is unavailable, the last known mask is returned, or
+    no commands are disabled if the guild is not known.
+
+    :param guild_id: ID of guild to search in
+    :return: Mask of disabled commands
+    """
+    global _toggle_cache_generation
+    if guild_id is None:
+        return 0
+
+    if Command.generation != _toggle_cache_generation:
+        # Paths of new commands may be cached as unknown
+        _toggle_cache.clear()
+        _toggle_cache.clear_stale()
+        _unknown_toggles.clear()
+        _toggle_cache_generation = Command.generation
+
+    try:
+        return await _toggle_cache.lookup(guild_id)
+    except KeyError:
+        Invalidation.read_fresh("toggles", guild_id)
+        try:
+            ret = await db.fetchall(_select_guild_toggles, guild_id)
+        except DatabaseUnavailable:
+            return _toggle_cache.get_stale(guild_id, 0)
+
+        mask, unknown = _split_paths(row[0] for row in ret)
+
+        _toggle_cache[guild_id] = mask
+        if unknown:
+            _unknown_toggles[guild_id] = unknown
+        else:
+            _unknown_toggles.pop(guild_id, None)
+
+        return mask
 
 
 async def is_toggled(guild_id: Optional[int], path: str) -> bool:
@@ -18,20 +168,39 @@ async def is_toggled(guild_id: Optional[int], path: str) -> bool:
     if guild_id is None:
         return False
 
-    try:
-        return guild_id in _toggle_cache[path]
+    mask = await get_toggle_mask(guild_id)
+    cmd = Command.registry.get(path)
+    if cmd is None:
+        return path in _unknown_toggles.get(guild_id, ())
+    return bool(mask & cmd.bit)
 
-    except KeyError:
-        ret = await db.fetchall("""
-            SELECT guild_id FROM toggles
-            WHERE command = %s
-        """, path)
 
-        ret = [row[0] for row in ret]
+async def get_disabled_ancestor(guild_id: Optional[int],
+                                path: str) -> Optional[str]:
+    """
+    Find the outermost disabled command along a command path, from the
+    top level command down to the command itself, in the given guild. This
+    needs at most one query for the whole path.
+
+    :param guild_id: ID of guild to search in
+    :param path: Command path
+    :return: Path of the outermost disabled command, or None if the command
+    and all of its parents are enabled
+    """
+    cmd = Command.registry.get(path)
+    if guild_id is None or cmd is None:
+        return None
+
+    disabled = await get_toggle_mask(guild_id) & cmd.ancestor_mask
+    if not disabled:
+        return None
+    # Parents have lower indexes than their children
+    return Command.qualified_ids[(disabled & -disabled).bit_length() - 1]
 
-        _toggle_cache[path] = ret
 
-        return guild_id in _toggle_cache[path]
+def _clear_toggles(guild_id: int):
+    _toggle_cache.discard(guild_id)
+    _unknown_toggles.pop(guild_id, None)
 
 
 async def get_guild_toggles(guild_id: int, path: str = "") -> List[str]:
@@ -43,14 +212,23 @@ async def get_guild_toggles(guild_id: int, path: str = "") -> List[str]:
     :param path: Root command path to search for
     :return: List of disabled command paths
     """
-    ret = await db.fetchall("""
-        SELECT command FROM toggles
-        WHERE guild_id = %s
-    """, guild_id)
-
     path = path.replace("*", "")
 
-    return [row[0] for row in ret if path in row[0]]
+    if guild_id in _toggle_cache or not path:
+        toggles = _mask_paths(await get_toggle_mask(guild_id))
+        toggles.extend(_unknown_toggles.get(guild_id, ()))
+        if not path:
+            return toggles
+        prefix = path + "."
+        return [cmd for cmd in toggles
+                if cmd == path or cmd.startswith(prefix)]
+
+    # Cached until the guild's toggles are next changed
+    ret = await db.fetchall_cached(_select_guild_toggles_under, guild_id,
+                                   path, _escape_like(path) + ".%",
+                                   tags=(f"toggles:{guild_id}",))
+
+    return [row[0] for row in ret]
 
 
 async def toggle_elements(guild_id: int, *elements: str):
@@ -61,18 +239,40 @@ async def toggle_elements(guild_id: int, *elements: str):
     :param guild_id: ID of guild to search in
     :param elements: Command paths to toggle
     """
-    args = [(guild_id, e) for e in elements]
-
-    await db.executemany("""
-        CALL toggle_toggle(%s, %s);
-    """, *args)
-
-    for path in elements:
-        if path in _toggle_cache:
-            try:
-                _toggle_cache[path].remove(guild_id)
-            except ValueError:
-                _toggle_cache[path].append(guild_id)
+    paths = list(dict.fromkeys(elements))
+    if not paths:
+        return
+
+    async with db.transaction():
+        query, padded = _sized_query(_select_toggles_in, paths)
+        rows = await db.fetchall(query, guild_id, *padded)
+        disabled = {row[0] for row in rows}
+        enabled = [path for path in paths if path not in disabled]
+        if disabled:
+            query, padded = _sized_query(_delete_toggles_in, list(disabled))
+            await db.execute(query, guild_id, *padded)
+        if enabled:
+            query, padded = _sized_query(_insert_toggles, enabled)
+            await db.execute(query, *(arg for path in padded
+                                      for arg in (guild_id, path)))
+
+    if guild_id in _toggle_cache:
+        # Follow the database, in case the cached mask was out of date
+        off, off_unknown = _split_paths(disabled)
+        on, on_unknown = _split_paths(enabled)
+        _toggle_cache[guild_id] = _toggle_cache[guild_id] & ~off | on
+        unknown = _unknown_toggles.get(guild_id, set()) - off_unknown | \
+            on_unknown
+        if unknown:
+            _unknown_toggles[guild_id] = unknown
+        else:
+            _unknown_toggles.pop(guild_id, None)
+    else:
+        # Any copy on disk is now out of date
+        _toggle_cache.discard(guild_id)
+
+    await Invalidation.publish("toggles", guild_id)
+    await Invalidation.invalidate_tags(f"toggles:{guild_id}")
 
 
 async def enable_elements(guild_id: int, *elements: str):
@@ -82,17 +282,23 @@ async def enable_elements(guild_id: int, *elements: str):
     :param guild_id: ID of guild to enable in
     :param elements: Command paths to enable
     """
-    args = [(guild_id, e) for e in elements]
+    paths = list(dict.fromkeys(elements))
+    if not paths:
+        return
+
+    query, padded = _sized_query(_delete_toggles_in, paths)
+    await db.execute(query, guild_id, *padded)
 
-    await db.executemany("""
-        DELETE FROM toggles
-        WHERE guild_id = %s AND command = %s;  
-    """, *args)
+    if guild_id in _toggle_cache:
+        mask, unknown = _split_paths(paths)
+        _toggle_cache[guild_id] &= ~mask
+        if unknown and guild_id in _unknown_toggles:
+            _unknown_toggles[guild_id] -= unknown
+    else:
+        _toggle_cache.discard(guild_id)
 
-    for path in elements:
-        if path in _toggle_cache and \
-                guild_id not in _toggle_cache[path]:
-            _toggle_cache[path].append(guild_id)
+    await Invalidation.publish("toggles", guild_id)
+    await Invalidation.invalidate_tags(f"toggles:{guild_id}")
 
 
 async def disable_elements(guild_id: int, *elements: str):
@@ -102,20 +308,83 @@ async def disable_elements(guild_id: int, *elements: str):
     :param guild_id: ID of guild to disable in
     :param elements: Command paths to disable
     """
-    args = [(guild_id, e) for e in elements]
+    paths = list(dict.fromkeys(elements))
+    if not paths:
+        return
+
+    query, padded = _sized_query(_insert_toggles, paths)
+    await db.execute(query, *(arg for path in padded
+                              for arg in (guild_id, path)))
+
+    if guild_id in _toggle_cache:
+        mask, unknown = _split_paths(paths)
+        _toggle_cache[guild_id] |= mask
+        if unknown:
+            _unknown_toggles[guild_id] = \
+                _unknown_toggles.get(guild_id, set()) | unknown
+    else:
+        _toggle_cache.discard(guild_id)
+
+    await Invalidation.publish("toggles", guild_id)
+    await Invalidation.invalidate_tags(f"toggles:{guild_id}")
+
+
+Invalidation.subscribe("toggles", _clear_toggles)
+
+
+def _encode_toggles(guild_id: int, mask: int) -> List[str]:
+    # Command indexes may change between runs, so store paths instead
+    return _mask_paths(mask) + list(_unknown_toggles.pop(guild_id, ()))
+
+
+def _decode_toggles(guild_id: int, paths: List[str]) -> int:
+    mask, unknown = _split_paths(paths)
+    if unknown:
+        _unknown_toggles[guild_id] = unknown
+    return mask
+
+
+def _load_toggles(guild_id: int, encoded: Optional[memoryview]) -> int:
+    if encoded is None:
+        _unknown_toggles.pop(guild_id, None)
+        return 0
+    return _decode_toggles(guild_id, json.loads(bytes(encoded)))
+
+
+_toggle_cache.encode = _encode_toggles
+_toggle_cache.decode = _decode_toggles
+_toggle_cache.load = _load_toggles
+SharedSettings.register("toggles", lambda: grouped(
+    _select_all_toggles, lambda paths: json.dumps(paths).encode()))
+
+
+def _dump_toggles() -> Dict[int, List[str]]:
+    # Command indexes may change between runs, so save paths instead
+    return {guild_id: _mask_paths(mask) +
+            list(_unknown_toggles.get(guild_id, ()))
+            for guild_id, mask in _toggle_cache.items()}
+
+
+def _restore_toggles(toggles: Dict[int, List[str]]) -> List[int]:
+    global _toggle_cache_generation
+    _toggle_cache_generation = Command.generation
+    for guild_id, paths in toggles.items():
+        mask, unknown = _split_paths(paths)
+        _toggle_cache[guild_id] = mask
+        if unknown:
+            _unknown_toggles[guild_id] = unknown
+    return list(toggles)
+
+
+async def _revalidate_toggles(guild_ids: List[int]):
+    for guild_id in guild_ids:
+        _clear_toggles(guild_id)
+    for guild_id in guild_ids:
+        await get_toggle_mask(guild_id)
 
-    await db.executemany("""
-        INSERT IGNORE INTO toggles
-        (guild_id, command)
-        VALUES (%s, %s);
-    """, *args)
 
-    for path in elements:
-        if path in _toggle_cache:
-            try:
-                _toggle_cache[path].remove(guild_id)
-            except ValueError:
-                pass
+Snapshot.register("toggles", _dump_toggles, _restore_toggles,
+                  _revalidate_toggles)
 
 
 class Singleton(type):
@@ -129,11 +398,12 @@ class Singleton(type):
 
 class CommandToggle(metaclass=Singleton):
     """
-    Auth class added to all layers of command to check if the command has
-    been disabled in the server it's being called in.
+    Auth class added to all layers of command to check if the command, or
+    any of its parents, has been disabled in the server it's being called in.
     """
     __slots__ = []
     __name__ = "toggle"
     @staticmethod
     async def __call__(ctx):
-        return not await is_toggled(ctx.guild_id, ctx.command.qualified_id)
+        mask = await get_toggle_mask(ctx.guild_id)
+        return not mask & ctx.command.ancestor_mask
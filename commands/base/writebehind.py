@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import json
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from os import fsync, path, replace
+from typing import Any, Dict, Hashable, List, Optional, Set, Tuple
+
+from .database import Database as db, DatabaseUnavailable, Query
+
+Key = Tuple[Hashable, ...]
+Write = Tuple[Query, Tuple[Any, ...]]
+
+# Defaults for the "write_behind" config
+FLUSH_INTERVAL = 5.0
+FLUSH_SIZE = 100
+
+# Thread writing the journal, so that its writes keep their order
+_journal_executor = ThreadPoolExecutor(max_workers=1)
+
+
+def _append_lines(journal: str, lines: List[str]):
+    with open(journal, "a") as f:
+        f.writelines(lines)
+        f.flush()
+        fsync(f.fileno())
+
+
+def _replace_lines(journal: str, lines: List[str]):
+    # Write to a temporary file first, so a crash never loses the journal
+    temp = journal + ".tmp"
+    with open(temp, "w") as f:
+        f.writelines(lines)
+        f.flush()
+        fsync(f.fileno())
+    replace(temp, journal)
+
+
+class WriteBehind:
+    """
+    Class used to defer settings writes to the database.
+
+    Callers submit the write here, keyed by the table and row it affects,
+    and update their in-memory caches once it returns. When write-behind is enabled
+    in the "write_behind" config, writes are held in memory and flushed in
+    batches every `interval' seconds, or as soon as `max_batch' rows are
+    pending. A newer write to a pending key replaces the older one, so
+    repeated changes to the same setting only reach the database once.
+
+    Every pending write is also appended to a journal file, which is replayed
+    on startup if the bot stopped before it could be flushed. The journal is
+    written and synced to disk in a background thread, with every write
+    submitted while the previous sync was running synced at once. All pending
+    writes are flushed by WriteBehind.close() on a graceful shutdown.
+
+    Writes to tables in `trailing_tables' are executed after every other
+    write in the same flush, and only once all of them have succeeded.
+
+    When write-behind is disabled, every write is executed immediately.
+    """
+    __slots__ = []
+    enabled = False
+    interval = FLUSH_INTERVAL
+    max_batch = FLUSH_SIZE
+    journal: Optional[str] = None
+    pending: Dict[Key, Write] = {}
+    trailing_tables: Set[str] = set()
+    _flush_task: Optional[asyncio.Task] = None
+    _flush_lock: Optional[asyncio.Lock] = None
+    _started = False
+    # Journal lines not yet handed to the journal thread
+    _journal_lines: List[str] = []
+    _journal_task: Optional[asyncio.Task] = None
+    submitted = 0
+    coalesced = 0
+    flushed = 0
+    batches = 0
+    failures = 0
+
+    @classmethod
+    def configure(cls, config: Dict[str, Any]):
+        """
+        Set the write-behind options from the bot config.
+
+        :param config: Bot config, containing the optional "write_behind"
+        entry
+        """
+        options = config.get("write_behind", {})
+        cls.enabled = options.get("enabled", False)
+        cls.interval = options.get("interval", FLUSH_INTERVAL)
+        cls.max_batch = options.get("max_batch", FLUSH_SIZE)
+        cls.journal = options.get("journal")
+
+    @classmethod
+    async def start(cls):
+        """
+        Replay any writes left in the journal by a previous run, then start
+        flushing pending writes periodically. This is called automatically by
+        the first write if it has not been awaited beforehand.
+        """
+        if not cls.enabled or cls._started:
+            return
+        cls._started = True
+        await cls._replay()
+        cls._flush_task = asyncio.ensure_future(cls._flush_periodically())
+
+    @classmethod
+    async def submit(cls, key: Key, query: Query, *data: Any):
+        """
+        Write a row to the database, replacing any pending write with the
+        same key. The first element of the key must be the name of the table
+        being written to.
+
+        :param key: Key identifying the row being written
+        :param query: Registered query to execute
+        :param data: Arguments for prepared statements in query
+        """
+        if not cls.enabled:
+            await db.execute(query, *data)
+            return
+
+        await cls.start()
+        cls.submitted += 1
+        if key in cls.pending:
+            cls.coalesced += 1
+        cls.pending[key] = (query, data)
+        cls._log(key, query, data)
+        cls._check_size()
+
+    @classmethod
+    async def toggle(cls, key: Key, query: Query, *data: Any):
+        """
+        Write a row to the database that reverses the effect of any pending
+        write with the same key. If a write is pending, the two cancel out
+        and neither is executed. The first element of the key must be the name
+        of the table being written to.
+
+        :param key: Key identifying the row being written
+        :param query: Registered query to execute
+        :param data: Arguments for prepared statements in query
+        """
+        if not cls.enabled:
+            await db.execute(query, *data)
+            return
+
+        await cls.start()
+        cls.submitted += 1
+        if key in cls.pending:
+            cls.coalesced += 1
+            del cls.pending[key]
+            cls._log(key, None, ())
+        else:
+            cls.pending[key] = (query, data)
+            cls._log(key, query, data)
+            cls._check_size()
+
+    @classmethod
+    @asynccontextmanager
+    async def transaction(cls):
+        """
+        Run the reads and writes made in the body in one database
+        transaction, when writes are executed immediately. When write-behind
+        is enabled, the body's writes are only queued, so no transaction is
+        opened.
+        """
+        if cls.enabled:
+            yield
+            return
+        async with db.transaction():
+            yield
+
+    @classmethod
+    async def barrier(cls, table: str):
+        """
+        Flush all pending writes if any of them are to the given table. This
+        must be awaited before reading the table from the database, so that
+        the read does not miss any writes that have not been flushed.
+
+        :param table: Name of table about to be read
+        """
+        flushing = cls._flush_lock is not None and cls._flush_lock.locked()
+        if flushing or any(key[0] == table for key in cls.pending):
+            # Writes taken by a flush in progress are no longer pending, but
+            # may not have been executed yet
+            await cls.flush()
+
+    @classmethod
+    async def flush(cls):
+        """
+        Execute all pending writes, grouping consecutive writes that use the
+        same query into a single batch. If a batch fails, its writes are
+        retried one at a time, and any write that still fails stays pending
+        for the next flush, unless a newer write to the same key has been
+        submitted in the meantime. Writes to trailing tables stay pending if
+        any other write failed. If the database is unavailable, the flush
+        stops and every write it has not executed stays pending.
+        """
+        # Flush in a fresh context, so that the writes of every caller never
+        # share a connection or transaction bound by this one
+        await contextvars.Context().run(asyncio.ensure_future, cls._flush())
+
+    @classmethod
+    async def _flush(cls):
+        if cls._flush_lock is None:
+            cls._flush_lock = asyncio.Lock()
+
+        async with cls._flush_lock:
+            if not cls.pending:
+                return
+            writes = list(cls.pending.items())
+            cls.pending.clear()
+            # The sort is stable, so other writes keep their order
+            writes.sort(key=lambda write: write[0][0] in cls.trailing_tables)
+
+            batches: List[Tuple[Query, List[Key], List[Tuple[Any, ...]]]] = []
+            for key, (query, data) in writes:
+                if batches and batches[-1][0] is query:
+                    batches[-1][1].append(key)
+                    batches[-1][2].append(data)
+                else:
+                    batches.append((query, [key], [data]))
+
+            failed: Dict[Key, Write] = {}
+            unavailable = False
+            for query, keys, data_groups in batches:
+                if unavailable or (failed and
+                                   keys[0][0] in cls.trailing_tables):
+                    for key, data in zip(keys, data_groups):
+                        failed[key] = (query, data)
+                    continue
+                try:
+                    await db.executemany(query, *data_groups)
+                except DatabaseUnavailable as e:
+                    print(f"Database unavailable, keeping writes: {e}")
+                    unavailable = True
+                    for key, data in zip(keys, data_groups):
+                        failed[key] = (query, data)
+                    continue
+                except Exception:
+                    for key, data in zip(keys, data_groups):
+                        if unavailable:
+                            failed[key] = (query, data)
+                            continue
+                        try:
+                            await db.execute(query, *data)
+                        except Exception as e:
+                            if isinstance(e, DatabaseUnavailable):
+                                unavailable = True
+                            else:
+                                print(f"Failed to write {key}: {e}")
+                                cls.failures += 1
+                            failed[key] = (query, data)
+                        else:
+                            cls.flushed += 1
+                else:
+                    cls.flushed += len(keys)
+                cls.batches += 1
+
+            # Newer writes made during the flush take priority
+            failed.update(cls.pending)
+            cls.pending = failed
+            await cls._rewrite_journal()
+
+    @classmethod
+    async def close(cls):
+        """
+        Stop flushing periodically and flush every pending write. Writes that
+        cannot be flushed are kept in the journal for the next run.
+        """
+        if cls._flush_task is not None:
+            cls._flush_task.cancel()
+            cls._flush_task = None
+        cls._started = False
+        await cls.flush()
+        if cls._journal_task is not None:
+            await cls._journal_task
+        if cls.pending:
+            print(f"{len(cls.pending)} pending writes could not be flushed")
+
+    @classmethod
+    def stats(cls) -> Dict[str, int]:
+        """
+        Retrieve statistics on the writes made so far.
+
+        :return: Dict of statistics
+        """
+        return {
+            "pending": len(cls.pending),
+            "submitted": cls.submitted,
+            "coalesced": cls.coalesced,
+            "flushed": cls.flushed,
+            "batches": cls.batches,
+            "failures": cls.failures
+        }
+
+    @classmethod
+    def _check_size(cls):
+        if len(cls.pending) >= cls.max_batch:
+            asyncio.ensure_future(cls.flush())
+
+    @classmethod
+    async def _flush_periodically(cls):
+        while True:
+            await asyncio.sleep(cls.interval)
+            await cls.flush()
+
+    # Journal
+
+    @classmethod
+    def _log(cls, key: Key, query: Optional[Query], data: Tuple[Any, ...]):
+        """
+        Append a write to the journal. A query of None records that the
+        pending write with the given key was cancelled.
+        """
+        if cls.journal is None:
+            return
+        entry = {"key": key, "query": query and query.name, "data": data}
+        cls._journal_lines.append(json.dumps(entry) + "\n")
+        if cls._journal_task is None or cls._journal_task.done():
+            cls._journal_task = asyncio.ensure_future(cls._sync_journal())
+
+    @classmethod
+    async def _sync_journal(cls):
+        """
+        Append the logged lines to the journal until none are left.
+        """
+        loop = asyncio.get_event_loop()
+        while cls._journal_lines:
+            lines = cls._journal_lines
+            cls._journal_lines = []
+            try:
+                await loop.run_in_executor(_journal_executor, _append_lines,
+                                           cls.journal, lines)
+            except OSError as e:
+                print(f"Failed to write to journal: {e}")
+
+    @classmethod
+    async def _rewrite_journal(cls):
+        """
+        Replace the journal with only the writes that are still pending.
+        """
+        if cls.journal is None:
+            return
+        lines = [json.dumps({"key": key, "query": query.name, "data": data})
+                 + "\n" for key, (query, data) in cls.pending.items()]
+        # Lines logged so far are covered by the pending writes
+        cls._journal_lines = []
+        try:
+            await asyncio.get_event_loop().run_in_executor(
+                _journal_executor, _replace_lines, cls.journal, lines)
+        except OSError as e:
+            print(f"Failed to rewrite journal: {e}")
+
+    @classmethod
+    async def _replay(cls):
+        """
+        Add every write in the journal to the pending writes, without
+        replacing any writes made since startup.
+        """
+        if cls.journal is None or not path.isfile(cls.journal):
+            return
+        replayed = {}
+        with open(cls.journal) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line may be incomplete if the bot crashed
+                    continue
+                key = tuple(entry["key"])
+                if entry["query"] is None:
+                    replayed.pop(key, None)
+                else:
+                    replayed[key] = (db.queries[entry["query"]],
+                                     tuple(entry["data"]))
+        replayed.update(cls.pending)
+        cls.pending = replayed
+        if replayed:
+            print(f"Replayed {len(replayed)} pending writes from journal")
+        await cls._rewrite_journal()
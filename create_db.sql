@@ -1,7 +1,9 @@
 CREATE TABLE IF NOT EXISTS invokers (
-    guild_id BIGINT UNSIGNED NOT NULL PRIMARY KEY,
-    callstr VARCHAR(32)
+    guild_id BIGINT UNSIGNED NOT NULL,
+    callstr VARCHAR(32),
+    UNIQUE KEY invokers_guild_callstr_index (guild_id, callstr)
 );
+CREATE INDEX invokers_guild_index ON invokers(guild_id);
 
 CREATE TABLE IF NOT EXISTS guild_lang (
     guild_id BIGINT UNSIGNED PRIMARY KEY,
@@ -25,6 +27,17 @@ CREATE TABLE IF NOT EXISTS toggles (
     command VARCHAR(255) NOT NULL,
     PRIMARY KEY (guild_id, command)
 );
+CREATE INDEX toggles_command_index ON toggles(command);
+
+CREATE TABLE IF NOT EXISTS cache_invalidations (
+    id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    origin CHAR(32) NOT NULL,
+    tbl VARCHAR(64) NOT NULL,
+    cache_key VARCHAR(255) NOT NULL,
+    created DOUBLE NOT NULL
+);
+CREATE INDEX cache_invalidations_created_index
+    ON cache_invalidations(created);
 
 DROP PROCEDURE IF EXISTS toggle_toggle;
 
@@ -0,0 +1,42 @@
+CREATE TABLE IF NOT EXISTS invokers (
+    guild_id INTEGER NOT NULL,
+    callstr VARCHAR(32),
+    UNIQUE (guild_id, callstr)
+);
+CREATE INDEX IF NOT EXISTS invokers_guild_index ON invokers(guild_id);
+
+CREATE TABLE IF NOT EXISTS guild_lang (
+    guild_id INTEGER PRIMARY KEY,
+    lang VARCHAR(15) NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS channel_lang (
+    channel_id INTEGER PRIMARY KEY,
+    lang VARCHAR(15) NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS botbans (
+    user_id INTEGER NOT NULL,
+    guild_id INTEGER NOT NULL,
+    PRIMARY KEY (user_id, guild_id)
+);
+CREATE INDEX IF NOT EXISTS botbans_guild_index ON botbans(guild_id);
+
+CREATE TABLE IF NOT EXISTS toggles (
+    guild_id INTEGER NOT NULL,
+    command VARCHAR(255) NOT NULL,
+    PRIMARY KEY (guild_id, command)
+);
+CREATE INDEX IF NOT EXISTS toggles_command_index ON toggles(command);
+
+CREATE TABLE IF NOT EXISTS cache_invalidations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    origin CHAR(32) NOT NULL,
+    tbl VARCHAR(64) NOT NULL,
+    cache_key VARCHAR(255) NOT NULL,
+    created DOUBLE NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cache_invalidations_created_index
+    ON cache_invalidations(created);
+
+-- The toggle_toggle procedure is implemented in commands/base/sqlite.py
@@ -1,13 +1,24 @@
 # -*- coding: utf-8 -*-
 
-from commands.base import bot
+from commands.base import (bot, db, WriteBehind, Invalidation, Snapshot,
+                           L2Store, SharedSettings, ClusterLink)
 import os
 import asyncio
 
 
 async def main_task(token):
+    # Warm the caches before any messages arrive
+    Snapshot.restore()
     print("Logging in...")
-    await bot._bot.login(token)
+    # Connect to the database while logging in
+    await asyncio.gather(db.connect(), bot._bot.login(token))
+    await ClusterLink.start()
+    await WriteBehind.start()
+    # Changes made while stopped must be applied before polling for more
+    await L2Store.start()
+    await Invalidation.start()
+    await Snapshot.start()
+    await SharedSettings.start()
     print("Logged in, Connecting...")
     await bot._bot.connect()
 
@@ -22,6 +33,14 @@ def main():
         loop.run_until_complete(main_task(token))
     finally:
         loop.run_until_complete(asyncio.sleep(1))
+        ClusterLink.close()
+        loop.run_until_complete(Invalidation.close())
+        # Pending settings writes must reach the database before it closes
+        loop.run_until_complete(WriteBehind.close())
+        Snapshot.save()
+        L2Store.close()
+        SharedSettings.close()
+        loop.run_until_complete(db.close())
         loop.stop()
 
 
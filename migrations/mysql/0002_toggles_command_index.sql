@@ -0,0 +1,2 @@
+-- Supports looking up which guilds have disabled a command
+CREATE INDEX toggles_command_index ON toggles(command);
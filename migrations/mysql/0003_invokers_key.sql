@@ -0,0 +1,9 @@
+-- Guilds may have several invokers, so guild_id alone cannot be the key.
+-- The guild index is added first, so lookups by guild stay indexed.
+CREATE INDEX invokers_guild_index ON invokers(guild_id);
+-- Swapping the keys in one statement means there is no moment without a
+-- unique key, and the table is not locked while the index is built
+ALTER TABLE invokers
+    DROP PRIMARY KEY,
+    ADD UNIQUE INDEX invokers_guild_callstr_index (guild_id, callstr),
+    ALGORITHM=INPLACE, LOCK=NONE;
@@ -0,0 +1,12 @@
+-- Guilds may have several invokers, so guild_id alone cannot be the key.
+-- SQLite cannot change a table's key, so the table is copied.
+CREATE TABLE invokers_new (
+    guild_id INTEGER NOT NULL,
+    callstr VARCHAR(32),
+    UNIQUE (guild_id, callstr)
+);
+INSERT OR IGNORE INTO invokers_new
+SELECT guild_id, callstr FROM invokers;
+DROP TABLE invokers;
+ALTER TABLE invokers_new RENAME TO invokers;
+CREATE INDEX IF NOT EXISTS invokers_guild_index ON invokers(guild_id);
@@ -1,8 +1,12 @@
+DROP TABLE IF EXISTS schema_version;
+
 DROP TABLE IF EXISTS invokers;
 CREATE TABLE invokers (
-    guild_id BIGINT UNSIGNED PRIMARY KEY,
-    callstr VARCHAR(32)
+    guild_id BIGINT UNSIGNED NOT NULL,
+    callstr VARCHAR(32),
+    UNIQUE KEY invokers_guild_callstr_index (guild_id, callstr)
 );
+CREATE INDEX invokers_guild_index ON invokers(guild_id);
 DROP TABLE IF EXISTS guild_lang;
 CREATE TABLE guild_lang (
     guild_id BIGINT UNSIGNED PRIMARY KEY,
@@ -29,6 +33,18 @@ CREATE TABLE toggles (
     command VARCHAR(255) NOT NULL,
     PRIMARY KEY (guild_id, command)
 );
+CREATE INDEX toggles_command_index ON toggles(command);
+
+DROP TABLE IF EXISTS cache_invalidations;
+CREATE TABLE cache_invalidations (
+    id BIGINT UNSIGNED NOT NULL AUTO_INCREMENT PRIMARY KEY,
+    origin CHAR(32) NOT NULL,
+    tbl VARCHAR(64) NOT NULL,
+    cache_key VARCHAR(255) NOT NULL,
+    created DOUBLE NOT NULL
+);
+CREATE INDEX cache_invalidations_created_index
+    ON cache_invalidations(created);
 
 DROP PROCEDURE IF EXISTS toggle_toggle;
 